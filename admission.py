@@ -0,0 +1,215 @@
+from flask import current_app, g, jsonify, render_template, request, session
+from sqlalchemy import case, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from functools import wraps
+import math
+import os
+import threading
+import time
+from jobs import inference_queue
+from metrics import Counter
+
+admission_rejections_total = Counter('xray_admission_rejections_total',
+                                     'Inference requests turned away by admission control', ('endpoint', 'reason'))
+
+def take_token(key, rate, burst, now=None):
+    """Spend one token from a shared bucket allowing `rate` requests per second with bursts of `burst`.
+
+    The bucket is a database row refilled and spent in one UPDATE, so every
+    worker process draws from the same tokens. Returns 0 when allowed, else
+    the seconds until a token is available.
+    """
+    from database import db, RateLimitBucket
+    bucket = RateLimitBucket.__table__
+    now = time.time() if now is None else now
+    refilled = bucket.c.tokens + (now - bucket.c.updated) * rate
+    level = case((refilled > burst, float(burst)), else_=refilled)
+    for _ in range(2):
+        try:
+            # Its own connection, so a request's pending changes are never committed here
+            with db.engine.begin() as conn:
+                taken = conn.execute(update(bucket).where(bucket.c.key == key, level >= 1).values(
+                    tokens=level - 1, updated=now)).rowcount
+                if taken:
+                    return 0.0
+                tokens = conn.execute(select(level).where(bucket.c.key == key)).scalar()
+                if tokens is not None:
+                    return (1 - tokens) / rate
+                conn.execute(insert(bucket).values(key=key, tokens=float(burst) - 1, updated=now))
+                return 0.0
+        except IntegrityError:
+            # Another worker created the bucket first; spend from that one
+            continue
+    return 0.0
+
+class AdmissionController:
+    """Admission control for the endpoints that run or queue inference.
+
+    Each request is checked before its body is read: the admin's rate
+    limit (429), the detection backlog (503) and the number of inference
+    requests this process is already handling (503). Rejections are fast
+    and carry Retry-After. The rate limit and the backlog live in the
+    database and hold across all workers. The concurrency limit is per
+    worker process by nature: it keeps that worker's request threads free
+    for everything else, so history, result pages and images stay
+    responsive during an upload storm; those endpoints never pass through
+    here.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_concurrent = 0
+        self.max_queue = 0
+        self.rate = 0.0
+        self.burst = 1
+        self.max_retry_after = 60
+        self.active = 0
+        self.inference_processes = 1
+        self._lock = threading.Lock()
+        self._pending = (0.0, 0)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ADMISSION_CONTROL', True)
+        self.max_concurrent = app.config.get('ADMISSION_MAX_CONCURRENT_PER_WORKER') or max(
+            1, int(os.getenv('GUNICORN_THREADS', 4)) - app.config.get('ADMISSION_RESERVED_THREADS', 1))
+        # With local inference every web worker runs its own inference threads
+        if not inference_queue.external:
+            self.inference_processes = max(1, int(os.getenv('GUNICORN_WORKERS', 1)))
+        self.max_queue = app.config.get('ADMISSION_MAX_QUEUE', 100)
+        self.rate = app.config.get('RATE_LIMIT_PER_MINUTE', 0) / 60.0
+        self.burst = max(1, app.config.get('RATE_LIMIT_BURST', 10))
+        self.max_retry_after = app.config.get('ADMISSION_MAX_RETRY_AFTER', 60)
+
+    def backlog(self):
+        """Uploads waiting for or in detection, across all workers"""
+        # One count per second per process is plenty for a shed decision
+        checked_at, count = self._pending
+        if time.monotonic() - checked_at > 1.0:
+            from database import Upload
+            count = Upload.query.filter(Upload.status.in_(('pending', 'running'))).count()
+            self._pending = (time.monotonic(), count)
+        return count
+
+    def backlog_retry_after(self, backlog):
+        """Time for the inference threads to work through the backlog, from the average run time"""
+        average = inference_queue.run_time.snapshot()['avg'] or 1.0
+        return backlog * average / (max(1, inference_queue.num_workers) * self.inference_processes)
+
+    def rate_limited(self, admin_id):
+        """Seconds until the admin may send another request, or 0"""
+        if not self.rate or admin_id is None:
+            return 0.0
+        try:
+            return take_token(f"admin:{admin_id}", self.rate, self.burst)
+        except Exception as e:
+            # Fail open: a database hiccup should not turn away every upload
+            print(f"Error checking the rate limit: {e}")
+            return 0.0
+
+    def admit(self, admin_id):
+        """Returns None and holds a slot when the request may run, else (status, reason, retry_after)"""
+        wait = self.rate_limited(admin_id)
+        if wait:
+            return 429, 'rate_limit', wait
+        if self.max_queue:
+            backlog = self.backlog()
+            if backlog >= self.max_queue:
+                return 503, 'queue_full', self.backlog_retry_after(backlog - self.max_queue + 1)
+        if not self.try_acquire():
+            return 503, 'concurrency', 1
+        return None
+
+    def try_acquire(self):
+        """Take a concurrency slot if one is free"""
+        with self._lock:
+            if self.active >= self.max_concurrent:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'active': self.active,
+            'max_concurrent_per_worker': self.max_concurrent,
+            'max_queue': self.max_queue,
+            'rate_limit_per_minute': round(self.rate * 60, 3)
+        }
+
+admission = AdmissionController()
+
+class BatchSlots:
+    """In-flight limit for the images of one batch request.
+
+    At most `limit` images wait for or run detection at once. With a
+    controller, the request's own admission slot covers one of them and
+    every further one takes a concurrency slot of its own, so a batch
+    counts like the same number of single uploads running together.
+    """
+
+    def __init__(self, limit, controller=None):
+        self.limit = limit
+        self.controller = controller
+        self.running = 0
+        self.extra = 0
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        with self._changed:
+            while self.running:
+                if self.running < self.limit:
+                    if self.controller is None:
+                        break
+                    if self.controller.try_acquire():
+                        self.extra += 1
+                        break
+                # Woken when an image of this batch finishes; slots freed
+                # by other requests are noticed on the next look
+                self._changed.wait(0.05)
+            self.running += 1
+
+    def release(self):
+        with self._changed:
+            self.running -= 1
+            if self.extra:
+                self.extra -= 1
+                self.controller.release()
+            self._changed.notify()
+
+REJECTION_MESSAGES = {
+    'rate_limit': ("Too Many Requests", "You are sending images faster than the configured limit."),
+    'queue_full': ("Server Busy", "Too many images are waiting for detection."),
+    'concurrency': ("Server Busy", "The server is handling as many uploads as it can.")
+}
+
+def rejection_response(status, reason, retry_after):
+    retry_after = min(admission.max_retry_after, max(1, math.ceil(retry_after)))
+    admission_rejections_total.inc(endpoint=request.endpoint, reason=reason)
+    title, message = REJECTION_MESSAGES[reason]
+    if request.blueprint == 'api' or request.accept_mimetypes.best == 'application/json':
+        response = jsonify({"error": message, "reason": reason, "retry_after": retry_after})
+    else:
+        response = current_app.make_response(render_template(
+            'busy.html', status=status, title=title, message=message, retry_after=retry_after))
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+# Admission decorator for inference endpoints; goes below the auth decorator
+def admission_controlled(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not admission.enabled:
+            return f(*args, **kwargs)
+        rejected = admission.admit(g.get('api_admin_id') or session.get('admin_id'))
+        if rejected:
+            return rejection_response(*rejected)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            admission.release()
+    return decorated_function
@@ -0,0 +1,213 @@
+from flask import Blueprint, request, jsonify, url_for, g, current_app
+from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from functools import wraps
+from datetime import datetime, timedelta
+import click
+import hashlib
+import io
+import json
+import secrets
+import time
+from database import db, Admin, Upload, ApiToken
+from admission import admission_controlled
+from jobs import inference_queue
+from detection import allowed_file, validate_image, create_upload, send_upload_image, image_version
+from history import parse_history_filters, history_page, serialize_upload, has_processed_image
+from metrics import upload_errors_total
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def api_error(message, status):
+    return jsonify({"error": message}), status
+
+# Token required decorator for machine clients; no session cookie involved
+def token_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth_header = request.headers.get('Authorization', '')
+        if not auth_header.startswith('Bearer '):
+            return api_error("Missing bearer token", 401)
+        api_token = ApiToken.query.filter_by(token_hash=hash_token(auth_header[7:].strip()), revoked=False).first()
+        if not api_token:
+            return api_error("Invalid or revoked token", 401)
+
+        # Record usage at most once a minute instead of writing on every call
+        now = datetime.now()
+        if not api_token.last_used_at or now - api_token.last_used_at > timedelta(minutes=1):
+            api_token.last_used_at = now
+            db.session.commit()
+        g.api_admin_id = api_token.admin_id
+        return f(*args, **kwargs)
+    return decorated_function
+
+def serialize_detection(upload):
+    """Upload with every prediction box and links to its images"""
+    data = serialize_upload(upload)
+    predictions = json.loads(upload.predictions) if upload.predictions else []
+    data.update({
+        "error": upload.error_message,
+        "predictions": [{
+            "class": prediction["class"],
+            "confidence": prediction["confidence"],
+            "xyxy": prediction["coordinates"]
+        } for prediction in predictions],
+        "images": {
+            "original": url_for('api.detection_image', image_id=upload.id, image_type='original',
+                                v=image_version(upload), _external=True),
+            "processed": url_for('api.detection_image', image_id=upload.id, image_type='processed', _external=True)
+            if has_processed_image(upload) else None
+        },
+        "url": url_for('api.get_detection', image_id=upload.id, _external=True)
+    })
+    return data
+
+def iter_request_images():
+    """Yield (filename, bytes) from a raw image body or multipart files"""
+    if request.mimetype.startswith('image/'):
+        # Raw body: no multipart parsing, the filename comes from the query string
+        yield request.args.get('filename', ''), request.get_data(cache=False)
+        return
+    for file in request.files.getlist('files') + request.files.getlist('file'):
+        if file and file.filename:
+            yield file.filename, file.stream.read()
+
+def submit_image(filename, image_data):
+    """Validate and submit one image; returns (upload, error)"""
+    file_extension = validate_image(io.BytesIO(image_data))
+    if not file_extension:
+        upload_errors_total.inc(reason='invalid_image')
+        return None, "Invalid image file."
+    if not filename:
+        filename = f"upload{file_extension}"
+    if not allowed_file(filename):
+        upload_errors_total.inc(reason='extension')
+        return None, "Only JPG, JPEG and PNG files allowed."
+    upload, _ = create_upload(image_data, secure_filename(filename), file_extension, g.api_admin_id, source='api')
+    return upload, None
+
+def wait_for_results(uploads, timeout):
+    """Wait up to timeout seconds for queued uploads to finish.
+
+    Jobs queued in this process signal completion through the inference
+    queue; uploads detected elsewhere (INFERENCE_PROCESS=external) are
+    polled, backing off from 50 ms to one second.
+    """
+    deadline = time.monotonic() + timeout
+    interval = 0.05
+    while True:
+        pending = [upload for upload in uploads if upload.status in ('pending', 'running')]
+        remaining = deadline - time.monotonic()
+        if not pending or remaining <= 0:
+            return
+        if not all(inference_queue.wait(upload.id, deadline - time.monotonic()) is not None
+                   for upload in pending):
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, 1.0)
+        for upload in pending:
+            db.session.refresh(upload)
+
+@api_bp.route('/detections', methods=['POST'])
+@token_required
+@admission_controlled
+def create_detections():
+    """Submit one raw image body or several multipart files for detection.
+
+    ?wait=N holds the response for up to N seconds (capped by API_MAX_WAIT)
+    so simple clients get the result without polling.
+    """
+    try:
+        wait = min(request.args.get('wait', 0, type=float), current_app.config.get('API_MAX_WAIT', 30))
+        items = []
+        uploads = []
+        for filename, image_data in iter_request_images():
+            upload, error = submit_image(filename, image_data)
+            items.append((filename, upload, error))
+            if upload:
+                uploads.append(upload)
+    except RequestEntityTooLarge:
+        upload_errors_total.inc(reason='too_large')
+        return api_error("Image too large", 413)
+    if not items:
+        return api_error("Send an image body (Content-Type: image/jpeg or image/png) or multipart 'files'", 400)
+
+    if wait > 0:
+        wait_for_results(uploads, wait)
+    status = 201 if uploads and all(upload.status in ('done', 'failed') for upload in uploads) else 202
+
+    # A single raw image gets a single object back
+    if len(items) == 1:
+        filename, upload, error = items[0]
+        if error:
+            return api_error(error, 400)
+        response = jsonify(serialize_detection(upload))
+        response.status_code = status
+        response.headers['Location'] = url_for('api.get_detection', image_id=upload.id)
+        return response
+
+    return jsonify({"items": [
+        serialize_detection(upload) if upload else {"file_name": filename, "error": error}
+        for filename, upload, error in items
+    ]}), status
+
+@api_bp.route('/detections/<int:image_id>', methods=['GET'])
+@token_required
+def get_detection(image_id):
+    upload = Upload.query.get(image_id)
+    if not upload:
+        return api_error("Detection not found", 404)
+    return jsonify(serialize_detection(upload))
+
+@api_bp.route('/detections', methods=['GET'])
+@token_required
+def list_detections():
+    """History with the same filters and cursors as /history/data"""
+    limit = min(request.args.get('limit', current_app.config.get('HISTORY_PAGE_SIZE', 10), type=int), 100)
+    try:
+        filters = parse_history_filters(request.args)
+        page = history_page(filters,
+                            after=request.args.get('after'),
+                            before=request.args.get('before'),
+                            limit=max(limit, 1))
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    page['items'] = [serialize_detection(upload) for upload in page['items']]
+    return jsonify(page)
+
+@api_bp.route('/detections/<int:image_id>/image/<string:image_type>', methods=['GET'])
+@token_required
+def detection_image(image_id, image_type):
+    if image_type not in ('original', 'processed'):
+        return api_error("Image type must be original or processed", 404)
+    upload = Upload.query.get(image_id)
+    if not upload:
+        return api_error("Detection not found", 404)
+    return send_upload_image(upload, image_type, request.args.get('size'),
+                             request.args.get('threshold', type=float))
+
+# Flask CLI commands to manage API tokens
+@click.command("create-token")
+@click.argument("name")
+@click.option("--admin", "username", default="admin", help="Admin user the token acts as.")
+def create_token_command(name, username):
+    """Create an API token; it is shown only once."""
+    admin = Admin.query.filter_by(username=username).first()
+    if not admin:
+        click.echo(f"Admin user '{username}' not found")
+        return
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(name=name, token_hash=hash_token(token), admin_id=admin.id))
+    db.session.commit()
+    click.echo(token)
+
+@click.command("revoke-token")
+@click.argument("name")
+def revoke_token_command(name):
+    """Revoke every API token with this name."""
+    count = ApiToken.query.filter_by(name=name, revoked=False).update({'revoked': True})
+    db.session.commit()
+    click.echo(f"Revoked {count} token(s)")
@@ -1,33 +1,256 @@
-from flask import Flask, render_template, redirect, url_for, flash, session
+from flask import Flask, Request, Response, render_template, redirect, url_for, session, jsonify, request
 from auth import auth_bp, register_cli_commands
-from detection import detection_bp
-from report import report_bp
-from database import init_db, db  # Import db from Database.py
+from detection import detection_bp, process_upload, predict_batch, preload_model, start_warm_up, get_model_status, requeue_stranded_uploads
+from jobs import inference_queue
+from batching import inference_batcher
+from report import report_bp, requeue_report_jobs
+from bulk import bulk_bp, ingest_command
+from cache import dedupe_uploads_command, purge_processed_command, overlay_cache
+from storage import storage, migrate_storage_command
+from backends import export_model_command, check_backend_command
+from database import init_db, db_upgrade_command, Upload  # Import db from Database.py
+from audit import audit_bp, audit_log, export_audit_log_command
+from api import api_bp, create_token_command, revoke_token_command
+from rescore import rescore_bp, rescore_command
+from worker import inference_worker_command
+from model_server import model_server_command
+from admission import admission
+from metrics import (COUNTERS, request_metrics, inference_seconds, stage_histograms, request_histograms,
+                     request_stage_histograms, histogram_family, prometheus_text)
 import os
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+class AppRequest(Request):
+    @property
+    def max_content_length(self):
+        # Batch uploads carry many images, so they get their own size limit
+        if self.endpoint == 'bulk.upload_batch':
+            return app.config['BATCH_MAX_CONTENT_LENGTH']
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = AppRequest
 
 # Use environment variable for secret key, fallback to random if not set
 app.secret_key = os.getenv('SECRET_KEY', os.urandom(24))
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/uploads')
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', os.path.join(BASE_DIR, 'static/uploads'))
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Initialize database with SQLAlchemy
+# YOLO weights; loaded at startup unless MODEL_PRELOAD is false
+app.config['MODEL_PATH'] = os.getenv('MODEL_PATH', os.path.join(BASE_DIR, 'models', 'best.pt'))
+app.config['MODEL_PRELOAD'] = os.getenv('MODEL_PRELOAD', 'True').lower() == 'true'
+app.config['MODEL_WARMUP_IMGSZ'] = int(os.getenv('MODEL_WARMUP_IMGSZ', 640))
+app.config['TORCH_THREADS'] = int(os.getenv('TORCH_THREADS', 0)) or None
+
+# Inference backend: torch (ultralytics eager), onnx (ONNX Runtime) or openvino.
+# Exported models default to files next to MODEL_PATH (see flask export-model)
+app.config['INFERENCE_BACKEND'] = os.getenv('INFERENCE_BACKEND', 'torch')
+app.config['ONNX_MODEL_PATH'] = os.getenv('ONNX_MODEL_PATH')
+app.config['OPENVINO_MODEL_PATH'] = os.getenv('OPENVINO_MODEL_PATH')
+app.config['ONNX_INTRA_OP_THREADS'] = int(os.getenv('ONNX_INTRA_OP_THREADS', 0)) or None
+app.config['MODEL_IMGSZ'] = int(os.getenv('MODEL_IMGSZ', 640))
+
+# Tiled inference for high-resolution films: off, tiles (whole image plus every
+# overlapping tile) or coarse (whole image at INFERENCE_COARSE_CONF first, then
+# only the tiles around its candidates); tile boxes are merged with cross-tile NMS
+app.config['INFERENCE_TILING'] = os.getenv('INFERENCE_TILING', 'off').lower()
+app.config['INFERENCE_TILE_SIZE'] = int(os.getenv('INFERENCE_TILE_SIZE', 1024))
+app.config['INFERENCE_TILE_OVERLAP'] = float(os.getenv('INFERENCE_TILE_OVERLAP', 0.2))
+app.config['INFERENCE_TILE_BATCH'] = int(os.getenv('INFERENCE_TILE_BATCH', 8))
+app.config['INFERENCE_TILE_MERGE_IOU'] = float(os.getenv('INFERENCE_TILE_MERGE_IOU', 0.5))
+app.config['INFERENCE_COARSE_CONF'] = float(os.getenv('INFERENCE_COARSE_CONF', 0.05))
+
+# Number of background threads running YOLO for queued uploads
+app.config['INFERENCE_WORKERS'] = int(os.getenv('INFERENCE_WORKERS', 1))
+
+# Where detection runs: local (threads in every web worker) or external (web
+# workers only store uploads as pending and never import torch; a dedicated
+# `flask inference-worker` process runs the model)
+app.config['INFERENCE_PROCESS'] = os.getenv('INFERENCE_PROCESS', 'local').lower()
+
+# Seconds an upload may stay running before it counts as abandoned (its
+# process died) and is queued again; keep it above the slowest detection
+app.config['INFERENCE_LEASE_SECONDS'] = int(os.getenv('INFERENCE_LEASE_SECONDS', 600))
+
+# Micro-batching: group up to N concurrent images or wait at most T ms per batch
+app.config['INFERENCE_BATCHING'] = os.getenv('INFERENCE_BATCHING', 'False').lower() == 'true'
+app.config['INFERENCE_MAX_BATCH_SIZE'] = int(os.getenv('INFERENCE_MAX_BATCH_SIZE', 8))
+app.config['INFERENCE_MAX_WAIT_MS'] = float(os.getenv('INFERENCE_MAX_WAIT_MS', 20))
+
+# Shared model server: one local process (see `flask model-server`) holds the
+# model and MODEL_SERVER_THREADS cores instead of a copy in every worker;
+# images reach it through shared memory, boxes come back over the socket.
+# With autostart the first worker that finds it missing (or crashed) spawns it
+app.config['MODEL_SERVER'] = os.getenv('MODEL_SERVER', 'False').lower() == 'true'
+app.config['MODEL_SERVER_SOCKET'] = os.getenv('MODEL_SERVER_SOCKET', os.path.join(app.instance_path, 'model-server.sock'))
+app.config['MODEL_SERVER_AUTOSTART'] = os.getenv('MODEL_SERVER_AUTOSTART', 'True').lower() == 'true'
+app.config['MODEL_SERVER_TIMEOUT'] = float(os.getenv('MODEL_SERVER_TIMEOUT', 30))
+app.config['MODEL_SERVER_START_TIMEOUT'] = float(os.getenv('MODEL_SERVER_START_TIMEOUT', 120))
+app.config['MODEL_SERVER_THREADS'] = int(os.getenv('MODEL_SERVER_THREADS', 0)) or None
+
+# Detection confidence threshold and size of the content-hash result cache
+app.config['DETECTION_THRESHOLD'] = float(os.getenv('DETECTION_THRESHOLD', 0.25))
+app.config['DETECTION_CACHE_MAX_ENTRIES'] = int(os.getenv('DETECTION_CACHE_MAX_ENTRIES', 10000))
+# Boxes down to this confidence are stored so results can be re-thresholded later
+app.config['DETECTION_STORE_MIN_CONFIDENCE'] = float(os.getenv('DETECTION_STORE_MIN_CONFIDENCE', 0.1))
+# Post-processing (see postprocess.py): per-class thresholds overriding
+# DETECTION_THRESHOLD, e.g. "foreign_object=0.4,other=0.6" (class names or
+# ids), extra class-aware NMS IoU (0 = off) and the most boxes kept per image
+app.config['DETECTION_CLASS_THRESHOLDS'] = os.getenv('DETECTION_CLASS_THRESHOLDS', '')
+app.config['DETECTION_NMS_IOU'] = float(os.getenv('DETECTION_NMS_IOU', 0))
+app.config['DETECTION_MAX_BOXES'] = int(os.getenv('DETECTION_MAX_BOXES', 300))
+
+# Full-history reports are built in the background and kept for download
+app.config['REPORT_FOLDER'] = os.getenv('REPORT_FOLDER', os.path.join(app.instance_path, 'reports'))
+app.config['REPORT_CHUNK_SIZE'] = int(os.getenv('REPORT_CHUNK_SIZE', 200))
+app.config['REPORT_RETENTION_HOURS'] = int(os.getenv('REPORT_RETENTION_HOURS', 24))
+# Seconds after which a report still running is taken to be lost with its worker
+app.config['REPORT_JOB_TIMEOUT'] = int(os.getenv('REPORT_JOB_TIMEOUT', 1800))
+os.makedirs(app.config['REPORT_FOLDER'], exist_ok=True)
+
+# Thumbnail / preview cache used by the history page and the PDF reports
+app.config['DERIVATIVE_FOLDER'] = os.getenv('DERIVATIVE_FOLDER', os.path.join(BASE_DIR, 'static/derivatives'))
+app.config['DERIVATIVE_CACHE_MAX_MB'] = int(os.getenv('DERIVATIVE_CACHE_MAX_MB', 512))
+app.config['DERIVATIVE_MAX_AGE'] = int(os.getenv('DERIVATIVE_MAX_AGE', 3600))
+# Set STORE_PROCESSED_IMAGES=false to draw overlays on request instead of writing processed_*.jpg
+app.config['STORE_PROCESSED_IMAGES'] = os.getenv('STORE_PROCESSED_IMAGES', 'True').lower() == 'true'
+app.config['OVERLAY_CACHE_MAX_MB'] = int(os.getenv('OVERLAY_CACHE_MAX_MB', 64))
+app.config['DERIVATIVES_AT_INGEST'] = os.getenv('DERIVATIVES_AT_INGEST', 'True').lower() == 'true'
+os.makedirs(app.config['DERIVATIVE_FOLDER'], exist_ok=True)
+
+# Image delivery: x-accel (nginx X-Accel-Redirect) or x-sendfile (Apache, lighttpd)
+# leaves sending the file to the front proxy; files under IMAGE_ACCEL_ROOT are
+# mapped to the internal IMAGE_ACCEL_PREFIX location
+app.config['IMAGE_SENDFILE'] = os.getenv('IMAGE_SENDFILE', '').lower()
+app.config['USE_X_SENDFILE'] = app.config['IMAGE_SENDFILE'] == 'x-sendfile'
+app.config['IMAGE_ACCEL_ROOT'] = os.getenv('IMAGE_ACCEL_ROOT', os.path.join(BASE_DIR, 'static'))
+app.config['IMAGE_ACCEL_PREFIX'] = os.getenv('IMAGE_ACCEL_PREFIX', '/protected/')
+
+# Blob storage for originals and processed images: local (hash-sharded folders
+# under UPLOAD_FOLDER) or s3 (any S3-compatible service, e.g. MinIO via
+# STORAGE_S3_ENDPOINT_URL; credentials from the usual AWS_* variables)
+app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', 'local').lower()
+app.config['STORAGE_S3_BUCKET'] = os.getenv('STORAGE_S3_BUCKET')
+app.config['STORAGE_S3_PREFIX'] = os.getenv('STORAGE_S3_PREFIX', '')
+app.config['STORAGE_S3_ENDPOINT_URL'] = os.getenv('STORAGE_S3_ENDPOINT_URL')
+app.config['STORAGE_S3_REGION'] = os.getenv('STORAGE_S3_REGION')
+app.config['STORAGE_S3_MULTIPART_THRESHOLD_MB'] = int(os.getenv('STORAGE_S3_MULTIPART_THRESHOLD_MB', 8))
+app.config['STORAGE_S3_MULTIPART_CHUNK_MB'] = int(os.getenv('STORAGE_S3_MULTIPART_CHUNK_MB', 8))
+app.config['STORAGE_S3_MAX_CONCURRENCY'] = int(os.getenv('STORAGE_S3_MAX_CONCURRENCY', 4))
+# Local copies of S3 objects for code that needs a file on disk, kept apart
+# from the derivatives and evicted by their own size limit
+app.config['STORAGE_S3_CACHE_FOLDER'] = os.getenv('STORAGE_S3_CACHE_FOLDER', os.path.join(app.instance_path, 's3-cache'))
+app.config['STORAGE_S3_CACHE_MAX_MB'] = int(os.getenv('STORAGE_S3_CACHE_MAX_MB', 2048))
+
+# Batch / ZIP ingestion limits
+app.config['BATCH_MAX_CONTENT_LENGTH'] = int(os.getenv('BATCH_MAX_CONTENT_LENGTH_MB', 512)) * 1024 * 1024
+app.config['BATCH_WORKERS'] = int(os.getenv('BATCH_WORKERS', 4))
+
+# Rescoring stored uploads with a new model: rows per checkpointed chunk, images
+# read ahead, niceness of the rescore workers and whether to pause for live uploads
+app.config['RESCORE_CHUNK_SIZE'] = int(os.getenv('RESCORE_CHUNK_SIZE', 100))
+app.config['RESCORE_PREFETCH'] = int(os.getenv('RESCORE_PREFETCH', 16))
+app.config['RESCORE_NICE'] = int(os.getenv('RESCORE_NICE', 10))
+app.config['RESCORE_YIELD_TO_LIVE'] = os.getenv('RESCORE_YIELD_TO_LIVE', 'True').lower() == 'true'
+
+# History page size and how long filtered result counts are cached (seconds)
+app.config['HISTORY_PAGE_SIZE'] = int(os.getenv('HISTORY_PAGE_SIZE', 10))
+app.config['HISTORY_COUNT_TTL'] = int(os.getenv('HISTORY_COUNT_TTL', 30))
+
+# Longest a POST /api/v1/detections?wait=N request may hold for its result (seconds)
+app.config['API_MAX_WAIT'] = float(os.getenv('API_MAX_WAIT', 30))
+
+# Admission control for the endpoints that run or queue inference (/upload,
+# /upload_batch, POST /api/v1/detections): at most
+# ADMISSION_MAX_CONCURRENT_PER_WORKER of them in each worker process (default:
+# gunicorn threads minus the reserved ones, which stay free for history,
+# results and images), 503 once ADMISSION_MAX_QUEUE uploads wait for detection
+# in total (0 = no limit) and 429 above RATE_LIMIT_PER_MINUTE requests per
+# admin across all workers (0 = no limit)
+app.config['ADMISSION_CONTROL'] = os.getenv('ADMISSION_CONTROL', 'True').lower() == 'true'
+app.config['ADMISSION_MAX_CONCURRENT_PER_WORKER'] = int(os.getenv('ADMISSION_MAX_CONCURRENT_PER_WORKER', 0)) or None
+app.config['ADMISSION_RESERVED_THREADS'] = int(os.getenv('ADMISSION_RESERVED_THREADS', 1))
+app.config['ADMISSION_MAX_QUEUE'] = int(os.getenv('ADMISSION_MAX_QUEUE', 100))
+app.config['ADMISSION_MAX_RETRY_AFTER'] = int(os.getenv('ADMISSION_MAX_RETRY_AFTER', 60))
+app.config['RATE_LIMIT_PER_MINUTE'] = float(os.getenv('RATE_LIMIT_PER_MINUTE', 0))
+app.config['RATE_LIMIT_BURST'] = int(os.getenv('RATE_LIMIT_BURST', 10))
+
+# Audit log: buffer entries and write them in bulk every AUDIT_FLUSH_INTERVAL
+# seconds or AUDIT_BATCH_SIZE entries (AUDIT_BUFFERED=false writes each one at once)
+app.config['AUDIT_BUFFERED'] = os.getenv('AUDIT_BUFFERED', 'True').lower() == 'true'
+app.config['AUDIT_BATCH_SIZE'] = int(os.getenv('AUDIT_BATCH_SIZE', 100))
+app.config['AUDIT_FLUSH_INTERVAL'] = float(os.getenv('AUDIT_FLUSH_INTERVAL', 1.0))
+# Flushes an entry may fail before it is dropped (and printed to the log)
+app.config['AUDIT_MAX_ATTEMPTS'] = int(os.getenv('AUDIT_MAX_ATTEMPTS', 5))
+
+# Metrics: /metrics in Prometheus text format (requires a bearer METRICS_TOKEN when set),
+# per-request stage timings in a Server-Timing header and/or printed for slow requests
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+app.config['SERVER_TIMING'] = os.getenv('SERVER_TIMING', 'False').lower() == 'true'
+app.config['REQUEST_TIMING_LOG'] = os.getenv('REQUEST_TIMING_LOG', 'False').lower() == 'true'
+app.config['REQUEST_TIMING_LOG_MIN_MS'] = float(os.getenv('REQUEST_TIMING_LOG_MIN_MS', 0))
+
+# Run schema migrations at startup; disable to run `flask db-upgrade` in deploys
+app.config['DB_AUTO_MIGRATE'] = os.getenv('DB_AUTO_MIGRATE', 'True').lower() == 'true'
+
+# Initialize database with SQLAlchemy (DATABASE_URL, pool sizing: see database.py)
 init_db(app)
 
+# Blob storage backend for uploaded and processed images
+storage.init_app(app)
+
+# Wire up the inference job queue and the micro-batcher
+inference_queue.init_app(app, process_upload)
+inference_batcher.init_app(app, predict_batch)
+
+# Limits and rate limits for the inference endpoints
+admission.init_app(app)
+
+# Buffered audit log writer, flushed in bulk and at exit
+audit_log.init_app(app)
+
+# Request counters, latency histograms and Server-Timing
+request_metrics.init_app(app)
+
+# Load the model before serving. Under gunicorn (see gunicorn.conf.py) this
+# runs once in the master with preload_app, and each forked worker only does
+# its own warm-up inference in post_fork
+if app.config['MODEL_PRELOAD'] and not inference_queue.external:
+    with app.app_context():
+        preload_model()
+    if not os.getenv('MODEL_WARMUP_ON_FORK'):
+        start_warm_up(app)
+
 # Register blueprints
 app.register_blueprint(auth_bp)
 app.register_blueprint(detection_bp)
 app.register_blueprint(report_bp)
+app.register_blueprint(bulk_bp)
+app.register_blueprint(audit_bp)
+app.register_blueprint(api_bp)
+app.register_blueprint(rescore_bp)
 
 # Register CLI commands
 register_cli_commands(app)
+app.cli.add_command(db_upgrade_command)
+app.cli.add_command(ingest_command)
+app.cli.add_command(dedupe_uploads_command)
+app.cli.add_command(purge_processed_command)
+app.cli.add_command(migrate_storage_command)
+app.cli.add_command(export_model_command)
+app.cli.add_command(check_backend_command)
+app.cli.add_command(export_audit_log_command)
+app.cli.add_command(create_token_command)
+app.cli.add_command(revoke_token_command)
+app.cli.add_command(rescore_command)
+app.cli.add_command(inference_worker_command)
+app.cli.add_command(model_server_command)
 
 @app.route('/')
 def index():
@@ -35,6 +258,49 @@ def index():
         return redirect(url_for('auth.login'))
     return render_template('index.html')
 
+@app.route('/ready')
+def ready():
+    """Readiness probe: 503 until the model is loaded and warmed up"""
+    status = get_model_status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    """Counters, gauges and latency histograms of this process for Prometheus"""
+    token = app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+
+    queue = inference_queue.stats()
+    cache = overlay_cache.stats()
+    gauges = [
+        ('xray_uploads_pending', 'Uploads waiting for detection (all workers)',
+         Upload.query.filter_by(status='pending').count()),
+        ('xray_uploads_running', 'Uploads being detected (all workers)',
+         Upload.query.filter_by(status='running').count()),
+        ('xray_inference_queue_depth', 'Jobs queued in this process', queue['queue_depth']),
+        ('xray_inference_active', 'Jobs running in this process', queue['active']),
+        ('xray_admission_active', 'Inference requests being handled in this process', admission.active),
+        ('xray_model_ready', '1 once the model is loaded and warmed up', int(get_model_status()['ready'])),
+        ('xray_overlay_cache_bytes', 'Bytes held by the overlay cache', cache['bytes']),
+        ('xray_audit_log_pending', 'Audit entries waiting to be written', audit_log.pending())
+    ]
+    families = [counter.family() for counter in COUNTERS]
+    families += [(name, 'gauge', help_text, [({}, value)]) for name, help_text, value in gauges]
+    families += [
+        ('xray_inference_seconds', 'histogram', 'Model forward pass time', [({}, inference_seconds)]),
+        ('xray_inference_batch_size', 'histogram', 'Images per forward pass', [({}, inference_batcher.batch_size)]),
+        ('xray_queue_wait_seconds', 'histogram', 'Time uploads waited for a worker', [({}, inference_queue.wait_time)]),
+        ('xray_queue_run_seconds', 'histogram', 'Time spent processing an upload', [({}, inference_queue.run_time)]),
+        histogram_family('xray_pipeline_stage_seconds', 'Detection and report pipeline stages',
+                         stage_histograms, ('stage',)),
+        histogram_family('xray_http_request_seconds', 'Request latency by endpoint',
+                         request_histograms, ('endpoint',)),
+        histogram_family('xray_http_request_stage_seconds', 'Timed spans inside requests',
+                         request_stage_histograms, ('endpoint', 'stage'))
+    ]
+    return Response(prometheus_text(families), mimetype='text/plain; version=0.0.4')
+
 @app.errorhandler(404)
 def not_found(e):
     return render_template('404.html'), 404
@@ -44,4 +310,7 @@ def server_error(e):
     return render_template('500.html'), 500
 
 if __name__ == "__main__":
+    requeue_report_jobs(app)
+    if not inference_queue.external:
+        requeue_stranded_uploads(app)
     app.run(debug=os.getenv('FLASK_DEBUG', 'False').lower() == 'true')
@@ -0,0 +1,221 @@
+from flask import Blueprint, Response, request, stream_with_context, current_app, session, flash, redirect, url_for
+from sqlalchemy import insert
+from functools import wraps
+from datetime import datetime, timedelta
+import atexit
+import click
+import csv
+import io
+import os
+import threading
+from database import db, Admin, Log
+
+audit_bp = Blueprint('audit', __name__)
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('admin_logged_in'):
+            flash("Please log in to access this page.", "warning")
+            return redirect(url_for('auth.login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+class AuditLogWriter:
+    """Buffers audit Log entries and writes them to the database in bulk.
+
+    Entries are flushed from a background thread every AUDIT_FLUSH_INTERVAL
+    seconds or as soon as AUDIT_BATCH_SIZE entries are waiting, so a request
+    no longer pays for a second commit just to record what it did. Whatever
+    is still buffered is flushed when the process exits. When a batch fails
+    its entries are written one at a time, and an entry that still fails
+    AUDIT_MAX_ATTEMPTS flushes in a row is dropped and printed to the log.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = True
+        self.batch_size = 100
+        self.flush_interval = 1.0
+        self.max_attempts = 5
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.flushed = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('AUDIT_BUFFERED', True)
+        self.batch_size = max(1, app.config.get('AUDIT_BATCH_SIZE', 100))
+        self.flush_interval = app.config.get('AUDIT_FLUSH_INTERVAL', 1.0)
+        self.max_attempts = max(1, app.config.get('AUDIT_MAX_ATTEMPTS', 5))
+        atexit.register(self.flush)
+
+    def _ensure_started(self):
+        # Started lazily (and again after a fork) so each worker owns its thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+            self._thread.start()
+
+    def record(self, admin_id, action, details=None):
+        """Queue one audit entry; it is timestamped now, not when it is written"""
+        entry = {"admin_id": admin_id, "action": action, "details": details, "timestamp": datetime.now()}
+        if not self.enabled or self.app is None:
+            self._write([entry])
+            return
+        self._ensure_started()
+        with self._lock:
+            self._buffer.append(entry)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every buffered entry in one INSERT; returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                entries, self._buffer = self._buffer, []
+            if not entries:
+                return 0
+            if self.app is not None:
+                with self.app.app_context():
+                    written, failed = self._write_batch(entries)
+            else:
+                written, failed = self._write_batch(entries)
+
+            # Keep failed entries for the next flush, but not forever
+            retry = []
+            for entry in failed:
+                entry['attempts'] = entry.get('attempts', 0) + 1
+                if entry['attempts'] < self.max_attempts:
+                    retry.append(entry)
+                    continue
+                self.dropped += 1
+                print(f"Dropping audit log entry after {entry['attempts']} failed writes: "
+                      f"admin_id={entry['admin_id']} action={entry['action']!r} details={entry['details']!r} "
+                      f"timestamp={entry['timestamp'].isoformat()}")
+            if retry:
+                with self._lock:
+                    self._buffer[:0] = retry
+            self.flushed += written
+            return written
+
+    def _write_batch(self, entries):
+        """One INSERT for the batch, or one per entry if that fails; returns (written, failed entries)"""
+        try:
+            self._write(entries)
+            return len(entries), []
+        except Exception as e:
+            self.failed_flushes += 1
+            print(f"Error writing {len(entries)} audit log entries: {e}")
+            if len(entries) == 1:
+                return 0, entries
+        # A single bad entry must not hold back the rest of the batch
+        failed = []
+        for entry in entries:
+            try:
+                self._write([entry])
+            except Exception:
+                failed.append(entry)
+        return len(entries) - len(failed), failed
+
+    def _write(self, entries):
+        rows = [{key: value for key, value in entry.items() if key != 'attempts'} for entry in entries]
+        # Its own connection, so a flush never commits a request's pending changes
+        with db.engine.begin() as conn:
+            conn.execute(insert(Log), rows)
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+audit_log = AuditLogWriter()
+
+def log_action(admin_id, action, details=None):
+    """Record an admin action in the audit log"""
+    audit_log.record(admin_id, action, details)
+
+def audit_log_query(start_date=None, end_date=None, action=None):
+    """Log entries joined with the admin name, oldest first"""
+    query = db.session.query(Log.id, Log.timestamp, Admin.username, Log.action, Log.details) \
+        .outerjoin(Admin, Admin.id == Log.admin_id)
+    if start_date:
+        query = query.filter(Log.timestamp >= start_date)
+    if end_date:
+        query = query.filter(Log.timestamp < end_date + timedelta(days=1))
+    if action:
+        query = query.filter(Log.action == action)
+    return query.order_by(Log.timestamp.asc(), Log.id.asc())
+
+def iter_audit_csv(query, chunk_size=1000):
+    """Yield the audit log as CSV text, one chunk of rows at a time"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["id", "timestamp", "admin", "action", "details"])
+    for i, row in enumerate(query.yield_per(chunk_size), 1):
+        writer.writerow([row.id, row.timestamp.isoformat() if row.timestamp else '', row.username or '',
+                         row.action, row.details or ''])
+        if i % chunk_size == 0:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+def parse_export_args(args):
+    """Read start_date/end_date (YYYY-MM-DD) and action from request args"""
+    dates = {}
+    for key in ('start_date', 'end_date'):
+        value = (args.get(key) or '').strip()
+        dates[key] = datetime.strptime(value, "%Y-%m-%d") if value else None
+    return dates['start_date'], dates['end_date'], (args.get('action') or '').strip() or None
+
+@audit_bp.route('/audit_log.csv')
+@login_required
+def export_audit_log():
+    """Stream the audit log as CSV without loading it into memory"""
+    try:
+        start_date, end_date, action = parse_export_args(request.args)
+    except ValueError:
+        return "Dates must use the YYYY-MM-DD format.", 400
+
+    # Make sure entries recorded just before the export are included
+    audit_log.flush()
+    query = audit_log_query(start_date, end_date, action)
+    chunk_size = current_app.config.get('AUDIT_EXPORT_CHUNK_SIZE', 1000)
+    filename = f"audit_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    return Response(stream_with_context(iter_audit_csv(query, chunk_size)),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+# Flask CLI command for compliance exports of the audit log
+@click.command("export-audit-log")
+@click.option("--output", "-o", type=click.File('w'), default='-', help="CSV file to write (default: stdout).")
+@click.option("--start-date", default=None, help="First day to include (YYYY-MM-DD).")
+@click.option("--end-date", default=None, help="Last day to include (YYYY-MM-DD).")
+@click.option("--action", default=None, help="Only export this action.")
+def export_audit_log_command(output, start_date, end_date, action):
+    """Write the audit log as CSV."""
+    try:
+        start_date, end_date, action = parse_export_args(
+            {'start_date': start_date, 'end_date': end_date, 'action': action})
+    except ValueError:
+        raise click.BadParameter("Dates must use the YYYY-MM-DD format.")
+    audit_log.flush()
+    for chunk in iter_audit_csv(audit_log_query(start_date, end_date, action)):
+        output.write(chunk)
@@ -1,6 +1,6 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from werkzeug.security import generate_password_hash, check_password_hash
-from database import db, Admin, log_action  # Import SQLAlchemy db and models
+from database import db, Admin  # Import SQLAlchemy db and models
 from functools import wraps
 from datetime import datetime
 import click
@@ -0,0 +1,350 @@
+from flask import current_app
+import ast
+import click
+import itertools
+import os
+import time
+import numpy as np
+
+# Letterbox padding colour used by ultralytics during preprocessing
+PAD_COLOR = (114, 114, 114)
+
+class Boxes:
+    """Minimal stand-in for ultralytics Boxes backed by NumPy arrays.
+
+    Iterating yields one single-row Boxes per detection, so code written
+    against ultralytics (box.xyxy[0], box.conf[0], box.cls[0]) keeps working.
+    """
+
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        self.conf = np.asarray(conf, dtype=np.float32).reshape(-1)
+        self.cls = np.asarray(cls, dtype=np.float32).reshape(-1)
+
+    def __len__(self):
+        return len(self.conf)
+
+    def __iter__(self):
+        for i in range(len(self.conf)):
+            yield Boxes(self.xyxy[i:i + 1], self.conf[i:i + 1], self.cls[i:i + 1])
+
+class Result:
+    """Minimal stand-in for ultralytics Results with just the detection boxes"""
+
+    def __init__(self, boxes, names, orig_shape):
+        self.boxes = boxes
+        self.names = names
+        self.orig_shape = orig_shape
+
+def allow_detection_model():
+    """Allowlist the YOLO DetectionModel class for torch's safe deserialization"""
+    import torch
+    from ultralytics.nn.tasks import DetectionModel
+    if hasattr(torch.serialization, '_default_safe_globals'):
+        torch.serialization._default_safe_globals["ultralytics.nn.tasks.DetectionModel"] = DetectionModel
+
+class TorchBackend:
+    """PyTorch eager inference through ultralytics (the original behaviour)"""
+    name = 'torch'
+    # Weight tensors can be loaded in the gunicorn master and shared copy-on-write
+    preload_before_fork = True
+
+    def __init__(self, config):
+        from ultralytics import YOLO
+        allow_detection_model()
+        self.weights_path = self.weights_file(config)
+        self.model = YOLO(self.weights_path)
+        self.names = self.model.names
+
+    @classmethod
+    def weights_file(cls, config):
+        """File the model version is hashed from, found without loading the model"""
+        return config['MODEL_PATH']
+
+    def predict(self, source, **kwargs):
+        return self.model.predict(source=source, **kwargs)
+
+class OpenVINOBackend(TorchBackend):
+    """OpenVINO IR exported by ultralytics, optionally INT8 quantized"""
+    name = 'openvino'
+    preload_before_fork = False
+
+    def __init__(self, config):
+        from ultralytics import YOLO
+        self.weights_path = self.weights_file(config)
+        self.model = YOLO(self.model_dir(config), task='detect')
+        self.names = self.model.names
+
+    @staticmethod
+    def model_dir(config):
+        return config.get('OPENVINO_MODEL_PATH') or default_export_path(config['MODEL_PATH'], 'openvino')
+
+    @classmethod
+    def weights_file(cls, config):
+        model_dir = cls.model_dir(config)
+        if not os.path.isdir(model_dir):
+            return model_dir
+        return next((os.path.join(model_dir, name) for name in sorted(os.listdir(model_dir))
+                     if name.endswith('.bin')), model_dir)
+
+class OnnxBackend:
+    """ONNX Runtime inference with its own pre/post-processing.
+
+    Runs without torch or ultralytics and lets us size the intra-op thread
+    pool explicitly, which the ultralytics ONNX loader does not expose.
+    """
+    name = 'onnx'
+    # ONNX Runtime thread pools do not survive fork, so build the session per worker
+    preload_before_fork = False
+
+    def __init__(self, config):
+        import onnxruntime as ort
+        self.weights_path = self.weights_file(config)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        threads = config.get('ONNX_INTRA_OP_THREADS') or config.get('TORCH_THREADS')
+        if threads:
+            options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(self.weights_path, options, providers=['CPUExecutionProvider'])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        height = model_input.shape[2]
+        self.imgsz = height if isinstance(height, int) else config.get('MODEL_IMGSZ', 640)
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+
+        # ultralytics stores the class names in the ONNX metadata
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata['names']) if 'names' in metadata else {}
+
+    @classmethod
+    def weights_file(cls, config):
+        return config.get('ONNX_MODEL_PATH') or default_export_path(config['MODEL_PATH'], 'onnx')
+
+    def _letterbox(self, image):
+        import cv2
+        height, width = image.shape[:2]
+        ratio = min(self.imgsz / height, self.imgsz / width)
+        new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+        pad_x, pad_y = (self.imgsz - new_width) / 2, (self.imgsz - new_height) / 2
+
+        resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+        top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+        left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+        padded = cv2.copyMakeBorder(resized, top, bottom, left, right, cv2.BORDER_CONSTANT, value=PAD_COLOR)
+
+        # BGR HWC uint8 -> RGB CHW float32 in [0, 1]
+        tensor = np.ascontiguousarray(padded[:, :, ::-1].transpose(2, 0, 1), dtype=np.float32) / 255.0
+        return tensor, ratio, (left, top)
+
+    def _postprocess(self, prediction, ratio, pad, orig_shape, conf, iou, max_det):
+        import cv2
+        # (4 + num_classes, anchors) -> (anchors, 4 + num_classes)
+        prediction = prediction.T
+        scores = prediction[:, 4:]
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+        keep = confidences > conf
+        boxes, confidences, class_ids = prediction[keep, :4], confidences[keep], class_ids[keep]
+        if not len(confidences):
+            return Boxes(np.zeros((0, 4)), [], [])
+
+        # Class-aware NMS on xywh boxes shifted apart per class
+        xywh = boxes.copy()
+        xywh[:, 0] -= xywh[:, 2] / 2
+        xywh[:, 1] -= xywh[:, 3] / 2
+        offsets = class_ids[:, None].astype(np.float32) * 7680
+        shifted = xywh.copy()
+        shifted[:, :2] += offsets
+        indices = cv2.dnn.NMSBoxes(shifted.tolist(), confidences.tolist(), conf, iou)
+        indices = np.asarray(indices, dtype=int).reshape(-1)[:max_det]
+
+        # Undo the letterbox and clip to the original image
+        xyxy = xywh[indices].copy()
+        xyxy[:, 2] += xyxy[:, 0]
+        xyxy[:, 3] += xyxy[:, 1]
+        xyxy[:, [0, 2]] = (xyxy[:, [0, 2]] - pad[0]) / ratio
+        xyxy[:, [1, 3]] = (xyxy[:, [1, 3]] - pad[1]) / ratio
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, orig_shape[1])
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, orig_shape[0])
+        return Boxes(xyxy, confidences[indices], class_ids[indices])
+
+    def predict(self, source, conf=0.25, iou=0.7, max_det=300, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        prepared = [self._letterbox(image) for image in images]
+        tensors = [tensor for tensor, _, _ in prepared]
+
+        # One session run for the whole batch when the model allows it
+        if self.dynamic_batch:
+            outputs = self.session.run(None, {self.input_name: np.stack(tensors)})[0]
+        else:
+            outputs = np.concatenate([self.session.run(None, {self.input_name: tensor[None]})[0]
+                                      for tensor in tensors])
+
+        results = []
+        for image, (_, ratio, pad), prediction in zip(images, prepared, outputs):
+            boxes = self._postprocess(prediction, ratio, pad, image.shape[:2], conf, iou, max_det)
+            results.append(Result(boxes, self.names, image.shape[:2]))
+        return results
+
+BACKENDS = {
+    'torch': TorchBackend,
+    'onnx': OnnxBackend,
+    'openvino': OpenVINOBackend
+}
+
+def register_backend(name, backend_class):
+    """Make an extra backend selectable through INFERENCE_BACKEND"""
+    BACKENDS[name] = backend_class
+
+def get_backend_class(config):
+    name = config.get('INFERENCE_BACKEND', 'torch')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]
+
+def create_backend(config, name=None):
+    if name:
+        config = dict(config, INFERENCE_BACKEND=name)
+    return get_backend_class(config)(config)
+
+def default_export_path(model_path, export_format, int8=False):
+    """Where ultralytics (and our INT8 step) put exported models next to the .pt"""
+    stem = os.path.splitext(model_path)[0]
+    if export_format == 'onnx':
+        return f"{stem}_int8.onnx" if int8 else f"{stem}.onnx"
+    return f"{stem}_int8_openvino_model" if int8 else f"{stem}_openvino_model"
+
+def export_model(model_path, export_format, int8=False, imgsz=640):
+    """Export the PyTorch weights to ONNX or OpenVINO and return the new path"""
+    from ultralytics import YOLO
+    model = YOLO(model_path)
+
+    if export_format == 'openvino':
+        exported = model.export(format='openvino', imgsz=imgsz, int8=int8)
+        target = default_export_path(model_path, 'openvino', int8)
+        if os.path.abspath(exported) != os.path.abspath(target):
+            os.replace(exported, target)
+        return target
+
+    # Dynamic batch axis so the micro-batcher can send several images at once
+    exported = model.export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+    if not int8:
+        return exported
+
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    target = default_export_path(model_path, 'onnx', int8=True)
+    quantize_dynamic(exported, target, weight_type=QuantType.QUInt8)
+    return target
+
+def box_iou(a, b):
+    """Pairwise IoU between two (N, 4) and (M, 4) xyxy arrays"""
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return intersection / (area_a[:, None] + area_b[None, :] - intersection + 1e-9)
+
+def match_detections(reference, candidate, iou_threshold=0.5):
+    """Greedily match candidate boxes to reference boxes of the same class.
+
+    Returns (matched, confidence differences of the matched pairs).
+    """
+    if not len(reference) or not len(candidate):
+        return 0, []
+    ious = box_iou(reference.xyxy, candidate.xyxy)
+    ious[reference.cls[:, None] != candidate.cls[None, :]] = 0
+    matched, differences, used = 0, [], set()
+    for i in np.argsort(-reference.conf):
+        order = [j for j in np.argsort(-ious[i]) if j not in used and ious[i, j] >= iou_threshold]
+        if order:
+            used.add(order[0])
+            matched += 1
+            differences.append(abs(float(reference.conf[i]) - float(candidate.conf[order[0]])))
+    return matched, differences
+
+def as_numpy_boxes(boxes):
+    """Convert ultralytics (torch) Boxes into NumPy-backed Boxes"""
+    if isinstance(boxes, Boxes):
+        return boxes
+    def to_numpy(values):
+        return values.cpu().numpy() if hasattr(values, 'cpu') else np.asarray(values)
+    return Boxes(to_numpy(boxes.xyxy), to_numpy(boxes.conf), to_numpy(boxes.cls))
+
+# Flask CLI command to export the weights for the faster CPU backends
+@click.command("export-model")
+@click.option("--format", "export_format", type=click.Choice(['onnx', 'openvino']), default='onnx')
+@click.option("--int8", is_flag=True, help="Quantize weights to INT8.")
+@click.option("--imgsz", default=640, help="Model input size.")
+def export_model_command(export_format, int8, imgsz):
+    """Export best.pt to ONNX or OpenVINO for the optimized CPU backends."""
+    path = export_model(current_app.config['MODEL_PATH'], export_format, int8, imgsz)
+    click.echo(f"Exported {export_format}{' INT8' if int8 else ''} model to {path}")
+
+def sample_images(folder, limit):
+    """Up to limit images directly in folder, leaving out stored processed_* files"""
+    return [os.path.join(folder, file_name) for file_name in sorted(os.listdir(folder))
+            if file_name.lower().endswith(('.jpg', '.jpeg', '.png')) and not file_name.startswith('processed_')][:limit]
+
+# Flask CLI command comparing a backend against PyTorch on stored uploads
+@click.command("check-backend")
+@click.option("--backend", "name", default=None, help="Backend to check (default: INFERENCE_BACKEND).")
+@click.option("--images", "image_dir", default=None, type=click.Path(exists=True, file_okay=False),
+              help="Folder of sample images (default: stored uploads).")
+@click.option("--limit", default=50, help="Maximum number of images to compare.")
+@click.option("--iou", default=0.5, help="IoU needed for two boxes to count as the same detection.")
+@click.option("--min-recall", default=0.95, help="Fail if fewer PyTorch detections are reproduced.")
+def check_backend_command(name, image_dir, limit, iou, min_recall):
+    """Compare detections of a backend with the PyTorch backend."""
+    import cv2
+    config = current_app.config
+    name = name or config.get('INFERENCE_BACKEND', 'torch')
+    threshold = config.get('DETECTION_THRESHOLD', 0.25)
+    if image_dir:
+        paths = sample_images(image_dir, limit)
+    else:
+        from storage import storage
+        keys = itertools.islice(storage.iter_keys('originals/'), limit)
+        paths = [path for path in map(storage.local_path, keys) if path]
+        if not paths and os.path.isdir(config['UPLOAD_FOLDER']):
+            # Uploads stored flat, before dedupe-uploads or migrate-storage ran
+            paths = sample_images(config['UPLOAD_FOLDER'], limit)
+    if not paths:
+        raise click.ClickException(f"No sample images found in {image_dir or 'storage'}")
+
+    reference_backend = create_backend(config, 'torch')
+    candidate_backend = create_backend(config, name)
+    compared = reference_total = candidate_total = matched_total = 0
+    differences, timings = [], {'torch': 0.0, name: 0.0}
+
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        compared += 1
+        outputs = {}
+        for label, backend in (('torch', reference_backend), (name, candidate_backend)):
+            started = time.perf_counter()
+            outputs[label] = as_numpy_boxes(backend.predict(source=image, conf=threshold, verbose=False)[0].boxes)
+            timings[label] += time.perf_counter() - started
+
+        matched, diffs = match_detections(outputs['torch'], outputs[name], iou)
+        reference_total += len(outputs['torch'])
+        candidate_total += len(outputs[name])
+        matched_total += matched
+        differences.extend(diffs)
+
+    if not compared:
+        raise click.ClickException(f"None of the {len(paths)} sample images could be read")
+    recall = matched_total / reference_total if reference_total else 1.0
+    precision = matched_total / candidate_total if candidate_total else 1.0
+    click.echo(f"Images: {compared}  torch boxes: {reference_total}  {name} boxes: {candidate_total}  matched: {matched_total}")
+    click.echo(f"Recall vs torch: {recall:.3f}  precision vs torch: {precision:.3f}  "
+               f"mean |conf diff|: {np.mean(differences) if differences else 0.0:.4f}")
+    for label, seconds in timings.items():
+        click.echo(f"{label:>10}: {seconds / compared * 1000:.1f} ms/image")
+    if recall < min_recall:
+        raise click.ClickException(f"Recall {recall:.3f} is below the required {min_recall:.3f}")
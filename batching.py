@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from metrics import Histogram
+
+# Batch size buckets; the upper bound is whatever INFERENCE_MAX_BATCH_SIZE allows
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+class MicroBatcher:
+    """Collects concurrent inference requests and runs them as one model batch.
+
+    Callers block in predict() while a single background thread gathers up
+    to max_batch_size images, or waits at most max_wait_ms after the first
+    one arrives, and hands the whole list to the batch handler.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.handler = None
+        self.enabled = False
+        self.max_batch_size = 8
+        self.max_wait = 0.02
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.latency = Histogram()
+        self.batch_time = Histogram()
+
+    def init_app(self, app, handler):
+        self.app = app
+        self.handler = handler
+        self.enabled = app.config.get('INFERENCE_BATCHING', False)
+        self.max_batch_size = max(1, app.config.get('INFERENCE_MAX_BATCH_SIZE', 8))
+        self.max_wait = max(0, app.config.get('INFERENCE_MAX_WAIT_MS', 20)) / 1000.0
+
+    def _ensure_started(self):
+        if self._thread:
+            return
+        with self._start_lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._loop, name="inference-batcher", daemon=True)
+            self._thread.start()
+
+    def submit(self, image):
+        """Queue one image and return a Future for its own Results"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((image, future, time.monotonic()))
+        return future
+
+    def predict(self, image, timeout=None):
+        return self.submit(image).result(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            images = [image for image, _, _ in batch]
+            started_at = time.monotonic()
+            try:
+                with self.app.app_context():
+                    results = self.handler(images)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"Expected {len(batch)} results, got {len(results)}")
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                finished_at = time.monotonic()
+                self.batch_size.observe(len(batch))
+                self.batch_time.observe(finished_at - started_at)
+
+            for (_, future, submitted_at), result in zip(batch, results):
+                self.latency.observe(finished_at - submitted_at)
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'queue_depth': self._queue.qsize(),
+            'batch_size': self.batch_size.snapshot(),
+            'batch_time_seconds': self.batch_time.snapshot(),
+            'latency_seconds': self.latency.snapshot()
+        }
+
+inference_batcher = MicroBatcher()
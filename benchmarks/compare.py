@@ -0,0 +1,64 @@
+"""Compare two benchmark result files and flag regressions.
+
+    python -m benchmarks.compare benchmarks/results/base.json benchmarks/results/new.json
+
+Exits with status 1 when any scenario's p95 latency or baseline RSS grew, or
+its throughput or recall fell, by more than --threshold (default 15%).
+"""
+import argparse
+import json
+import sys
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def change(old, new):
+    if not old or new is None:
+        return None
+    return (new - old) / old
+
+def compare(base, head, threshold):
+    """Rows of (scenario, metric, old, new, change, regressed) for shared scenarios"""
+    rows = []
+    for name in sorted(set(base['scenarios']) & set(head['scenarios'])):
+        old, new = base['scenarios'][name], head['scenarios'][name]
+        for metric, higher_is_worse in (('p50_ms', True), ('p95_ms', True), ('p99_ms', True),
+                                        ('throughput_rps', False), ('peak_rss_mb', True), ('recall', False),
+                                        ('baseline_rss_mb', True)):
+            if metric not in old and metric not in new:
+                continue
+            delta = change(old.get(metric), new.get(metric))
+            # Gate on p95, throughput, recall and startup RSS; the other columns are informational
+            gated = metric in ('p95_ms', 'throughput_rps', 'recall', 'baseline_rss_mb')
+            worse = delta is not None and (delta > threshold if higher_is_worse else delta < -threshold)
+            rows.append((name, metric, old.get(metric), new.get(metric), delta, gated and worse))
+        if new.get('errors') and not old.get('errors'):
+            rows.append((name, 'errors', old.get('errors'), new.get('errors'), None, True))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('base', help="Results of the reference commit.")
+    parser.add_argument('head', help="Results of the commit under test.")
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help="Relative change treated as a regression (0.15 = 15%%).")
+    args = parser.parse_args(argv)
+
+    base, head = load(args.base), load(args.head)
+    print(f"base {base['meta'].get('commit') or '?'}  ->  head {head['meta'].get('commit') or '?'}")
+    regressions = 0
+    for name, metric, old, new, delta, regressed in compare(base, head, args.threshold):
+        pct = f"{delta:+.1%}" if delta is not None else '   n/a'
+        flag = '  REGRESSION' if regressed else ''
+        print(f"{name:36} {metric:15} {old!s:>10} -> {new!s:<10} {pct:>8}{flag}")
+        regressions += regressed
+
+    missing = set(base['scenarios']) - set(head['scenarios'])
+    if missing:
+        print(f"Scenarios missing from head: {', '.join(sorted(missing))}")
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,464 @@
+"""Benchmark and load test for the upload -> detect -> report path.
+
+Runs the app in-process against a throwaway database and upload folder with
+the stub model, so it needs neither best.pt nor a GPU:
+
+    python -m benchmarks.run --sizes 1,4,8,16 --iterations 10 --concurrency 8
+
+Each scenario reports p50/p95/p99 latency, throughput and peak RSS, and the
+whole run is written as JSON to benchmarks/results/ for benchmarks.compare.
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# --- Measurement helpers ---
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of an unsorted list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is the lifetime peak (KiB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+class RssSampler:
+    """Samples RSS on a background thread and keeps the peak"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+class Scenario:
+    """Latencies and errors for one named scenario"""
+
+    def __init__(self, name, track_rss=True):
+        self.name = name
+        self.track_rss = track_rss
+        self.latencies = []
+        self.errors = 0
+        self.wall_seconds = 0.0
+        self.peak_rss = None
+        # Extra figures reported with the timings, e.g. recall
+        self.extra = {}
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            self.latencies.append(seconds)
+            if not ok:
+                self.errors += 1
+
+    def run(self, fn, iterations, concurrency=1):
+        """Call fn(i) iterations times on concurrency threads; fn returns (seconds, ok)"""
+        sampler = RssSampler() if self.track_rss else None
+        started = time.perf_counter()
+        if sampler:
+            sampler.__enter__()
+        try:
+            if concurrency <= 1:
+                for i in range(iterations):
+                    self.record(*fn(i))
+            else:
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    for seconds, ok in pool.map(fn, range(iterations)):
+                        self.record(seconds, ok)
+        finally:
+            self.wall_seconds += time.perf_counter() - started
+            if sampler:
+                sampler.__exit__(None, None, None)
+                self.peak_rss = max(self.peak_rss or 0, sampler.peak)
+        return self
+
+    def summary(self):
+        ok = len(self.latencies) - self.errors
+        ms = lambda value: round(value * 1000, 2) if value is not None else None
+        return {
+            "count": len(self.latencies),
+            "errors": self.errors,
+            "p50_ms": ms(percentile(self.latencies, 50)),
+            "p95_ms": ms(percentile(self.latencies, 95)),
+            "p99_ms": ms(percentile(self.latencies, 99)),
+            "mean_ms": ms(sum(self.latencies) / len(self.latencies)) if self.latencies else None,
+            "max_ms": ms(max(self.latencies)) if self.latencies else None,
+            "throughput_rps": round(ok / self.wall_seconds, 3) if self.wall_seconds else None,
+            "peak_rss_mb": round(self.peak_rss / 1024 / 1024, 1) if self.peak_rss else None,
+            **self.extra
+        }
+
+def timed(fn):
+    """Run fn() and return (seconds, ok) where ok is fn's truthy result"""
+    started = time.perf_counter()
+    try:
+        ok = bool(fn())
+    except Exception as e:
+        print(f"  request failed: {e}")
+        ok = False
+    return time.perf_counter() - started, ok
+
+def unique_image(image, tag):
+    """Same picture with different bytes, so the content-hash cache never hits"""
+    return image + b'BENCH' + tag.encode() + uuid.uuid4().bytes
+
+# --- In-process app ---
+
+def setup_app(args, workdir):
+    """Import the app against a scratch database, folders and the stub model"""
+    sys.path.insert(0, REPO_DIR)
+    from benchmarks.stub import install_stub_backend
+    weights_path = install_stub_backend(args.stub_ms / 1000)
+
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'INFERENCE_BACKEND': 'stub',
+        'MODEL_PATH': weights_path,
+        'REPORT_FOLDER': os.path.join(workdir, 'reports'),
+        'DERIVATIVE_FOLDER': os.path.join(workdir, 'derivatives'),
+        'SECRET_KEY': 'benchmark'
+    })
+    from app import app
+    app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Point the blob store at the scratch folder too
+    from storage import storage
+    storage.init_app(app)
+
+    from detection import model_ready
+    if not model_ready.wait(30):
+        raise SystemExit("Stub model did not become ready")
+    return app
+
+def login_client(app, args):
+    client = app.test_client()
+    response = client.post('/login', data={'username': args.username, 'password': args.password})
+    if response.status_code != 302:
+        raise SystemExit("Login failed; check --username/--password")
+    return client
+
+def upload_id_from(location):
+    match = re.search(r'/(\d+)(?:\?|$)', location or '')
+    return int(match.group(1)) if match else None
+
+def wait_for_upload(get_json, upload_id, timeout):
+    """Poll the status endpoint until detection finishes; True on success"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        status = get_json(f'/upload/{upload_id}/status').get('status')
+        if status in ('done', 'failed'):
+            return status == 'done'
+        time.sleep(0.01)
+    return False
+
+def wait_for_report(get_json, location, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        status = get_json(location).get('status')
+        if status in ('done', 'failed'):
+            return status == 'done'
+        time.sleep(0.05)
+    return False
+
+def bench_client(app, args, images, results):
+    """Single-user latency of each endpoint through the Flask test client"""
+    client = login_client(app, args)
+
+    def get_json(path):
+        return client.get(path, headers={'Accept': 'application/json'}).get_json() or {}
+
+    upload_ids = []
+    for size_mb, image in images.items():
+        request_scenario = Scenario(f"client.upload_file[{size_mb}MB]")
+        done_scenario = Scenario(f"client.upload_to_result[{size_mb}MB]")
+        started_all = time.perf_counter()
+        with RssSampler() as sampler:
+            for i in range(args.iterations):
+                data = unique_image(image, f"client-{size_mb}-{i}")
+                started = time.perf_counter()
+                response = client.post('/upload', data={'file': (io.BytesIO(data), f'bench_{size_mb}mb_{i}.jpg')},
+                                       content_type='multipart/form-data')
+                request_seconds = time.perf_counter() - started
+                upload_id = upload_id_from(response.headers.get('Location'))
+                request_scenario.record(request_seconds, upload_id is not None)
+                ok = upload_id is not None and wait_for_upload(get_json, upload_id, args.timeout)
+                done_scenario.record(time.perf_counter() - started, ok)
+                if upload_id:
+                    upload_ids.append(upload_id)
+        # Peak RSS and wall time cover the whole size class, inference included
+        for scenario in (request_scenario, done_scenario):
+            scenario.peak_rss = sampler.peak
+            scenario.wall_seconds = time.perf_counter() - started_all
+        results += [request_scenario, done_scenario]
+        print_summary(request_scenario)
+        print_summary(done_scenario)
+
+    if not upload_ids:
+        return upload_ids
+
+    def get(path, expected=200):
+        return lambda i: timed(lambda: client.get(path(i) if callable(path) else path).status_code == expected)
+
+    pick = lambda i: upload_ids[i % len(upload_ids)]
+    scenarios = [
+        ("client.history", get('/history')),
+        ("client.history_data", get('/history/data')),
+        ("client.view_image.original", get(lambda i: f'/view_image/{pick(i)}/original')),
+        ("client.view_image.processed", get(lambda i: f'/view_image/{pick(i)}/processed')),
+        ("client.view_image.thumb", get(lambda i: f'/view_image/{pick(i)}/processed?size=thumb')),
+        ("client.single_report", get(lambda i: f'/single_report/{pick(i)}'))
+    ]
+    for name, fn in scenarios:
+        results.append(Scenario(name).run(fn, args.iterations))
+        print_summary(results[-1])
+
+    def full_report(i):
+        def run():
+            response = client.get('/generate_report')
+            return response.status_code == 302 and \
+                wait_for_report(get_json, response.headers['Location'], args.timeout)
+        return timed(run)
+    results.append(Scenario("client.generate_report").run(full_report, args.report_iterations))
+    print_summary(results[-1])
+    return upload_ids
+
+# --- Concurrent HTTP load ---
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+def http_opener(base_url, args):
+    """urllib opener logged in as the benchmark admin, without following redirects"""
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), NoRedirect)
+    body = urllib.parse.urlencode({'username': args.username, 'password': args.password}).encode()
+    try:
+        opener.open(f'{base_url}/login', body, timeout=args.timeout)
+    except urllib.error.HTTPError as e:
+        if e.code != 302:
+            raise SystemExit(f"Login to {base_url} failed with HTTP {e.code}")
+    return opener
+
+def http_call(opener, url, data=None, headers=None, timeout=60):
+    """Return (status, headers, body), treating redirects as responses"""
+    request = urllib.request.Request(url, data=data, headers=headers or {})
+    try:
+        with opener.open(request, timeout=timeout) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+def multipart(field, filename, data, content_type='image/jpeg'):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+def start_server(app):
+    """Serve the app on a free local port from a threaded werkzeug server"""
+    from werkzeug.serving import make_server
+    # Per-request access lines would drown the results
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+def bench_http(base_url, args, images, upload_ids, results, track_rss):
+    """Many concurrent clients hitting the same endpoints over real HTTP"""
+    opener = http_opener(base_url, args)
+    image_size = min(images)
+    image = images[image_size]
+
+    def get_json(path):
+        status, _, body = http_call(opener, base_url + path, headers={'Accept': 'application/json'},
+                                    timeout=args.timeout)
+        return json.loads(body) if status == 200 else {}
+
+    def upload(i):
+        body, headers = multipart('file', f'load_{i}.jpg', unique_image(image, f"http-{i}"))
+        status, response_headers, _ = http_call(opener, f'{base_url}/upload', body, headers, args.timeout)
+        upload_id = upload_id_from(response_headers.get('Location'))
+        if upload_id:
+            upload_ids.append(upload_id)
+        return status == 302 and upload_id is not None
+
+    results.append(Scenario(f"http.upload_file[{image_size}MB]", track_rss)
+                   .run(lambda i: timed(lambda: upload(i)), args.requests, args.concurrency))
+    print_summary(results[-1])
+    # Let the inference queue drain so the read scenarios see finished uploads
+    for upload_id in list(upload_ids)[-args.concurrency:]:
+        wait_for_upload(get_json, upload_id, args.timeout)
+
+    if not upload_ids:
+        return
+    pick = lambda i: upload_ids[i % len(upload_ids)]
+
+    def get(path):
+        return lambda i: timed(lambda: http_call(opener, base_url + path(i), timeout=args.timeout)[0] == 200)
+
+    scenarios = [
+        ("http.history", get(lambda i: '/history')),
+        ("http.history_data", get(lambda i: '/history/data')),
+        ("http.view_image.thumb", get(lambda i: f'/view_image/{pick(i)}/processed?size=thumb')),
+        ("http.view_image.original", get(lambda i: f'/view_image/{pick(i)}/original')),
+        ("http.single_report", get(lambda i: f'/single_report/{pick(i)}'))
+    ]
+    for name, fn in scenarios:
+        results.append(Scenario(name, track_rss).run(fn, args.requests, args.concurrency))
+        print_summary(results[-1])
+
+# --- Reporting ---
+
+def print_summary(scenario):
+    s = scenario.summary()
+    rss = f"{s['peak_rss_mb']}MB" if s['peak_rss_mb'] else '-'
+    print(f"{scenario.name:36} n={s['count']:<5} err={s['errors']:<3} p50={s['p50_ms']}ms "
+          f"p95={s['p95_ms']}ms p99={s['p99_ms']}ms {s['throughput_rps']} req/s rss={rss}")
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                             cwd=REPO_DIR, stderr=subprocess.DEVNULL, text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def write_results(args, results, prefix=''):
+    commit, dirty = git_revision()
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec='seconds'),
+            "commit": commit,
+            "dirty": dirty,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args)
+        },
+        "scenarios": {scenario.name: scenario.summary() for scenario in results}
+    }
+    output = args.output
+    if not output:
+        os.makedirs(os.path.join(BENCH_DIR, 'results'), exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output = os.path.join(BENCH_DIR, 'results', f"{prefix}{stamp}_{(commit or 'nogit')[:10]}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    return output
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1,4,8,16',
+                        help="Comma separated image sizes in MB (capped just under MAX_CONTENT_LENGTH).")
+    parser.add_argument('--iterations', type=int, default=10, help="Requests per test-client scenario.")
+    parser.add_argument('--report-iterations', type=int, default=2, help="Full reports to generate.")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent HTTP clients.")
+    parser.add_argument('--requests', type=int, default=100, help="Requests per HTTP load scenario.")
+    parser.add_argument('--stub-ms', type=float, default=50.0, help="Simulated inference time per image.")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Seconds to wait for a result or report.")
+    parser.add_argument('--url', default=None,
+                        help="Load test a running deployment instead of the in-process app (HTTP phase only).")
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--skip-client', action='store_true', help="Skip the test-client phase.")
+    parser.add_argument('--skip-http', action='store_true', help="Skip the concurrent HTTP phase.")
+    parser.add_argument('--output', '-o', default=None, help="Results file (default: benchmarks/results/).")
+    return parser.parse_args(argv)
+
+def drain_queue(timeout):
+    """Wait for queued detections so the scratch folder is not removed under them"""
+    from jobs import inference_queue
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = inference_queue.stats()
+        if not stats['queue_depth'] and not stats['active']:
+            return True
+        time.sleep(0.05)
+    return False
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [float(size) if '.' in size else int(size) for size in args.sizes.split(',') if size.strip()]
+
+    from benchmarks.stub import load_xray
+    max_bytes = 16 * 1024 * 1024
+    results = []
+    upload_ids = []
+    with tempfile.TemporaryDirectory(prefix='xray_bench_') as workdir:
+        app = None
+        if not args.url:
+            app = setup_app(args, workdir)
+            max_bytes = app.config['MAX_CONTENT_LENGTH']
+        print("Preparing synthetic images...")
+        images = {size: load_xray(size, os.path.join(BENCH_DIR, '.images'), max_bytes) for size in sizes}
+
+        if app and not args.skip_client:
+            upload_ids = bench_client(app, args, images, results)
+        if not args.skip_http:
+            server = None
+            base_url = args.url.rstrip('/') if args.url else None
+            if not base_url:
+                server, base_url = start_server(app)
+            try:
+                bench_http(base_url, args, images, [] if args.url else upload_ids, results,
+                           track_rss=not args.url)
+            finally:
+                if server:
+                    server.shutdown()
+        if app:
+            drain_queue(args.timeout)
+    write_results(args, results)
+
+if __name__ == '__main__':
+    main()
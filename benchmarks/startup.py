@@ -0,0 +1,123 @@
+"""Import time and baseline memory of the app in each deployment mode.
+
+Every sample is a fresh interpreter that imports app.py, serves one GET
+/login through the test client and reports its import time, RSS and which
+heavy ML modules got loaded:
+
+    python -m benchmarks.startup --repeat 5
+
+Modes: web (INFERENCE_PROCESS=external, what split web workers pay), lazy
+(in-process inference, model loaded on the first upload) and preload (the
+default: model loaded and warmed up at import). preload needs MODEL_PATH,
+or --stub for the stub model, which measures everything but torch itself.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.run import REPO_DIR, Scenario, percentile, print_summary, write_results
+
+HEAVY_MODULES = ('torch', 'ultralytics', 'cv2', 'PIL', 'onnxruntime', 'openvino')
+
+MODES = {
+    'web': {'INFERENCE_PROCESS': 'external', 'MODEL_PRELOAD': 'True'},
+    'lazy': {'INFERENCE_PROCESS': 'local', 'MODEL_PRELOAD': 'False'},
+    'preload': {'INFERENCE_PROCESS': 'local', 'MODEL_PRELOAD': 'True'}
+}
+
+# Runs in the child interpreter; prints one JSON line
+CHILD = r"""
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, os.environ['BENCH_REPO_DIR'])
+if os.environ.get('BENCH_STUB'):
+    from benchmarks.stub import install_stub_backend
+    os.environ['MODEL_PATH'] = install_stub_backend()
+from benchmarks.run import current_rss
+from app import app
+if os.environ['MODEL_PRELOAD'] == 'True' and os.environ['INFERENCE_PROCESS'] == 'local':
+    from detection import model_ready
+    model_ready.wait(120)
+imported = time.perf_counter()
+rss_import = current_rss()
+status = app.test_client().get('/login').status_code
+print(json.dumps({
+    'import_seconds': imported - started,
+    'request_seconds': time.perf_counter() - imported,
+    'rss_import': rss_import,
+    'rss_request': current_rss(),
+    'status': status,
+    'heavy': sorted(name for name in json.loads(os.environ['BENCH_HEAVY']) if name in sys.modules)
+}))
+"""
+
+def run_child(mode, workdir, args):
+    env = dict(os.environ, **MODES[mode])
+    env.update({
+        'BENCH_REPO_DIR': REPO_DIR,
+        'BENCH_HEAVY': json.dumps(HEAVY_MODULES),
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+        'REPORT_FOLDER': os.path.join(workdir, 'reports'),
+        'DERIVATIVE_FOLDER': os.path.join(workdir, 'derivatives'),
+        'SECRET_KEY': 'benchmark'
+    })
+    if args.stub:
+        env.update({'BENCH_STUB': '1', 'INFERENCE_BACKEND': 'stub'})
+    completed = subprocess.run([sys.executable, '-c', CHILD], env=env, cwd=REPO_DIR,
+                               capture_output=True, text=True, timeout=args.timeout)
+    lines = [line for line in completed.stdout.splitlines() if line.startswith('{')]
+    if completed.returncode != 0 or not lines:
+        print(completed.stderr[-2000:], file=sys.stderr)
+        return None
+    return json.loads(lines[-1])
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--modes', default='web,lazy,preload', help="Comma-separated modes to measure.")
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters per mode.")
+    parser.add_argument('--stub', action='store_true', help="Use the stub model instead of MODEL_PATH.")
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds allowed per interpreter.")
+    parser.add_argument('--output', '-o', default=None, help="Results file (default: benchmarks/results/).")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        raise SystemExit(f"Unknown mode(s): {', '.join(sorted(unknown))}")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='xray_startup_') as workdir:
+        # One untimed run creates the database so every sample starts alike
+        run_child('lazy', workdir, args)
+        for mode in modes:
+            scenario = Scenario(f"startup.{mode}", track_rss=False)
+            samples = []
+            for _ in range(args.repeat):
+                sample = run_child(mode, workdir, args)
+                scenario.record(sample['import_seconds'] if sample else 0.0, ok=bool(sample and sample['status'] == 200))
+                if sample:
+                    samples.append(sample)
+            if samples:
+                mb = lambda values: round(percentile(values, 50) / 1024 / 1024, 1)
+                scenario.peak_rss = max(sample['rss_request'] for sample in samples)
+                scenario.extra = {
+                    'baseline_rss_mb': mb([sample['rss_request'] for sample in samples]),
+                    'import_rss_mb': mb([sample['rss_import'] for sample in samples]),
+                    'first_request_ms': round(percentile([sample['request_seconds'] for sample in samples], 50) * 1000, 2),
+                    'heavy_modules': samples[-1]['heavy']
+                }
+            print_summary(scenario)
+            if samples:
+                print(f"{'':36} baseline rss={scenario.extra['baseline_rss_mb']}MB "
+                      f"first request={scenario.extra['first_request_ms']}ms "
+                      f"loaded: {', '.join(scenario.extra['heavy_modules']) or 'none'}")
+            results.append(scenario)
+    write_results(args, results, prefix='startup_')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Stub model and synthetic X-ray images so benchmarks run without best.pt"""
+import os
+import tempfile
+import time
+import numpy as np
+from backends import Boxes, Result, register_backend
+
+MB = 1024 * 1024
+
+class StubBackend:
+    """Returns fixed boxes scaled to the image after an optional sleep.
+
+    The sleep stands in for a forward pass, so the benchmark measures the
+    web, storage and report path around inference rather than the model.
+    """
+    name = 'stub'
+    preload_before_fork = True
+    # Seconds per image, set by the benchmark runner before the app is imported
+    delay = 0.0
+
+    def __init__(self, config):
+        self.weights_path = self.weights_file(config)
+        self.names = {0: 'foreign_object'}
+
+    @classmethod
+    def weights_file(cls, config):
+        return config['MODEL_PATH']
+
+    def predict(self, source, conf=0.25, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        if self.delay:
+            time.sleep(self.delay * len(images))
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            # One confident find, one borderline and one below the default threshold
+            xyxy = [[width * 0.40, height * 0.45, width * 0.48, height * 0.52],
+                    [width * 0.15, height * 0.20, width * 0.22, height * 0.26],
+                    [width * 0.70, height * 0.60, width * 0.74, height * 0.66]]
+            scores = [0.87, 0.41, 0.12]
+            keep = [i for i, score in enumerate(scores) if score >= conf]
+            boxes = Boxes([xyxy[i] for i in keep], [scores[i] for i in keep], [0] * len(keep))
+            results.append(Result(boxes, self.names, (height, width)))
+        return results
+
+def install_stub_backend(delay=0.0):
+    """Register the stub as INFERENCE_BACKEND=stub with a dummy weights file"""
+    StubBackend.delay = delay
+    register_backend('stub', StubBackend)
+    fd, weights_path = tempfile.mkstemp(prefix='stub_weights_', suffix='.pt')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'stub weights')
+    return weights_path
+
+def render_xray(width, height, seed=0):
+    """Grayscale chest-film look: dark field, bright body, ribs, a metal object and grain"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    cx, cy = width / 2, height / 2
+    body = np.clip(1.2 - ((x - cx) / (width * 0.42)) ** 2 - ((y - cy) / (height * 0.48)) ** 2, 0, 1)
+    ribs = 0.5 + 0.5 * np.sin(y / height * 40 + np.abs(x - cx) / width * 6)
+    image = 30 + body * (120 + 50 * ribs)
+    # Bright, hard-edged blob where the stub reports its confident box
+    metal = ((x - width * 0.44) ** 2 + (y - height * 0.485) ** 2) < (min(width, height) * 0.025) ** 2
+    image[metal] = 245
+    image += rng.normal(0, 22, size=image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def encode_jpeg(image, quality=95):
+    import cv2
+    ok, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("Could not encode synthetic image")
+    return data.tobytes()
+
+def synthetic_xray(target_bytes, seed=0, aspect=1.25):
+    """JPEG bytes of a synthetic X-ray close to target_bytes in size.
+
+    The noise level is fixed and the resolution is scaled to reach the
+    target, so larger files are also larger images, as with real scans.
+    """
+    sample = encode_jpeg(render_xray(512, 640, seed))
+    bytes_per_pixel = len(sample) / (512 * 640)
+    data = None
+    for _ in range(3):
+        pixels = target_bytes / bytes_per_pixel
+        width = max(64, int((pixels / aspect) ** 0.5))
+        height = int(width * aspect)
+        data = encode_jpeg(render_xray(width, height, seed))
+        if abs(len(data) - target_bytes) <= target_bytes * 0.05:
+            break
+        bytes_per_pixel = len(data) / (width * height)
+    return data
+
+def load_xray(size_mb, cache_dir, max_bytes=None, seed=0):
+    """Synthetic X-ray of about size_mb, generated once and kept in cache_dir"""
+    target = int(size_mb * MB)
+    if max_bytes:
+        # Leave room for the multipart envelope under MAX_CONTENT_LENGTH
+        target = min(target, max_bytes - 64 * 1024)
+    path = os.path.join(cache_dir, f"xray_{target}_{seed}.jpg")
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    data = synthetic_xray(target, seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
@@ -0,0 +1,137 @@
+"""Latency and recall of tiled inference against full-image inference.
+
+Runs the real model (MODEL_PATH / INFERENCE_BACKEND) over a folder of
+radiographs in three modes: full image, every tile, and coarse-then-fine.
+With YOLO-format labels (one <image stem>.txt per image) recall and
+precision are measured against them; without labels the full-image boxes
+are the reference, so recall shows what tiling keeps and precision drops
+when tiling finds extra objects.
+
+    python -m benchmarks.tiling --images data/val/images --labels data/val/labels --tile-size 1024
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+from benchmarks.run import REPO_DIR, Scenario, print_summary, write_results
+
+MODES = ('full', 'tiles', 'coarse')
+
+def load_labels(path, height, width):
+    """YOLO txt labels (class cx cy w h, normalized) as xyxy Boxes in pixels"""
+    from backends import Boxes
+    rows = []
+    if os.path.exists(path):
+        with open(path) as f:
+            rows = [list(map(float, line.split()[:5])) for line in f if line.strip()]
+    if not rows:
+        return Boxes(np.zeros((0, 4)), [], [])
+    rows = np.array(rows, dtype=np.float32)
+    cx, cy, w, h = rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+    xyxy = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+    return Boxes(xyxy, np.ones(len(rows)), rows[:, 0])
+
+def model_config(args):
+    """Backend and tiling settings, read from the environment like app.py does"""
+    return {
+        'MODEL_PATH': args.model or os.getenv('MODEL_PATH', os.path.join(REPO_DIR, 'models', 'best.pt')),
+        'INFERENCE_BACKEND': args.backend or os.getenv('INFERENCE_BACKEND', 'torch'),
+        'ONNX_MODEL_PATH': os.getenv('ONNX_MODEL_PATH'),
+        'OPENVINO_MODEL_PATH': os.getenv('OPENVINO_MODEL_PATH'),
+        'ONNX_INTRA_OP_THREADS': int(os.getenv('ONNX_INTRA_OP_THREADS', 0)) or None,
+        'MODEL_IMGSZ': int(os.getenv('MODEL_IMGSZ', 640)),
+        'INFERENCE_TILE_SIZE': args.tile_size,
+        'INFERENCE_TILE_OVERLAP': args.overlap,
+        'INFERENCE_TILE_BATCH': args.tile_batch,
+        'INFERENCE_TILE_MERGE_IOU': args.merge_iou,
+        'INFERENCE_COARSE_CONF': args.coarse_conf
+    }
+
+def detect(backend, image, mode, config, conf):
+    from backends import as_numpy_boxes
+    from tiling import predict_tiled, tiling_settings
+    if mode == 'full':
+        return as_numpy_boxes(backend.predict(source=image, save=False, conf=conf, verbose=False)[0].boxes)
+    settings = dict(tiling_settings(config), mode=mode)
+    return predict_tiled(backend, image, conf, settings)[0].boxes
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--images', required=True, help="Folder of radiographs.")
+    parser.add_argument('--labels', default=None, help="Folder of YOLO .txt labels (optional).")
+    parser.add_argument('--model', default=None, help="Weights (default: MODEL_PATH).")
+    parser.add_argument('--backend', default=None, help="Inference backend (default: INFERENCE_BACKEND).")
+    parser.add_argument('--limit', type=int, default=50, help="Maximum number of images.")
+    parser.add_argument('--conf', type=float, default=float(os.getenv('DETECTION_THRESHOLD', 0.25)))
+    parser.add_argument('--iou', type=float, default=0.5, help="IoU for a box to count as found.")
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--overlap', type=float, default=0.2)
+    parser.add_argument('--tile-batch', type=int, default=8)
+    parser.add_argument('--merge-iou', type=float, default=0.5)
+    parser.add_argument('--coarse-conf', type=float, default=0.05)
+    parser.add_argument('--warmup', type=int, default=1, help="Untimed runs per mode before measuring.")
+    parser.add_argument('--output', '-o', default=None, help="Results file (default: benchmarks/results/).")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, REPO_DIR)
+    import cv2
+    from backends import create_backend, match_detections
+
+    paths = [os.path.join(args.images, name) for name in sorted(os.listdir(args.images))
+             if name.lower().endswith(('.jpg', '.jpeg', '.png')) and not name.startswith('processed_')][:args.limit]
+    if not paths:
+        raise SystemExit(f"No images found in {args.images}")
+    config = model_config(args)
+    backend = create_backend(config)
+
+    scenarios = {mode: Scenario(f"tiling.{mode}", track_rss=False) for mode in MODES}
+    totals = {mode: {'reference': 0, 'found': 0, 'matched': 0} for mode in MODES}
+    warmed = False
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        if not warmed:
+            for mode in MODES:
+                for _ in range(args.warmup):
+                    detect(backend, image, mode, config, args.conf)
+            warmed = True
+
+        outputs = {}
+        for mode in MODES:
+            started = time.perf_counter()
+            outputs[mode] = detect(backend, image, mode, config, args.conf)
+            seconds = time.perf_counter() - started
+            scenarios[mode].record(seconds)
+            scenarios[mode].wall_seconds += seconds
+
+        if args.labels:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            reference = load_labels(os.path.join(args.labels, f"{stem}.txt"), *image.shape[:2])
+        else:
+            reference = outputs['full']
+        for mode in MODES:
+            matched, _ = match_detections(reference, outputs[mode], args.iou)
+            totals[mode]['reference'] += len(reference)
+            totals[mode]['found'] += len(outputs[mode])
+            totals[mode]['matched'] += matched
+
+    print(f"{len(paths)} images, reference: {'labels' if args.labels else 'full-image boxes'}")
+    for mode in MODES:
+        counts = totals[mode]
+        scenarios[mode].extra = {
+            'boxes': counts['found'],
+            'recall': round(counts['matched'] / counts['reference'], 4) if counts['reference'] else None,
+            'precision': round(counts['matched'] / counts['found'], 4) if counts['found'] else None
+        }
+        print_summary(scenarios[mode])
+        print(f"{'':36} boxes={counts['found']} recall={scenarios[mode].extra['recall']} "
+              f"precision={scenarios[mode].extra['precision']}")
+    write_results(args, list(scenarios.values()), prefix='tiling_')
+
+if __name__ == '__main__':
+    main()
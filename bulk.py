@@ -0,0 +1,260 @@
+from flask import Blueprint, request, redirect, url_for, flash, render_template, session, current_app, jsonify
+from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import click
+import json
+import os
+import time
+import zipfile
+from database import db, Admin, Upload  # Import SQLAlchemy db and models
+from audit import log_action
+from detection import allowed_file, validate_image, decode_image, run_detection, login_required, get_model_version, get_threshold, get_settings_key, save_detections, add_cached_detections
+from cache import content_hash, content_path, cached_summary, get_cached_detection, store_detection, remove_unreferenced_file
+from storage import storage
+from jobs import inference_queue
+from admission import admission, admission_controlled, BatchSlots
+from metrics import StageTimer, observe_stages, uploads_total, upload_errors_total, detection_cache_total
+
+bulk_bp = Blueprint('bulk', __name__)
+
+def iter_zip_entries(zip_stream):
+    """Yield (name, stream) for every file in a ZIP without extracting it to disk"""
+    with zipfile.ZipFile(zip_stream) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            with archive.open(info) as entry:
+                yield info.filename, info.file_size, entry
+
+def iter_upload_entries(files):
+    """Yield (name, size, stream) for uploaded files, expanding ZIP archives"""
+    for file in files:
+        if not file or file.filename == '':
+            continue
+        if file.filename.lower().endswith('.zip'):
+            yield from iter_zip_entries(file.stream)
+        else:
+            yield file.filename, None, file.stream
+
+def iter_path_entries(paths):
+    """Yield (name, size, stream) for files, folders and ZIP archives on disk"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    yield from iter_path_entries([os.path.join(root, name)])
+        elif path.lower().endswith('.zip'):
+            with open(path, 'rb') as archive:
+                yield from iter_zip_entries(archive)
+        else:
+            with open(path, 'rb') as stream:
+                yield os.path.basename(path), os.path.getsize(path), stream
+
+def _detect(app, image_data):
+    """Decode one entry and run detection on it inside its own app context"""
+    started = time.monotonic()
+    timer = StageTimer()
+    with app.app_context():
+        try:
+            with timer.stage('decode'):
+                image = decode_image(image_data)
+            summary, error = run_detection(image, timer)
+        except Exception as e:
+            summary, error = None, f"Unexpected error: {str(e)}"
+    observe_stages(timer)
+    return summary, error, time.monotonic() - started
+
+def ingest_entries(entries, admin_id, workers=None, admitted=False):
+    """Validate, store and detect a batch of image entries.
+
+    Entries are read once, stored under their content hash and decoded in
+    memory while detection for earlier entries already runs on a thread
+    pool. At most two images per worker wait for or run detection, so
+    reading stops until one finishes rather than holding a whole archive in
+    memory. Images seen before reuse their cached result, and all Upload
+    rows are committed together in a single transaction at the end.
+
+    An admitted request (see admission_controlled) also charges every image
+    in flight beyond the first to the admission controller.
+    """
+    app = current_app._get_current_object()
+    workers = workers or app.config.get('BATCH_WORKERS', 4)
+    max_size = app.config['MAX_CONTENT_LENGTH']
+    model_version, threshold, settings_key = get_model_version(), get_threshold(), get_settings_key()
+    batch_started = time.monotonic()
+    items = []
+    pending = []
+    in_flight = {}
+    slots = BatchSlots(workers * 2, admission if admitted else None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, size, stream in entries:
+            item = {"file": name, "status": "failed", "upload_id": None, "seconds": 0.0}
+            items.append(item)
+
+            if not allowed_file(name):
+                item["error"] = "Only JPG, JPEG and PNG files allowed."
+                upload_errors_total.inc(reason='extension')
+                continue
+            if size is not None and size > max_size:
+                item["error"] = "File too large."
+                upload_errors_total.inc(reason='too_large')
+                continue
+
+            file_extension = validate_image(stream)
+            if not file_extension:
+                item["error"] = "Invalid image file."
+                upload_errors_total.inc(reason='invalid_image')
+                continue
+
+            # Read the entry once: the bytes are written to storage
+            # and decoded in memory for detection without a second disk read
+            image_data = stream.read(max_size + 1)
+            if len(image_data) > max_size:
+                item["error"] = "File too large."
+                upload_errors_total.inc(reason='too_large')
+                continue
+            uploads_total.inc(source='batch')
+            digest = content_hash(image_data)
+            file_path = content_path(digest, file_extension)
+            if not storage.exists(file_path):
+                storage.save(file_path, image_data)
+
+            # Duplicates within the batch share one detection run
+            cached = get_cached_detection(digest, model_version, threshold, settings_key)
+            detection_cache_total.inc(result='hit' if cached else 'miss')
+            if cached:
+                pending.append((item, file_path, digest, None, cached_summary(cached)))
+                continue
+            if inference_queue.external:
+                # The inference process picks the row up from the database
+                pending.append((item, file_path, digest, None, None))
+                continue
+            if digest not in in_flight:
+                slots.acquire()
+                in_flight[digest] = executor.submit(_detect, app, image_data)
+                in_flight[digest].add_done_callback(lambda future: slots.release())
+            pending.append((item, file_path, digest, in_flight[digest], None))
+
+    # Build every row first, then commit them in one transaction
+    uploads = []
+    for item, file_path, digest, future, summary in pending:
+        if future is not None:
+            summary, error, seconds = future.result()
+            item["seconds"] = round(seconds, 3)
+            if error:
+                item["error"] = error
+                upload_errors_total.inc(reason='detection')
+                remove_unreferenced_file(file_path)
+                continue
+            if in_flight.pop(digest, None) is not None:
+                store_detection(digest, model_version, threshold, settings_key, summary)
+        if summary is None:
+            upload = Upload(
+                file_name=secure_filename(os.path.basename(item["file"])),
+                file_path=file_path,
+                content_hash=digest,
+                status='pending',
+                upload_time=datetime.now()
+            )
+            uploads.append((item, upload, None))
+            continue
+
+        upload = Upload(
+            file_name=secure_filename(os.path.basename(item["file"])),
+            file_path=file_path,
+            content_hash=digest,
+            detection_result=summary['detection_result'],
+            confidence_score=summary['confidence_score'],
+            processed_file_path=summary['processed_file_path'],
+            predictions=json.dumps(summary['predictions']),
+            model_version=model_version,
+            status='done',
+            upload_time=datetime.now()
+        )
+        uploads.append((item, upload, summary))
+
+    db.session.add_all([upload for _, upload, _ in uploads])
+    db.session.flush()
+    for _, upload, summary in uploads:
+        if summary is None:
+            continue
+        if 'boxes' in summary:
+            save_detections(upload.id, summary['boxes'], model_version)
+        else:
+            add_cached_detections(upload.id, upload.content_hash, model_version, summary['predictions'])
+    db.session.commit()
+
+    for item, upload, summary in uploads:
+        if summary is None:
+            item.update({"status": "queued", "upload_id": upload.id, "detection_result": "Queued for detection"})
+            continue
+        item.update({
+            "status": "ok",
+            "upload_id": upload.id,
+            "detection_result": summary['detection_result'],
+            "confidence_score": summary['confidence_score']
+        })
+
+    # Queued uploads are stored but not detected yet, so they are not counted as ok
+    ok = sum(item["status"] == "ok" for item in items)
+    queued = sum(item["status"] == "queued" for item in items)
+    result = {
+        "total": len(items),
+        "ok": ok,
+        "queued": queued,
+        "failed": len(items) - ok - queued,
+        "seconds": round(time.monotonic() - batch_started, 3),
+        "items": items
+    }
+
+    # Log the action
+    log_action(admin_id, "batch_upload",
+               f"Batch upload: {ok} of {len(items)} images processed, {queued} queued for detection")
+    return result
+
+@bulk_bp.route('/upload_batch', methods=['POST'])
+@login_required
+@admission_controlled
+def upload_batch():
+    try:
+        files = request.files.getlist('files')
+        if not files or all(file.filename == '' for file in files):
+            flash("No files selected.", "danger")
+            return redirect(url_for('index'))
+
+        result = ingest_entries(iter_upload_entries(files), session.get('admin_id'), admitted=admission.enabled)
+    except RequestEntityTooLarge:
+        flash("Batch too large.", "danger")
+        return redirect(url_for('index'))
+    except zipfile.BadZipFile:
+        flash("Invalid ZIP archive.", "danger")
+        return redirect(url_for('index'))
+    except Exception as e:
+        flash(f"Error processing batch: {str(e)}", "danger")
+        return redirect(url_for('index'))
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(result)
+    return render_template('batch_result.html', result=result)
+
+# Flask CLI command to ingest folders, images or ZIP archives from disk
+@click.command("ingest")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--admin", "username", default="admin", help="Admin user recorded in the audit log.")
+@click.option("--workers", default=None, type=int, help="Parallel detection workers.")
+def ingest_command(paths, username, workers):
+    """Run detection for many images, folders or ZIP archives at once."""
+    admin = Admin.query.filter_by(username=username).first()
+    if not admin:
+        click.echo(f"Admin user '{username}' not found")
+        return
+
+    result = ingest_entries(iter_path_entries(paths), admin.id, workers)
+    for item in result["items"]:
+        outcome = item.get("detection_result") if item["status"] in ("ok", "queued") else item.get("error")
+        click.echo(f"{item['status']:<7} {item['seconds']:>7.2f}s  {item['file']}  {outcome}")
+    click.echo(f"{result['ok']} ok, {result['queued']} queued, {result['failed']} failed, "
+               f"{result['total']} total in {result['seconds']:.2f}s")
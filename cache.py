@@ -0,0 +1,244 @@
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
+from collections import OrderedDict
+import click
+import hashlib
+import json
+import os
+import threading
+from database import db, Upload, Detection, DetectionCache
+from derivatives import remove_derivatives
+from storage import storage, original_key, processed_key, copy_to_storage
+
+def content_hash(data):
+    """SHA-256 hex digest of an image's bytes, used as its storage name"""
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def content_path(digest, extension):
+    """Content-addressed storage key of an original upload"""
+    return original_key(digest, extension)
+
+def get_cached_detection(digest, model_version, threshold, settings_key):
+    """Return the cached detection for this image, or None on a miss"""
+    entry = DetectionCache.query.filter_by(
+        content_hash=digest, model_version=model_version, threshold=threshold,
+        settings_key=settings_key).first()
+    if entry is None:
+        return None
+
+    # A cache entry is useless once its processed image is gone
+    if entry.processed_file_path and not storage.exists(entry.processed_file_path):
+        db.session.delete(entry)
+        db.session.commit()
+        return None
+
+    entry.last_used_at = datetime.now()
+    db.session.commit()
+    return entry
+
+def cached_summary(entry):
+    """Rebuild the run_detection summary dict from a cache entry"""
+    return {
+        "detection_result": entry.detection_result,
+        "confidence_score": entry.confidence_score,
+        "processed_file_path": entry.processed_file_path,
+        "predictions": json.loads(entry.predictions) if entry.predictions else []
+    }
+
+def store_detection(digest, model_version, threshold, settings_key, summary):
+    """Remember a detection summary and evict the least recently used entries"""
+    entry = DetectionCache(
+        content_hash=digest,
+        model_version=model_version,
+        threshold=threshold,
+        settings_key=settings_key,
+        detection_result=summary['detection_result'],
+        confidence_score=summary['confidence_score'],
+        processed_file_path=summary['processed_file_path'],
+        predictions=json.dumps(summary['predictions'])
+    )
+    db.session.add(entry)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker cached the same image first
+        db.session.rollback()
+        return
+    evict_detection_cache(current_app.config.get('DETECTION_CACHE_MAX_ENTRIES', 10000))
+
+def evict_detection_cache(max_entries):
+    """Drop least recently used entries until at most max_entries remain"""
+    excess = DetectionCache.query.count() - max_entries
+    if excess <= 0:
+        return 0
+
+    stale = DetectionCache.query.order_by(DetectionCache.last_used_at.asc()).limit(excess).all()
+    paths = [entry.processed_file_path for entry in stale]
+    for entry in stale:
+        db.session.delete(entry)
+    db.session.commit()
+
+    for path in paths:
+        remove_unreferenced_file(path)
+    return len(stale)
+
+class OverlayCache:
+    """Small in-process LRU of rendered overlay JPEGs, bounded by total bytes"""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data, max_bytes):
+        if len(data) > max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+overlay_cache = OverlayCache()
+
+def is_file_referenced(path):
+    """True if any upload or cache entry still points at this file"""
+    if Upload.query.filter((Upload.file_path == path) | (Upload.processed_file_path == path)).first():
+        return True
+    return DetectionCache.query.filter_by(processed_file_path=path).first() is not None
+
+def remove_unreferenced_file(path):
+    """Delete a stored file and its derivatives once nothing in the database refers to it"""
+    if path and not is_file_referenced(path):
+        storage.delete(path)
+        remove_derivatives(path)
+
+# Flask CLI command to migrate the flat uploads folder to content-addressed storage keys
+@click.command("dedupe-uploads")
+@click.option("--dry-run", is_flag=True, help="Only report what would change.")
+def dedupe_uploads_command(dry_run):
+    """Store each distinct image of the legacy uploads folder exactly once, under its content hash."""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+
+    # Group every legacy (flat, absolute path) file by the hash of its bytes
+    groups = {}
+    for name in sorted(os.listdir(upload_folder)):
+        path = os.path.join(upload_folder, name)
+        if not os.path.isfile(path):
+            continue
+        prefix = 'processed_' if name.startswith('processed_') else ''
+        extension = os.path.splitext(name)[1].lower()
+        groups.setdefault((prefix, file_hash(path), extension), []).append(path)
+
+    stored = removed = rows = 0
+    for (prefix, digest, extension), paths in groups.items():
+        if prefix:
+            target = processed_key(f"{prefix}{digest}{extension}")
+        else:
+            target = original_key(digest, extension)
+
+        # One copy goes into storage; the legacy files are deleted after the commit
+        if not storage.exists(target):
+            stored += 1
+            if not dry_run:
+                copy_to_storage(paths[0], target)
+
+        for path in paths:
+            if prefix:
+                matches = Upload.query.filter_by(processed_file_path=path).all()
+                for upload in matches:
+                    upload.processed_file_path = target
+                DetectionCache.query.filter_by(processed_file_path=path).update(
+                    {'processed_file_path': target})
+            else:
+                matches = Upload.query.filter_by(file_path=path).all()
+                for upload in matches:
+                    upload.file_path = target
+                    upload.content_hash = digest
+            rows += len(matches)
+
+        if not prefix:
+            Upload.query.filter_by(file_path=target, content_hash=None).update({'content_hash': digest})
+        removed += len(paths)
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+        # Every row now points at a storage key, so no legacy file is referenced any more
+        for paths in groups.values():
+            for path in paths:
+                storage.delete(path)
+                remove_derivatives(path)
+    click.echo(f"{len(groups)} distinct files, {stored} stored under their content hash, "
+               f"{removed} legacy files removed, {rows} rows updated" + (" (dry run)" if dry_run else ""))
+
+# Flask CLI command to reclaim stored processed images once overlays are drawn on demand
+@click.command("purge-processed")
+@click.option("--dry-run", is_flag=True, help="Only report what would be removed.")
+def purge_processed_command(dry_run):
+    """Delete processed_*.jpg files whose overlay can be redrawn from stored boxes."""
+    with_boxes = db.session.query(Detection.upload_id).distinct()
+    uploads = Upload.query.filter(Upload.processed_file_path.isnot(None), Upload.id.in_(with_boxes)).all()
+    redrawable = {upload.processed_file_path for upload in uploads}
+
+    # Uploads without stored boxes keep their processed image, it cannot be redrawn
+    kept = {path for (path,) in db.session.query(Upload.processed_file_path).filter(
+        Upload.processed_file_path.isnot(None), ~Upload.id.in_(with_boxes))}
+
+    # Orphans: processed files the database may no longer point at, in the
+    # sharded layout and left over in the flat legacy folder
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    orphans = {os.path.join(upload_folder, name) for name in os.listdir(upload_folder)
+               if name.startswith('processed_')}
+    orphans = (orphans | set(storage.iter_keys('processed/'))) - redrawable
+
+    if not dry_run:
+        for upload in uploads:
+            upload.processed_file_path = None
+        DetectionCache.query.filter(DetectionCache.processed_file_path.in_(redrawable - kept)).update(
+            {'processed_file_path': None}, synchronize_session=False)
+        db.session.commit()
+
+    removed = freed = 0
+    for path in sorted(redrawable | orphans):
+        size = None if path in kept else storage.size(path)
+        if size is None:
+            continue
+        if path in orphans and is_file_referenced(path):
+            continue
+        removed += 1
+        freed += size
+        if not dry_run:
+            storage.delete(path)
+            remove_derivatives(path)
+    click.echo(f"{removed} processed images, {freed / (1024 * 1024):.1f} MB"
+               + (" would be removed (dry run)" if dry_run else " removed"))
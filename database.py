@@ -1,6 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, insert, inspect, text
 from werkzeug.security import generate_password_hash
 from datetime import datetime
+import click
+import json
+import os
 
 db = SQLAlchemy()
 
@@ -12,28 +16,150 @@ class Admin(db.Model):
     last_login = db.Column(db.DateTime)
 
 class Upload(db.Model):
+    # (upload_time, id) is the keyset the history pages are ordered and cursored by
+    __table_args__ = (db.Index('ix_upload_upload_time_id', 'upload_time', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     file_name = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(255), nullable=False)
+    detection_result = db.Column(db.String(255), index=True)
+    confidence_score = db.Column(db.Float, index=True)
+    remarks = db.Column(db.Text)
+    upload_time = db.Column(db.DateTime, default=datetime.now, index=True)
+    processed_file_path = db.Column(db.String(255))
+    # Inference job state: pending -> running -> done/failed
+    status = db.Column(db.String(20), default='done', server_default='done', nullable=False, index=True)
+    error_message = db.Column(db.Text)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    stage_timings = db.Column(db.Text)  # JSON: seconds spent in each pipeline stage
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the original bytes
+    predictions = db.Column(db.Text)  # JSON list of every box above the threshold
+    model_version = db.Column(db.String(64))  # Weights that produced the result
+
+class DetectionCache(db.Model):
+    """Detection results keyed by image content, model version, threshold and post-processing settings"""
+    __table_args__ = (db.UniqueConstraint('content_hash', 'model_version', 'threshold', 'settings_key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)
+    model_version = db.Column(db.String(64), nullable=False)
+    threshold = db.Column(db.Float, nullable=False)
+    settings_key = db.Column(db.String(16), nullable=False, default='', server_default='')  # postprocess.settings_fingerprint
     detection_result = db.Column(db.String(255))
     confidence_score = db.Column(db.Float)
-    remarks = db.Column(db.Text)
-    upload_time = db.Column(db.DateTime, default=datetime.now)
     processed_file_path = db.Column(db.String(255))
+    predictions = db.Column(db.Text)  # JSON list of predictions above the threshold
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    last_used_at = db.Column(db.DateTime, default=datetime.now, index=True)
 
-class Log(db.Model):
+class Detection(db.Model):
+    """One predicted box of an upload, kept so results can be re-thresholded and redrawn"""
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.Integer, db.ForeignKey('upload.id'), nullable=False, index=True)
+    class_id = db.Column(db.Integer)
+    class_name = db.Column(db.String(100))
+    confidence = db.Column(db.Float, nullable=False)
+    x1 = db.Column(db.Float, nullable=False)
+    y1 = db.Column(db.Float, nullable=False)
+    x2 = db.Column(db.Float, nullable=False)
+    y2 = db.Column(db.Float, nullable=False)
+    model_version = db.Column(db.String(64))
+
+class ApiToken(db.Model):
+    """Bearer token for machine clients of the JSON API; only its hash is stored"""
     id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
     admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    last_used_at = db.Column(db.DateTime)
+    revoked = db.Column(db.Boolean, default=False, server_default='0', nullable=False)
+
+class RescoreJob(db.Model):
+    """Re-running detection over stored uploads with a new model; the checkpoint makes it resumable"""
+    id = db.Column(db.Integer, primary_key=True)
+    admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'))
+    model_version = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending/running/done/failed/cancelled
+    last_upload_id = db.Column(db.Integer, default=0, nullable=False)  # Checkpoint: uploads up to here are handled
+    total = db.Column(db.Integer)
+    processed = db.Column(db.Integer, default=0, nullable=False)
+    failed = db.Column(db.Integer, default=0, nullable=False)
+    error_message = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+class ReportJob(db.Model):
+    """Full-history PDF report built in the background and downloaded when ready"""
+    id = db.Column(db.Integer, primary_key=True)
+    admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'), nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)
+    filters = db.Column(db.Text)  # JSON: start_date, end_date, result
+    file_path = db.Column(db.String(255))
+    total = db.Column(db.Integer)
+    error_message = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+class RateLimitBucket(db.Model):
+    """Token bucket of one rate-limited client, shared by every worker process"""
+    key = db.Column(db.String(64), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.Float, nullable=False)  # Unix time of the last refill
+
+class Log(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'), nullable=False, index=True)
     action = db.Column(db.String(50), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.now)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
     details = db.Column(db.Text)
 
+class SchemaVersion(db.Model):
+    """Versioned migrations that have been applied to this database"""
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(255))
+    applied_at = db.Column(db.DateTime, default=datetime.now)
+
+def database_uri():
+    """DATABASE_URL from the environment, defaulting to the local SQLite file"""
+    uri = os.getenv('DATABASE_URL', 'sqlite:///database.db')
+    # Heroku/Azure style URLs use the scheme SQLAlchemy dropped
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+def engine_options(uri):
+    if uri.startswith('sqlite'):
+        # Wait for the write lock instead of failing with "database is locked"
+        return {'connect_args': {'timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 15000)) / 1000.0}}
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True
+    }
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers run alongside the single writer; NORMAL sync is safe with WAL"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 15000))}")
+    cursor.close()
+
 def init_db(app):
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+    uri = app.config.get('SQLALCHEMY_DATABASE_URI') or database_uri()
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(uri))
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
     with app.app_context():
-        db.create_all()
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', set_sqlite_pragmas)
+        if app.config.get('DB_AUTO_MIGRATE', True):
+            upgrade_db()
         if not Admin.query.filter_by(username='admin').first():
             default_admin = Admin(
                 username='admin',
@@ -43,7 +169,119 @@ def init_db(app):
             db.session.add(default_admin)
             db.session.commit()
 
-def log_action(admin_id, action, details=None):
-    log = Log(admin_id=admin_id, action=action, details=details)
-    db.session.add(log)
-    db.session.commit()
\ No newline at end of file
+def add_missing_columns():
+    """Add model columns that are missing from tables created by an older version"""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                conn.execute(text(ddl))
+
+def create_missing_indexes():
+    """Create model indexes that tables created by an older version do not have"""
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine, checkfirst=True)
+
+def analyze_tables(conn):
+    """Refresh planner statistics so new indexes are actually used"""
+    conn.execute(text("ANALYZE"))
+
+def create_upload_search_index(conn):
+    """SQLite FTS5 index over upload file names, kept in sync by triggers"""
+    if conn.dialect.name != 'sqlite':
+        return
+    try:
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS upload_fts USING fts5("
+                          "file_name, content='upload', content_rowid='id')"))
+    except Exception as e:
+        # SQLite built without FTS5: history search falls back to LIKE
+        print(f"Warning: FTS5 unavailable, filename search will not be indexed: {e}")
+        return
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS upload_fts_insert AFTER INSERT ON upload BEGIN "
+                      "INSERT INTO upload_fts(rowid, file_name) VALUES (new.id, new.file_name); END"))
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS upload_fts_delete AFTER DELETE ON upload BEGIN "
+                      "INSERT INTO upload_fts(upload_fts, rowid, file_name) VALUES ('delete', old.id, old.file_name); END"))
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS upload_fts_update AFTER UPDATE OF file_name ON upload BEGIN "
+                      "INSERT INTO upload_fts(upload_fts, rowid, file_name) VALUES ('delete', old.id, old.file_name); "
+                      "INSERT INTO upload_fts(rowid, file_name) VALUES (new.id, new.file_name); END"))
+    conn.execute(text("INSERT INTO upload_fts(upload_fts) VALUES ('rebuild')"))
+
+def backfill_upload_predictions(conn):
+    """Give existing uploads the full box list kept in the detection cache"""
+    conn.execute(text(
+        "UPDATE upload SET predictions = ("
+        "SELECT predictions FROM detection_cache WHERE detection_cache.content_hash = upload.content_hash "
+        "ORDER BY last_used_at DESC LIMIT 1) "
+        "WHERE predictions IS NULL AND content_hash IS NOT NULL"))
+
+def migrate_predictions_to_detections(conn):
+    """Move the prediction boxes stored as JSON on uploads into the detection table"""
+    rows = conn.execute(text(
+        "SELECT id, predictions FROM upload WHERE predictions IS NOT NULL "
+        "AND id NOT IN (SELECT upload_id FROM detection)")).fetchall()
+    batch = []
+    for upload_id, predictions in rows:
+        for prediction in json.loads(predictions):
+            x1, y1, x2, y2 = prediction['coordinates']
+            batch.append({"upload_id": upload_id, "class_id": prediction.get('class_id'),
+                          "class_name": prediction['class'], "confidence": prediction['confidence'],
+                          "x1": x1, "y1": y1, "x2": x2, "y2": y2, "model_version": None})
+        if len(batch) >= 1000:
+            conn.execute(insert(Detection), batch)
+            batch = []
+    if batch:
+        conn.execute(insert(Detection), batch)
+
+def rebuild_detection_cache(conn):
+    """Recreate the detection cache with the settings key in its unique constraint; entries are only a cache"""
+    DetectionCache.__table__.drop(conn)
+    DetectionCache.__table__.create(conn)
+
+# Versioned migrations for changes create_all and the column/index sync
+# cannot express; append new steps, never reorder or edit applied ones
+MIGRATIONS = [
+    (1, "Analyze tables after adding upload/log indexes", analyze_tables),
+    (2, "Full-text index for history filename search", create_upload_search_index),
+    (3, "Analyze tables after adding history filter indexes", analyze_tables),
+    (4, "Copy cached prediction boxes onto uploads", backfill_upload_predictions),
+    (5, "Move upload prediction boxes into the detection table", migrate_predictions_to_detections),
+    (6, "Key the detection cache on post-processing settings", rebuild_detection_cache),
+]
+
+def upgrade_db():
+    """Bring the schema up to date: new tables, columns, indexes, then versioned steps"""
+    db.create_all()
+    add_missing_columns()
+    create_missing_indexes()
+
+    applied = {row.version for row in SchemaVersion.query.all()}
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with db.engine.begin() as conn:
+            migrate(conn)
+        db.session.add(SchemaVersion(version=version, description=description))
+        db.session.commit()
+        print(f" Applied migration {version}: {description}")
+
+# Flask CLI command to upgrade the schema explicitly (e.g. with DB_AUTO_MIGRATE off)
+@click.command("db-upgrade")
+def db_upgrade_command():
+    """Create missing tables, columns and indexes and run pending migrations."""
+    upgrade_db()
+    click.echo("Database is up to date")
@@ -0,0 +1,81 @@
+from flask import current_app
+import os
+import threading
+import time
+import uuid
+from storage import storage, evict_lru
+
+# Bounding boxes (width, height) of the generated derivatives
+DERIVATIVE_SIZES = {
+    'thumb': (320, 320),
+    'preview': (1280, 1280)
+}
+
+_eviction_lock = threading.Lock()
+_last_eviction = 0.0
+
+def derivative_path(source_path, size_name):
+    """Location of a derivative; stored files never change, so the name is the key"""
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(current_app.config['DERIVATIVE_FOLDER'], size_name, f"{stem}.jpg")
+
+def generate_derivative(source_path, target_path, max_size):
+    """Decode at reduced scale, resize and write a JPEG next to the others"""
+    from PIL import Image
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with Image.open(source_path) as img:
+        # draft() lets the JPEG decoder skip straight to a reduced scale
+        img.draft('RGB', max_size)
+        img = img.convert('RGB')
+        img.thumbnail(max_size)
+        # Write under a temporary name so readers never see a partial file
+        temp_path = f"{target_path}.{uuid.uuid4().hex}.tmp"
+        img.save(temp_path, 'JPEG', quality=85, optimize=True)
+    os.replace(temp_path, target_path)
+
+def get_derivative(source_path, size_name):
+    """Return the path of a resized copy of a stored file, creating it on first use"""
+    if not source_path:
+        return None
+    target_path = derivative_path(source_path, size_name)
+    if os.path.exists(target_path):
+        # The modification time doubles as the last-used time for eviction
+        os.utime(target_path)
+        return target_path
+
+    local_path = storage.local_path(source_path)
+    if local_path is None:
+        return None
+    try:
+        generate_derivative(local_path, target_path, DERIVATIVE_SIZES[size_name])
+    except Exception as e:
+        print(f"Error creating {size_name} for {source_path}: {e}")
+        return None
+    evict_derivatives()
+    return target_path
+
+def remove_derivatives(source_path):
+    """Drop every derivative of a stored file that is being deleted"""
+    for size_name in DERIVATIVE_SIZES:
+        path = derivative_path(source_path, size_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+def evict_derivatives(force=False):
+    """Delete least recently used derivatives once the folder exceeds its size limit.
+
+    Scanning the folder is not free, so this runs at most once every
+    DERIVATIVE_EVICTION_INTERVAL seconds per process unless forced.
+    """
+    global _last_eviction
+    now = time.monotonic()
+    if not force and now - _last_eviction < current_app.config.get('DERIVATIVE_EVICTION_INTERVAL', 60):
+        return 0
+    if not _eviction_lock.acquire(blocking=False):
+        return 0
+    try:
+        _last_eviction = now
+        max_bytes = current_app.config.get('DERIVATIVE_CACHE_MAX_MB', 512) * 1024 * 1024
+        return evict_lru(current_app.config['DERIVATIVE_FOLDER'], max_bytes)
+    finally:
+        _eviction_lock.release()
@@ -1,29 +1,45 @@
-from flask import Blueprint, request, redirect, url_for, flash, render_template, send_file, session, current_app
+from flask import Blueprint, request, redirect, url_for, flash, render_template, send_file, session, current_app, jsonify
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
-import cv2
+import importlib.util
 import os
 import json
 from functools import lru_cache, wraps
-from database import db, Upload, log_action  # Import SQLAlchemy db and models
-from PIL import Image
+from database import db, Upload, Detection, DetectionCache  # Import SQLAlchemy db and models
+from sqlalchemy import insert
+from audit import log_action
+from cache import content_hash, content_path, file_hash, cached_summary, get_cached_detection, store_detection, remove_unreferenced_file, overlay_cache
+from jobs import inference_queue
+from admission import admission, admission_controlled
+from batching import inference_batcher
+from metrics import StageTimer, observe_stages, stage_stats, span, inference_seconds, uploads_total, upload_errors_total, detection_cache_total
+from backends import get_backend_class
+from derivatives import DERIVATIVE_SIZES, get_derivative, evict_derivatives
+from storage import storage, processed_key, write_atomic
+from tiling import tiling_enabled, tiling_settings, tiling_fingerprint, predict_tiled
+from postprocess import Detections, postprocess, postprocess_settings, summarize, select, lowest_threshold, thresholds_fingerprint, settings_fingerprint
+from history import parse_history_filters, history_page, serialize_upload
+from concurrent.futures import ThreadPoolExecutor
 import io
-import uuid
 import numpy as np
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import imghdr
+import mimetypes
+import urllib.parse
 
-# Check for YOLO availability and version
-try:
-    from ultralytics import YOLO
-    YOLO_AVAILABLE = True
-except ImportError:
-    YOLO_AVAILABLE = False
-    print("Warning: YOLO not available. Install ultralytics package for detection functionality.")
+# torch, ultralytics, OpenCV and Pillow are imported where they are used,
+# so web requests, CLI commands and INFERENCE_PROCESS=external web workers
+# that never run the model do not pay for loading them
+def yolo_available():
+    return importlib.util.find_spec('ultralytics') is not None
 
 detection_bp = Blueprint('detection', __name__)
 
+# Small thread pool for disk writes that should stay off the request path
+io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload-io")
+
 # Define allowed extensions for security
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
@@ -49,202 +65,877 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Import torch and the YOLO detection model class
-import torch
-from ultralytics.nn.tasks import DetectionModel
-
-# --- PATCH: Allowlist DetectionModel for safe deserialization ---
-if hasattr(torch.serialization, '_default_safe_globals'):
-    torch.serialization._default_safe_globals["ultralytics.nn.tasks.DetectionModel"] = DetectionModel
-# -----------------------------------------------------------------------
+# Set once the model has been loaded and has run a dummy inference
+model_ready = threading.Event()
+_model_state = {"error": None, "warm_up_seconds": None}
 
 @lru_cache(maxsize=1)
 def get_model():
-    if not YOLO_AVAILABLE:
-        print(" YOLO package is not available.")
+    """Load the inference backend selected by INFERENCE_BACKEND (torch, onnx, openvino)"""
+    if current_app.config.get('MODEL_SERVER'):
+        # The model lives in the shared model server; this is only a client for it
+        from model_server import ModelServerClient
+        print(f" Using model server at {current_app.config['MODEL_SERVER_SOCKET']}")
+        return ModelServerClient(current_app.config)
+
+    backend_class = get_backend_class(current_app.config)
+    if backend_class.name in ('torch', 'openvino') and not yolo_available():
+        print(" YOLO package is not available. Install ultralytics package for detection functionality.")
         return None
 
-    model_path = r"E:\RedVision\RV (1)\best.pt"
-    print(f" Using model path: {model_path}")
+    model_path = current_app.config['MODEL_PATH']
+    print(f" Using model path: {model_path} ({backend_class.name} backend)")
 
     if not os.path.exists(model_path):
         print(f" Error: Model file not found at {model_path}")
         return None
 
     try:
-        # Initialize the YOLO model (this internally calls torch.load)
-        model = YOLO(model_path)
-        print(" YOLO model loaded successfully!")
+        # Initialize the backend (for torch this internally calls torch.load)
+        model = backend_class(current_app.config)
+        print(f" {backend_class.name} model loaded successfully!")
         return model
     except Exception as e:
-        print(f" Error loading YOLO model: {e}")
+        print(f" Error loading {backend_class.name} model: {e}")
         return None
 
-def predict_image(image_path):
+@lru_cache(maxsize=1)
+def get_model_version():
+    """Short hash of the weights in use, so cached results follow model or backend changes.
+
+    Only the weights file is read, so web workers that leave inference to a
+    separate process agree on the version without loading the model.
+    """
+    backend_class = get_backend_class(current_app.config)
+    model_path = backend_class.weights_file(current_app.config)
+    if not os.path.isfile(model_path):
+        return "unknown"
+    version = file_hash(model_path)[:16]
+    return version if backend_class.name == 'torch' else f"{backend_class.name}-{version}"
+
+def preload_model():
+    """Load the weights up front, e.g. in the gunicorn master before it forks.
+
+    Forked workers then share the weight tensors copy-on-write instead of
+    each loading its own copy on the first request. Backends whose runtime
+    cannot be forked are left for the workers to load.
+    """
+    if os.getenv('MODEL_WARMUP_ON_FORK') and not get_backend_class(current_app.config).preload_before_fork:
+        return False
+    get_model_version()
+    return get_model() is not None
+
+def warm_up_model():
+    """Run one dummy inference so the first real upload does not pay for it"""
+    model = get_model()
+    if model is None:
+        _model_state["error"] = "Model not available"
+        return False
+        
+    try:
+        started = time.monotonic()
+        size = current_app.config.get('MODEL_WARMUP_IMGSZ', 640)
+        dummy = np.zeros((size, size, 3), dtype=np.uint8)
+        model.predict(source=dummy, save=False, verbose=False)
+        _model_state["warm_up_seconds"] = round(time.monotonic() - started, 3)
+        _model_state["error"] = None
+        model_ready.set()
+        print(f" Model warm-up finished in {_model_state['warm_up_seconds']}s")
+        return True
+    except Exception as e:
+        _model_state["error"] = f"Warm-up error: {str(e)}"
+        print(f" Error warming up model: {e}")
+        return False
+
+def start_warm_up(app):
+    """Warm the model on a background thread of this (worker) process"""
+    threads = app.config.get('TORCH_THREADS')
+    # With MODEL_SERVER the server process owns the threads
+    if threads and get_backend_class(app.config).name == 'torch' and not app.config.get('MODEL_SERVER'):
+        import torch
+        torch.set_num_threads(threads)
+        
+    def run():
+        with app.app_context():
+            warm_up_model()
+    thread = threading.Thread(target=run, name="model-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def get_model_status():
+    if inference_queue.external:
+        # This web worker never loads the model; see flask inference-worker
+        return {"ready": True, "error": None, "warm_up_seconds": None, "inference": "external"}
+    return {
+        "ready": model_ready.is_set(),
+        "error": _model_state["error"],
+        "warm_up_seconds": _model_state["warm_up_seconds"]
+    }
+
+def get_threshold():
+    return current_app.config.get('DETECTION_THRESHOLD', 0.25)
+
+def get_postprocess_settings():
+    return postprocess_settings(current_app.config)
+
+def get_settings_key():
+    """Result cache key part for the settings besides the threshold, tiling included"""
+    return settings_fingerprint(get_postprocess_settings(), tiling_fingerprint(current_app.config))
+
+def get_store_threshold():
+    """Lowest confidence the model reports; boxes above it are stored for re-thresholding"""
+    return min(current_app.config.get('DETECTION_STORE_MIN_CONFIDENCE', 0.1),
+               lowest_threshold(get_postprocess_settings()))
+
+def decode_image(data):
+    """Decode image bytes held in memory into a BGR array, like cv2.imread does"""
+    import cv2
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def load_image(image):
+    """Accept a decoded array or a path on disk and return a BGR array"""
+    if image is None or isinstance(image, np.ndarray):
+        return image
+    import cv2
+    return cv2.imread(image)
+
+def write_file_async(key, data):
+    """Store bytes on the IO pool so the caller does not wait for the write"""
+    return io_executor.submit(storage.save, key, data)
+
+def predict_image(image):
     """Predict using YOLO model with error handling"""
     model = get_model()
     if model is None:
         return [], "Model not available"
         
     try:
-        img = cv2.imread(image_path)
+        img = load_image(image)
         if img is None:
             return [], "Failed to read image"
             
-        results = model.predict(source=img, save=False)
+        # High-resolution films are split into tiles, which are batched together
+        if tiling_enabled(current_app.config):
+            started = time.perf_counter()
+            results = predict_tiled(model, img, get_store_threshold(), tiling_settings(current_app.config))
+            inference_seconds.observe(time.perf_counter() - started)
+            return results, None
+            
+        # Concurrent callers share one batched forward pass when batching is on
+        if inference_batcher.enabled:
+            return [inference_batcher.predict(img)], None
+            
+        started = time.perf_counter()
+        results = model.predict(source=img, save=False, conf=get_store_threshold())
+        inference_seconds.observe(time.perf_counter() - started)
         return results, None
     except Exception as e:
         return [], f"Prediction error: {str(e)}"
 
-def draw_boxes_on_image(image_path, boxes, class_names=None):
+def predict_batch(images):
+    """Run one YOLO forward pass over a list of images, one Results per image"""
+    model = get_model()
+    started = time.perf_counter()
+    results = model.predict(source=images, save=False, conf=get_store_threshold())
+    inference_seconds.observe(time.perf_counter() - started)
+    return results
+
+def draw_boxes(img, predictions):
+    """Return a copy of img with the Detections drawn on it (box, class and confidence)"""
+    import cv2
+    # Draw on a copy so a shared decoded array stays untouched
+    img = img.copy()
+    for (x_min, y_min, x_max, y_max), label, confidence in zip(
+            predictions.xyxy.astype(int).tolist(), predictions.labels.tolist(), predictions.conf.tolist()):
+        cv2.rectangle(img, (x_min, y_min), (x_max, y_max), (0, 255, 0), 2)
+        cv2.putText(img, f"{label} {confidence:.2f}", (x_min, y_min - 10), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+    return img
+
+def draw_boxes_on_image(image, predictions):
     """Draw detection boxes on image"""
     try:
-        img = cv2.imread(image_path)
+        img = load_image(image)
         if img is None:
             return None
             
-        for box in boxes:
-            x_min, y_min, x_max, y_max = map(int, box.xyxy[0].tolist())
-            confidence = float(box.conf[0])
-            class_id = int(box.cls[0])
-            class_name = class_names[class_id] if class_names else "Object"
-            
-            cv2.rectangle(img, (x_min, y_min), (x_max, y_max), (0, 255, 0), 2)
-            cv2.putText(img, f"{class_name} {confidence:.2f}", (x_min, y_min - 10), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+        img = draw_boxes(img, predictions)
         
-        # Generate unique filename for processed image
-        filename = f"processed_{uuid.uuid4().hex}.jpg"
-        processed_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        cv2.imwrite(processed_path, img)
-        return processed_path
+        import cv2
+        ok, encoded = cv2.imencode('.jpg', img)
+        if not ok:
+            return None
+        # Store under a unique key for the processed image
+        key = processed_key()
+        storage.save(key, encoded.tobytes())
+        return key
     except Exception as e:
         print(f"Error drawing boxes: {e}")
         return None
 
+def run_detection(image, timer=None):
+    """Run YOLO on a decoded image (or a path) and draw the boxes, returning a detection summary"""
+    timer = timer or StageTimer()
+    with timer.stage('decode'):
+        img = load_image(image)
+    if img is None:
+        return None, "Failed to read image"
+        
+    with timer.stage('predict'):
+        results, error = predict_image(img)
+    if error:
+        return None, error
+        
+    # Process detection results
+    model = get_model()
+    with timer.stage('postprocess'):
+        settings = get_postprocess_settings()
+        boxes = postprocess(results, model.names if model else {}, settings)
+        detection_result, confidence_score, predictions = summarize(boxes, settings)
+    
+    # Draw boxes on the same decoded array instead of reading the file again;
+    # without stored processed images the overlay is drawn when viewed
+    processed_file_path = None
+    if results and current_app.config.get('STORE_PROCESSED_IMAGES', True):
+        with timer.stage('draw'):
+            processed_file_path = draw_boxes_on_image(img, predictions)
+    
+    return {
+        "detection_result": detection_result,
+        "confidence_score": confidence_score,
+        "processed_file_path": processed_file_path,
+        "predictions": predictions.as_dicts(),
+        "boxes": boxes
+    }, None
+
+def save_detections(upload_id, boxes, model_version):
+    """Bulk insert an upload's Detections (or prediction dicts) into the detection table (committed by the caller)"""
+    if not isinstance(boxes, Detections):
+        boxes = Detections.from_dicts(boxes)
+    if not len(boxes):
+        return
+    db.session.execute(insert(Detection), [{
+        "upload_id": upload_id,
+        "class_id": None if class_id < 0 else class_id,
+        "class_name": label,
+        "confidence": confidence,
+        "x1": x1,
+        "y1": y1,
+        "x2": x2,
+        "y2": y2,
+        "model_version": model_version
+    } for class_id, label, confidence, (x1, y1, x2, y2) in zip(
+        boxes.cls.tolist(), boxes.labels.tolist(), boxes.conf.tolist(), boxes.xyxy.tolist())])
+
+def copy_detections(upload_id, digest, model_version):
+    """Give a cache hit the stored boxes of an earlier upload of the same image"""
+    source = db.session.query(Detection.upload_id).join(Upload, Upload.id == Detection.upload_id).filter(
+        Upload.content_hash == digest, Detection.model_version == model_version).first()
+    if source is None:
+        return False
+    rows = db.session.query(*DETECTION_COLUMNS).filter(Detection.upload_id == source.upload_id).all()
+    save_detections(upload_id, Detections.from_rows(rows), model_version)
+    return True
+
+def add_cached_detections(upload_id, digest, model_version, predictions):
+    """Boxes for a cache hit: an earlier upload's full set, else the cached predictions"""
+    if not copy_detections(upload_id, digest, model_version):
+        save_detections(upload_id, predictions, model_version)
+
+# Detection columns in the order Detections.from_rows expects
+DETECTION_COLUMNS = (Detection.class_id, Detection.class_name, Detection.confidence,
+                     Detection.x1, Detection.y1, Detection.x2, Detection.y2)
+
+def threshold_settings(threshold=None):
+    """Post-processing settings for a requested threshold; None means the configured
+    threshold and per-class thresholds, an explicit value applies to every class"""
+    settings = get_postprocess_settings()
+    if threshold is None:
+        return settings
+    return dict(settings, threshold=threshold, class_thresholds={})
+
+def stored_boxes(upload, threshold=None, scale=1.0):
+    """The upload's stored Detections above threshold, best first, optionally scaled"""
+    settings = threshold_settings(threshold)
+    rows = db.session.query(*DETECTION_COLUMNS).filter(
+        Detection.upload_id == upload.id, Detection.confidence > lowest_threshold(settings)).all()
+    boxes = select(Detections.from_rows(rows).sorted(), settings)
+    return boxes.scaled(scale) if scale != 1.0 else boxes
+
+def overlay_key(upload, threshold=None):
+    """Name of a rendered overlay; the content hash guards against reused ids and
+    the model version against boxes replaced by a rescore"""
+    settings = threshold_settings(threshold)
+    fingerprint = thresholds_fingerprint(settings)
+    return (f"overlay_{upload.id}_{(upload.content_hash or 'legacy')[:12]}_"
+            f"{(upload.model_version or 'none')[:12]}_{settings['threshold']:g}"
+            + (f"_{fingerprint}" if fingerprint else ""))
+
+def render_overlay(upload, threshold=None):
+    """Redraw an upload's stored boxes above threshold on its original, as JPEG bytes"""
+    key = overlay_key(upload, threshold)
+    data = overlay_cache.get(key)
+    if data is not None:
+        return data
+    img = load_image(storage.local_path(upload.file_path))
+    if img is None:
+        return None
+    img = draw_boxes(img, stored_boxes(upload, threshold))
+    import cv2
+    ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        return None
+    data = encoded.tobytes()
+    overlay_cache.put(key, data, current_app.config.get('OVERLAY_CACHE_MAX_MB', 64) * 1024 * 1024)
+    return data
+
+def get_overlay_derivative(upload, size_name, threshold=None):
+    """Thumbnail/preview with the stored boxes drawn on it, cached with the other derivatives"""
+    target_path = os.path.join(current_app.config['DERIVATIVE_FOLDER'], size_name,
+                               f"{overlay_key(upload, threshold)}.jpg")
+    if os.path.exists(target_path):
+        os.utime(target_path)
+        return target_path
+    source = get_derivative(upload.file_path, size_name)
+    original_path = storage.local_path(upload.file_path)
+    if not source or not original_path:
+        return None
+    try:
+        import cv2
+        from PIL import Image
+        # Draw on the resized original, scaling the boxes to match
+        with Image.open(original_path) as original:
+            original_width = original.size[0]
+        img = cv2.imread(source)
+        img = draw_boxes(img, stored_boxes(upload, threshold, img.shape[1] / original_width))
+        ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        if not ok:
+            return None
+        # A *.tmp name, so eviction leaves the write in progress alone
+        write_atomic(target_path, encoded.tobytes())
+    except Exception as e:
+        print(f"Error creating {size_name} overlay for upload {upload.id}: {e}")
+        return None
+    evict_derivatives()
+    return target_path
+
+def get_processed_derivative(upload, size_name, threshold=None):
+    """Resized processed image, from the stored file or drawn from the stored boxes"""
+    if threshold is None and storage.exists(upload.processed_file_path):
+        return get_derivative(upload.processed_file_path, size_name)
+    if upload.status != 'done':
+        return None
+    return get_overlay_derivative(upload, size_name, threshold)
+
+def remove_overlays(upload):
+    """Drop the rendered overlay derivatives of a deleted upload"""
+    prefix = f"overlay_{upload.id}_"
+    for size_name in DERIVATIVE_SIZES:
+        folder = os.path.join(current_app.config['DERIVATIVE_FOLDER'], size_name)
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                if name.startswith(prefix):
+                    os.remove(os.path.join(folder, name))
+
+def pending_upload_ids(limit=None):
+    """Ids of uploads waiting for detection, oldest first"""
+    query = db.session.query(Upload.id).filter_by(status='pending').order_by(Upload.id)
+    if limit:
+        query = query.limit(limit)
+    return [upload_id for (upload_id,) in query]
+
+def reset_stale_uploads(lease_seconds):
+    """Put uploads running for longer than the lease (their process died mid-run) back to pending.
+
+    Returns the ids that were reset.
+    """
+    cutoff = datetime.now() - timedelta(seconds=lease_seconds)
+    upload_ids = [upload_id for (upload_id,) in db.session.query(Upload.id).filter(
+        Upload.status == 'running', Upload.started_at < cutoff)]
+    if upload_ids:
+        Upload.query.filter(Upload.id.in_(upload_ids), Upload.status == 'running').update(
+            {'status': 'pending', 'started_at': None}, synchronize_session=False)
+    db.session.commit()
+    return upload_ids
+
+def requeue_stranded_uploads(app):
+    """Queue uploads a previous process left behind, then keep reclaiming abandoned runs.
+
+    Jobs only live in memory, so a restart strands their rows: at start
+    every pending row is queued, and from then on running rows older than
+    INFERENCE_LEASE_SECONDS are reset and queued again. Every worker may do
+    this at once; each job claims its row atomically, so an upload still
+    runs only once.
+    """
+    lease = app.config.get('INFERENCE_LEASE_SECONDS', 600)
+
+    def run():
+        first = True
+        while True:
+            try:
+                with app.app_context():
+                    upload_ids = reset_stale_uploads(lease)
+                    if first:
+                        upload_ids = pending_upload_ids()
+                    db.session.remove()
+                for upload_id in upload_ids:
+                    inference_queue.submit(upload_id)
+                if upload_ids:
+                    print(f" Requeued {len(upload_ids)} stranded uploads")
+            except Exception as e:
+                print(f"Error requeueing stranded uploads: {e}")
+            first = False
+            time.sleep(min(60, lease))
+    thread = threading.Thread(target=run, name="upload-lease", daemon=True)
+    thread.start()
+    return thread
+
+def process_upload(upload_id, image_data=None, write_future=None):
+    """Run detection for a queued upload and store the outcome on its row.
+
+    When the request handed over the uploaded bytes they are decoded once
+    here; otherwise (e.g. a re-queued job) the original is read from storage.
+    """
+    # Claim the job atomically so it is never processed twice
+    claimed = Upload.query.filter_by(id=upload_id, status='pending').update(
+        {'status': 'running', 'started_at': datetime.now()})
+    db.session.commit()
+    if not claimed:
+        return
+        
+    upload = Upload.query.get(upload_id)
+    timer = StageTimer()
+    try:
+        if image_data is not None:
+            with timer.stage('decode'):
+                image = decode_image(image_data)
+        else:
+            image = storage.local_path(upload.file_path)
+        summary, error = run_detection(image, timer)
+        
+        # The original must be on disk before the result page links to it
+        if write_future is not None:
+            with timer.stage('write_original_wait'):
+                write_future.result()
+    except Exception as e:
+        summary, error = None, f"Unexpected error: {str(e)}"
+        
+    if error:
+        upload.status = 'failed'
+        upload.error_message = error
+        upload_errors_total.inc(reason='detection')
+    else:
+        upload.status = 'done'
+        upload.detection_result = summary['detection_result']
+        upload.confidence_score = summary['confidence_score']
+        upload.processed_file_path = summary['processed_file_path']
+        upload.predictions = json.dumps(summary['predictions'])
+        upload.model_version = get_model_version()
+        save_detections(upload.id, summary['boxes'], upload.model_version)
+    upload.finished_at = datetime.now()
+    with timer.stage('db_commit'):
+        upload.stage_timings = json.dumps(timer.as_dict())
+        db.session.commit()
+        
+    # Cache the result so duplicate uploads of this image skip inference
+    if not error and upload.content_hash:
+        with timer.stage('cache_store'):
+            store_detection(upload.content_hash, get_model_version(), get_threshold(), get_settings_key(), summary)
+            
+    # Thumbnails for the history page, made while the files are hot in the page cache
+    if not error and current_app.config.get('DERIVATIVES_AT_INGEST', True):
+        with timer.stage('thumbnails'):
+            get_derivative(upload.file_path, 'thumb')
+            get_processed_derivative(upload, 'thumb')
+    observe_stages(timer)
+
+def create_upload(image_data, original_filename, file_extension, admin_id, source='web'):
+    """Store an uploaded image and either reuse its cached result or queue detection.
+
+    Returns (upload, cached). Shared by the upload form and the JSON API.
+    """
+    uploads_total.inc(source=source)
+    # The disk write happens on the IO pool while the in-memory bytes go
+    # straight to the inference job
+    with span('hash'):
+        digest = content_hash(image_data)
+        file_path = content_path(digest, file_extension)
+    write_future = None
+    if not storage.exists(file_path):
+        write_future = write_file_async(file_path, image_data)
+    
+    # A duplicate image reuses the cached result and skips inference
+    with span('cache_lookup'):
+        cached = get_cached_detection(digest, get_model_version(), get_threshold(), get_settings_key())
+    detection_cache_total.inc(result='hit' if cached else 'miss')
+    if cached:
+        if write_future is not None:
+            with span('write_original'):
+                write_future.result()
+        now = datetime.now()
+        upload = Upload(
+            file_name=original_filename,
+            file_path=file_path,
+            content_hash=digest,
+            detection_result=cached.detection_result,
+            confidence_score=cached.confidence_score,
+            processed_file_path=cached.processed_file_path,
+            predictions=cached.predictions,
+            model_version=cached.model_version,
+            status='done',
+            upload_time=now,
+            started_at=now,
+            finished_at=now
+        )
+        with span('db_commit'):
+            db.session.add(upload)
+            db.session.flush()
+            add_cached_detections(upload.id, digest, cached.model_version, cached_summary(cached)['predictions'])
+            db.session.commit()
+        
+        # Log the action
+        with span('audit'):
+            log_action(admin_id, "upload_detection", f"Uploaded file: {original_filename}, Result: {cached.detection_result} (cached)")
+        return upload, True
+    
+    # A separate inference process reads the original from storage, so it
+    # must be written before the row it will pick up is committed
+    if inference_queue.external and write_future is not None:
+        with span('write_original'):
+            write_future.result()
+    
+    # Record the upload as pending; detection runs on the inference queue
+    upload = Upload(
+        file_name=original_filename,
+        file_path=file_path,
+        content_hash=digest,
+        status='pending',
+        upload_time=datetime.now()
+    )
+    with span('db_commit'):
+        db.session.add(upload)
+        db.session.commit()
+    inference_queue.submit(upload.id, image_data, write_future)
+    
+    # Log the action
+    with span('audit'):
+        log_action(admin_id, "upload_detection", f"Uploaded file: {original_filename}, queued for detection")
+    return upload, False
+
 @detection_bp.route('/upload', methods=['POST'])
 @login_required
+@admission_controlled
 def upload_file():
     try:
-        if 'file' not in request.files:
+        # Reading request.files parses (and spools) the multipart body
+        with span('parse'):
+            file = request.files.get('file')
+        if file is None:
+            upload_errors_total.inc(reason='no_file')
             flash("No file part in the request.", "danger")
             return redirect(url_for('index'))
             
-        file = request.files['file']
         if file.filename == '':
+            upload_errors_total.inc(reason='no_file')
             flash("No file selected.", "danger")
             return redirect(url_for('index'))
             
         if not allowed_file(file.filename):
+            upload_errors_total.inc(reason='extension')
             flash("Only JPG, JPEG and PNG files allowed.", "danger")
             return redirect(url_for('index'))
             
         # Additional validation
-        file_extension = validate_image(file.stream)
+        with span('validate'):
+            file_extension = validate_image(file.stream)
         if not file_extension:
+            upload_errors_total.inc(reason='invalid_image')
             flash("Invalid image file.", "danger")
             return redirect(url_for('index'))
             
-        # Secure the filename and generate unique name
+        # Secure the filename; the stored copy is named after its content
         original_filename = secure_filename(file.filename)
-        unique_filename = f"{int(time.time())}_{uuid.uuid4().hex}{file_extension}"
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
         
-        # Save the file
-        file.save(file_path)
+        # Read the upload once
+        with span('read'):
+            image_data = file.stream.read()
+        new_upload, cached = create_upload(image_data, original_filename, file_extension, session.get('admin_id'))
         
-        # Process image with YOLO
-        results, error = predict_image(file_path)
-        if error:
-            flash(f"Detection error: {error}", "danger")
-            return redirect(url_for('index'))
-            
-        # Process detection results
-        predictions = []
-        threshold = 0.25
-        model = get_model()
-        class_names = model.names if model else {}
-        
-        detection_result = "No foreign object detected"
-        confidence_score = 0.0
-        
-        for result in results:
-            for box in result.boxes:
-                if box.conf[0] > threshold:
-                    class_id = int(box.cls[0])
-                    class_name = class_names.get(class_id, "Unknown")
-                    conf = float(box.conf[0])
-                    predictions.append({
-                        "class": class_name,
-                        "confidence": conf,
-                        "coordinates": box.xyxy[0].tolist()
-                    })
-                    
-        if predictions:
-            # Sort by confidence and use highest confidence prediction
-            predictions.sort(key=lambda x: x['confidence'], reverse=True)
-            detection_result = predictions[0]['class']
-            confidence_score = predictions[0]['confidence']
-        
-        # Draw boxes on the image
-        processed_file_path = draw_boxes_on_image(file_path, results[0].boxes, class_names) if results else None
-        
-        # Save to database with SQLAlchemy
-        new_upload = Upload(
-            file_name=original_filename,
-            file_path=file_path,
-            detection_result=detection_result,
-            confidence_score=confidence_score,
-            processed_file_path=processed_file_path,
-            upload_time=datetime.now()
-        )
-        db.session.add(new_upload)
-        db.session.commit()
-        upload_id = new_upload.id
-        
-        # Log the action
-        admin_id = session.get('admin_id')
-        log_action(admin_id, "upload_detection", f"Uploaded file: {original_filename}, Result: {detection_result}")
-        
-        flash("Detection completed!", "success")
-        return redirect(url_for('detection.image_details', image_id=upload_id))
+        if cached:
+            flash("Detection completed! This image was analysed before, so the stored result was reused.", "success")
+        else:
+            flash("Image uploaded. Detection is in progress.", "success")
+        return redirect(url_for('detection.image_details', image_id=new_upload.id))
     except RequestEntityTooLarge:
+        upload_errors_total.inc(reason='too_large')
         flash("File too large. Maximum size is 16MB.", "danger")
         return redirect(url_for('index'))
     except Exception as e:
+        upload_errors_total.inc(reason='error')
         flash(f"Error processing file: {str(e)}", "danger")
         return redirect(url_for('index'))
 
+@detection_bp.route('/upload/<int:image_id>/status', methods=['GET'])
+@login_required
+def upload_status(image_id):
+    """Poll endpoint for the inference job of a single upload"""
+    upload = Upload.query.get(image_id)
+    if not upload:
+        return jsonify({"error": "Image not found"}), 404
+        
+    wait_seconds = run_seconds = None
+    if upload.started_at and upload.upload_time:
+        wait_seconds = (upload.started_at - upload.upload_time).total_seconds()
+    if upload.finished_at and upload.started_at:
+        run_seconds = (upload.finished_at - upload.started_at).total_seconds()
+        
+    return jsonify({
+        "id": upload.id,
+        "status": upload.status,
+        "detection_result": upload.detection_result,
+        "confidence_score": upload.confidence_score,
+        "error": upload.error_message,
+        "wait_seconds": wait_seconds,
+        "run_seconds": run_seconds,
+        "stage_timings": json.loads(upload.stage_timings) if upload.stage_timings else None
+    })
+
+@detection_bp.route('/jobs/stats', methods=['GET'])
+@login_required
+def job_stats():
+    """Queue depth, wait/run times and batching histograms of the inference path"""
+    # The database holds the queue state shared by all workers, the
+    # in-memory queue only describes this process
+    pending = Upload.query.filter_by(status='pending').count()
+    running = Upload.query.filter_by(status='running').count()
+    return jsonify({
+        "pending": pending,
+        "running": running,
+        "process": inference_queue.stats(),
+        "batching": inference_batcher.stats(),
+        "stages": stage_stats(),
+        "overlay_cache": overlay_cache.stats(),
+        "admission": admission.stats()
+    })
+
+@detection_bp.route('/upload/<int:image_id>/boxes', methods=['GET'])
+@login_required
+def upload_boxes(image_id):
+    """Stored boxes above a threshold, for drawing the overlay in the browser"""
+    upload = Upload.query.get(image_id)
+    if not upload:
+        return jsonify({"error": "Image not found"}), 404
+    threshold = request.args.get('threshold', type=float)
+    width = height = None
+    original_path = storage.local_path(upload.file_path)
+    if original_path:
+        from PIL import Image
+        # Only the header is read to get the size the coordinates refer to
+        with Image.open(original_path) as img:
+            width, height = img.size
+    return jsonify({
+        "id": upload.id,
+        "status": upload.status,
+        "threshold": get_threshold() if threshold is None else threshold,
+        "width": width,
+        "height": height,
+        "boxes": [{
+            "class": box["class"],
+            "confidence": box["confidence"],
+            "xyxy": box["coordinates"]
+        } for box in stored_boxes(upload, threshold).as_dicts()]
+    })
+
 @detection_bp.route('/history', methods=['GET'])
 @login_required
 def history():
-    page = request.args.get('page', 1, type=int)
-    per_page = 10
-    offset = (page - 1) * per_page
-    
-    total = Upload.query.count()
-    images = Upload.query.order_by(Upload.upload_time.desc()).limit(per_page).offset(offset).all()
+    try:
+        filters = parse_history_filters(request.args)
+        page = history_page(filters,
+                            after=request.args.get('after'),
+                            before=request.args.get('before'),
+                            limit=current_app.config.get('HISTORY_PAGE_SIZE', 10))
+    except ValueError:
+        flash("Invalid filters: dates must use YYYY-MM-DD and confidence must be a number.", "danger")
+        filters = {}
+        page = history_page(filters, limit=current_app.config.get('HISTORY_PAGE_SIZE', 10))
     
-    total_pages = (total + per_page - 1) // per_page
+    with span('render'):
+        return render_template('history.html', 
+                               images=page['items'], 
+                               filters=filters,
+                               total=page['total'],
+                               next_cursor=page['next_cursor'],
+                               prev_cursor=page['prev_cursor'])
+
+@detection_bp.route('/history/data')
+@login_required
+def history_data():
+    """History table as JSON, with the same filters and cursors as the page"""
+    limit = min(request.args.get('limit', current_app.config.get('HISTORY_PAGE_SIZE', 10), type=int), 100)
+    try:
+        filters = parse_history_filters(request.args)
+        page = history_page(filters,
+                            after=request.args.get('after'),
+                            before=request.args.get('before'),
+                            limit=max(limit, 1))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    return render_template('history.html', 
-                           images=images, 
-                           page=page, 
-                           total_pages=total_pages)
+    page['items'] = [serialize_upload(upload) for upload in page['items']]
+    return jsonify(page)
 
 @detection_bp.route('/view_image/<int:image_id>/<string:image_type>')
 @login_required
 def view_image(image_id, image_type):
     upload = Upload.query.get(image_id)
     if upload:
-        if image_type == 'original':
-            file_path = upload.file_path
-        else:
-            file_path = upload.processed_file_path
-        if file_path and os.path.exists(file_path):
-            return send_file(file_path, mimetype='image/jpeg')
+        return send_upload_image(upload, image_type, request.args.get('size'),
+                                 request.args.get('threshold', type=float))
     return "Image not found", 404
 
+# Browser cache lifetime of URLs whose content can never change
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+@detection_bp.app_template_global()
+def image_version(upload):
+    """Version token for original image URLs (?v=); the stored original never changes"""
+    if upload.content_hash:
+        return upload.content_hash[:16]
+    if upload.file_path:
+        return os.path.splitext(os.path.basename(upload.file_path))[0]
+    return None
+
+def send_upload_image(upload, image_type, size=None, threshold=None):
+    """Serve the original or processed image of an upload, optionally resized.
+
+    The processed image is redrawn from the stored boxes when there is no
+    stored processed file or a threshold is given, so any threshold can be
+    viewed without running the model again.
+    """
+    if image_type == 'original':
+        file_ref = upload.file_path
+        etag = upload.content_hash or os.path.basename(file_ref or '')
+        # Only a URL naming the content version is safe to cache forever;
+        # ids can be reused after a delete
+        version = image_version(upload)
+        immutable = version is not None and request.args.get('v') == version
+    else:
+        file_ref = upload.processed_file_path
+        if threshold is not None or not storage.exists(file_ref):
+            return send_overlay(upload, size, threshold)
+        # Processed files get a new name whenever they are redrawn
+        etag = os.path.basename(file_ref)
+        immutable = False
+    if not file_ref:
+        return "Image not found", 404
+    if size in DERIVATIVE_SIZES:
+        return send_derivative(file_ref, size, image_last_modified(upload), immutable)
+    return send_image_file(storage.local_path(file_ref), etag, immutable=immutable,
+                           last_modified=image_last_modified(upload))
+
+def image_last_modified(upload):
+    """Last-Modified of an upload's images; they are written once, by the time
+    detection finishes, and no stat (a round trip on S3) is needed"""
+    return (upload.finished_at or upload.upload_time).timestamp()
+
+def send_overlay(upload, size, threshold=None):
+    """Serve boxes drawn over the original, answering revalidations before rendering"""
+    if upload.status != 'done' or not upload.file_path:
+        return "Image not found", 404
+    etag = f"{size or 'full'}-{overlay_key(upload, threshold)}"
+    if etag in request.if_none_match:
+        return send_cached_image(None, etag, image_last_modified(upload), not_modified=True)
+    if size in DERIVATIVE_SIZES:
+        image = get_overlay_derivative(upload, size, threshold)
+    else:
+        data = render_overlay(upload, threshold)
+        image = io.BytesIO(data) if data is not None else None
+    if image is None:
+        return "Image not found", 404
+    return send_cached_image(image, etag, image_last_modified(upload))
+
+def send_derivative(file_ref, size, last_modified, immutable=False):
+    """Serve a cached thumbnail/preview that browsers can revalidate cheaply"""
+    derivative = get_derivative(file_ref, size)
+    if not derivative:
+        return "Image not found", 404
+        
+    # Derivative names are unique per stored file and never rewritten, so the
+    # name is a stable ETag (the derivative's own mtime is bumped on every use
+    # for LRU eviction, so it cannot be the Last-Modified)
+    return send_image_file(derivative, f"{size}-{os.path.basename(derivative)}", immutable=immutable,
+                           last_modified=last_modified, mimetype='image/jpeg')
+
+def accel_redirect_path(file_path):
+    """Internal nginx URI of a file under IMAGE_ACCEL_ROOT, or None to serve it here"""
+    if current_app.config.get('IMAGE_SENDFILE') != 'x-accel':
+        return None
+    root = os.path.abspath(current_app.config['IMAGE_ACCEL_ROOT'])
+    path = os.path.abspath(file_path)
+    if os.path.commonpath([root, path]) != root:
+        return None
+    relative = os.path.relpath(path, root).replace(os.sep, '/')
+    return current_app.config['IMAGE_ACCEL_PREFIX'].rstrip('/') + '/' + urllib.parse.quote(relative)
+
+def send_image_file(file_path, etag, immutable=False, last_modified=None, mimetype=None):
+    """Serve a stored image with a strong ETag and Range support.
+
+    Revalidations are answered here with a 304. With IMAGE_SENDFILE set the
+    bytes are left to the front proxy (X-Accel-Redirect or X-Sendfile), so
+    the worker never streams the file itself.
+    """
+    try:
+        stat = os.stat(file_path)
+    except (OSError, TypeError):
+        return "Image not found", 404
+    last_modified = last_modified or stat.st_mtime
+    if request.if_none_match.contains(etag):
+        return send_cached_image(None, etag, last_modified, not_modified=True, immutable=immutable)
+
+    # PNG originals keep their own type; everything we generate is JPEG
+    mimetype = mimetype or mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    accel_path = accel_redirect_path(file_path)
+    if accel_path:
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel_path
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return cache_image_response(response, immutable)
+    # send_file handles If-Modified-Since and Range, and X-Sendfile via USE_X_SENDFILE
+    response = send_cached_image(file_path, etag, last_modified, immutable=immutable, mimetype=mimetype)
+    response.accept_ranges = 'bytes'
+    return response
+
+def cache_image_response(response, immutable=False):
+    # send_file marks responses without a max_age as no-cache
+    response.cache_control.no_cache = None
+    if immutable:
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = current_app.config.get('DERIVATIVE_MAX_AGE', 3600)
+    # Images are behind the login, so only the browser may cache them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+def send_cached_image(image, etag, last_modified, not_modified=False, immutable=False, mimetype='image/jpeg'):
+    """Send an image (path or file object) with validators browsers can revalidate"""
+    if not_modified:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+    else:
+        response = send_file(
+            image,
+            mimetype=mimetype,
+            etag=etag,
+            last_modified=last_modified,
+            conditional=True
+        )
+    return cache_image_response(response, immutable)
+
 @detection_bp.route('/image/<int:image_id>')
 @login_required
 def image_details(image_id):
@@ -253,11 +944,14 @@ def image_details(image_id):
         return render_template(
             'result.html',
             image_id=upload.id,
+            image_version=image_version(upload),
             file_name=upload.file_name,
             detection_result=upload.detection_result,
             confidence_score=upload.confidence_score,
             upload_time=upload.upload_time.strftime("%Y-%m-%d %H:%M:%S"),
-            remarks=upload.remarks
+            remarks=upload.remarks,
+            status=upload.status,
+            error_message=upload.error_message
         )
     else:
         flash("Image not found", "danger")
@@ -293,16 +987,23 @@ def save_remarks():
 def delete_image(image_id):
     upload = Upload.query.get(image_id)
     if upload:
-        # Delete files from filesystem
-        if upload.file_path and os.path.exists(upload.file_path):
-            os.remove(upload.file_path)
-        if upload.processed_file_path and os.path.exists(upload.processed_file_path):
-            os.remove(upload.processed_file_path)
+        file_path = upload.file_path
+        processed_file_path = upload.processed_file_path
         
-        # Delete from database
+        # Delete from database; cached results go too once no upload of
+        # the same image is left
+        Detection.query.filter_by(upload_id=upload.id).delete()
+        remove_overlays(upload)
         db.session.delete(upload)
+        if upload.content_hash and not Upload.query.filter(
+                Upload.content_hash == upload.content_hash, Upload.id != upload.id).first():
+            DetectionCache.query.filter_by(content_hash=upload.content_hash).delete()
         db.session.commit()
         
+        # Delete files from filesystem unless another upload shares them
+        remove_unreferenced_file(file_path)
+        remove_unreferenced_file(processed_file_path)
+        
         # Log the action
         admin_id = session.get('admin_id')
         log_action(admin_id, "delete_image", f"Deleted image ID: {image_id}")
@@ -0,0 +1,50 @@
+import gc
+import os
+
+# Tell app.py to leave the warm-up inference to the forked workers
+os.environ.setdefault('MODEL_WARMUP_ON_FORK', 'true')
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+
+# Import the app (and load the model weights) once in the master so the
+# workers share them copy-on-write
+preload_app = True
+
+def when_ready(server):
+    # Move everything loaded so far out of the GC's reach; otherwise the
+    # first collection in each worker touches every object and un-shares
+    # the pages copied from the master
+    gc.freeze()
+
+def post_fork(server, worker):
+    from app import app
+    from database import db
+    from detection import start_warm_up, requeue_stranded_uploads
+    from report import requeue_report_jobs
+
+    # Never share database connections opened by the master with a child
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    # Reports left pending or running when the previous workers stopped
+    requeue_report_jobs(app)
+
+    # Web workers of a split deployment leave the model to flask inference-worker
+    if app.config['INFERENCE_PROCESS'] == 'external':
+        return
+
+    # Split the cores between workers instead of every worker using them all
+    if not app.config.get('TORCH_THREADS'):
+        app.config['TORCH_THREADS'] = max(1, (os.cpu_count() or 1) // server.num_workers)
+    start_warm_up(app)
+
+    # Uploads left pending or running when the previous workers stopped
+    requeue_stranded_uploads(app)
+
+def worker_exit(server, worker):
+    # Write audit entries still buffered in this worker before it goes away
+    from audit import audit_log
+    audit_log.flush()
@@ -0,0 +1,177 @@
+from flask import current_app
+from sqlalchemy import and_, or_, inspect, text
+from datetime import datetime, timedelta
+import base64
+import json
+import re
+import threading
+import time
+from database import db, Upload
+from metrics import span
+
+NO_DETECTION = "No foreign object detected"
+
+_count_cache = {}
+_count_lock = threading.Lock()
+_fts_available = None
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+def parse_history_filters(args):
+    """Read the history/report filters from request args, validating each one.
+
+    Raises ValueError for malformed values so the caller can report them.
+    """
+    filters = {}
+    for key in ('start_date', 'end_date'):
+        value = (args.get(key) or '').strip()
+        if value:
+            # Validate early so a typo fails the request, not a background job
+            parse_date(value)
+            filters[key] = value
+    result = (args.get('result') or '').strip()
+    if result and result != 'all':
+        filters['result'] = result
+    for key in ('min_confidence', 'max_confidence'):
+        value = (args.get(key) or '').strip()
+        if value:
+            filters[key] = float(value)
+    if (args.get('has_remarks') or '').strip().lower() in ('1', 'true', 'yes', 'on'):
+        filters['has_remarks'] = True
+    search = (args.get('q') or '').strip()
+    if search:
+        filters['q'] = search
+    return filters
+
+def fts_available():
+    """True once the upload_fts index from the search migration exists"""
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = inspect(db.engine).has_table('upload_fts')
+    return _fts_available
+
+def fts_query(search):
+    """Turn free text into an FTS5 prefix query, quoting each term"""
+    terms = re.findall(r'\w+', search)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def filter_uploads(query, filters):
+    """Apply parsed filters to an Upload query"""
+    if 'start_date' in filters:
+        query = query.filter(Upload.upload_time >= parse_date(filters['start_date']))
+    if 'end_date' in filters:
+        query = query.filter(Upload.upload_time < parse_date(filters['end_date']) + timedelta(days=1))
+    result = filters.get('result')
+    if result == 'positive':
+        query = query.filter(Upload.detection_result.isnot(None), Upload.detection_result != NO_DETECTION)
+    elif result == 'negative':
+        query = query.filter(Upload.detection_result == NO_DETECTION)
+    elif result:
+        query = query.filter(Upload.detection_result == result)
+    if 'min_confidence' in filters:
+        query = query.filter(Upload.confidence_score >= filters['min_confidence'])
+    if 'max_confidence' in filters:
+        query = query.filter(Upload.confidence_score <= filters['max_confidence'])
+    if filters.get('has_remarks'):
+        query = query.filter(Upload.remarks.isnot(None), Upload.remarks != '')
+    search = filters.get('q')
+    if search:
+        match = fts_query(search)
+        if match and db.engine.dialect.name == 'sqlite' and fts_available():
+            ids = text("SELECT rowid FROM upload_fts WHERE upload_fts MATCH :match").bindparams(match=match)
+            query = query.filter(Upload.id.in_(ids))
+        else:
+            query = query.filter(Upload.file_name.ilike(f"%{search}%"))
+    return query
+
+def encode_cursor(upload):
+    """Opaque cursor pointing at an upload's (upload_time, id) key"""
+    raw = json.dumps([upload.upload_time.isoformat(), upload.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        upload_time, upload_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(upload_time), int(upload_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def count_uploads(filters):
+    """Total for a filter set, cached for HISTORY_COUNT_TTL seconds.
+
+    Counting every matching row is the expensive part of a history page, and
+    an approximate total is good enough for "N results".
+    """
+    key = json.dumps(filters, sort_keys=True)
+    ttl = current_app.config.get('HISTORY_COUNT_TTL', 30)
+    now = time.monotonic()
+    with _count_lock:
+        cached = _count_cache.get(key)
+        if cached and now - cached[1] < ttl:
+            return cached[0]
+
+    total = filter_uploads(Upload.query, filters).order_by(None).count()
+    with _count_lock:
+        # Keep the cache bounded by dropping expired entries as new ones arrive
+        for stale in [k for k, (_, at) in _count_cache.items() if now - at >= ttl]:
+            del _count_cache[stale]
+        _count_cache[key] = (total, now)
+    return total
+
+def history_page(filters, after=None, before=None, limit=10):
+    """One page of uploads, newest first, using keyset pagination.
+
+    `after` continues past a cursor towards older uploads and `before` goes
+    back towards newer ones; neither needs to skip over earlier rows, so deep
+    pages cost the same as the first one.
+    """
+    query = filter_uploads(Upload.query, filters)
+    if before:
+        upload_time, upload_id = decode_cursor(before)
+        query = query.filter(or_(Upload.upload_time > upload_time,
+                                 and_(Upload.upload_time == upload_time, Upload.id > upload_id)))
+        with span('query'):
+            rows = query.order_by(Upload.upload_time.asc(), Upload.id.asc()).limit(limit + 1).all()
+        has_newer = len(rows) > limit
+        items = list(reversed(rows[:limit]))
+        has_older = True
+    else:
+        if after:
+            upload_time, upload_id = decode_cursor(after)
+            query = query.filter(or_(Upload.upload_time < upload_time,
+                                     and_(Upload.upload_time == upload_time, Upload.id < upload_id)))
+        with span('query'):
+            rows = query.order_by(Upload.upload_time.desc(), Upload.id.desc()).limit(limit + 1).all()
+        has_older = len(rows) > limit
+        items = rows[:limit]
+        has_newer = after is not None
+
+    with span('count'):
+        total = count_uploads(filters)
+    return {
+        "items": items,
+        "next_cursor": encode_cursor(items[-1]) if items and has_older else None,
+        "prev_cursor": encode_cursor(items[0]) if items and has_newer else None,
+        "total": total
+    }
+
+def has_processed_image(upload):
+    """Whether the processed image can be served: a stored file, or an
+    overlay drawn from the stored boxes once detection is done"""
+    return bool(upload.processed_file_path) or upload.status == 'done'
+
+def serialize_upload(upload):
+    """JSON view of an upload as shown in the history table"""
+    return {
+        "id": upload.id,
+        "file_name": upload.file_name,
+        "status": upload.status,
+        "detection_result": upload.detection_result,
+        "confidence_score": upload.confidence_score,
+        "remarks": upload.remarks,
+        "upload_time": upload.upload_time.isoformat() if upload.upload_time else None,
+        "has_processed": has_processed_image(upload)
+    }
@@ -0,0 +1,106 @@
+import queue
+import threading
+import time
+from metrics import Histogram
+
+class InferenceQueue:
+    """In-process job queue that runs detection for uploads on background workers.
+
+    Workers are started lazily on the first submit so that every forked
+    gunicorn worker gets its own threads instead of inheriting dead ones.
+    With INFERENCE_PROCESS=external nothing runs here: the pending row in
+    the database is the job, and `flask inference-worker` picks it up.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.handler = None
+        self.num_workers = 1
+        self.external = False
+        self._queue = queue.Queue()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self._done = {}
+        self._done_lock = threading.Lock()
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+        self.completed = 0
+        self.failed = 0
+
+    def init_app(self, app, handler):
+        self.app = app
+        self.handler = handler
+        self.num_workers = max(1, app.config.get('INFERENCE_WORKERS', 1))
+        self.external = app.config.get('INFERENCE_PROCESS', 'local') == 'external'
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._worker, name=f"inference-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, upload_id, *args):
+        """Queue an upload id (plus optional handler arguments) and return immediately"""
+        if self.external:
+            return
+        self._ensure_started()
+        with self._done_lock:
+            self._done.setdefault(upload_id, threading.Event())
+        self._queue.put((upload_id, args, time.monotonic()))
+
+    def wait(self, upload_id, timeout):
+        """Block until a job queued in this process finishes; True if it did, None if it is not queued here"""
+        with self._done_lock:
+            done = self._done.get(upload_id)
+        if done is None:
+            return None
+        return done.wait(max(0.0, timeout))
+
+    def _worker(self):
+        while True:
+            upload_id, args, enqueued_at = self._queue.get()
+            started_at = time.monotonic()
+            self.wait_time.observe(started_at - enqueued_at)
+            with self._active_lock:
+                self._active += 1
+            try:
+                with self.app.app_context():
+                    self.handler(upload_id, *args)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error processing upload {upload_id}: {e}")
+            finally:
+                self.run_time.observe(time.monotonic() - started_at)
+                with self._active_lock:
+                    self._active -= 1
+                with self._done_lock:
+                    done = self._done.pop(upload_id, None)
+                if done is not None:
+                    done.set()
+                self._queue.task_done()
+
+    def drain(self):
+        """Block until every queued job has been processed"""
+        self._queue.join()
+
+    def stats(self):
+        return {
+            'external': self.external,
+            'workers': self.num_workers,
+            'queue_depth': self._queue.qsize(),
+            'active': self._active,
+            'completed': self.completed,
+            'failed': self.failed,
+            'wait_time_seconds': self.wait_time.snapshot(),
+            'run_time_seconds': self.run_time.snapshot()
+        }
+
+inference_queue = InferenceQueue()
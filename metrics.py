@@ -0,0 +1,214 @@
+from flask import g, request, has_request_context
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Default latency buckets in seconds, tuned for CPU inference on X-ray images
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Finer buckets for web requests and the stages inside them
+REQUEST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Thread-safe cumulative histogram for latency style measurements"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+
+        # Report cumulative counts per upper bound, like Prometheus does
+        cumulative = {}
+        running = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            running += bucket_count
+            cumulative[str(bound)] = running
+        cumulative['+Inf'] = count
+        return {
+            'count': count,
+            'sum': round(total, 6),
+            'avg': round(total / count, 6) if count else 0.0,
+            'buckets': cumulative
+        }
+
+class StageTimer:
+    """Accumulates wall-clock time per named stage of one pipeline run"""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def as_dict(self):
+        return {name: round(seconds, 6) for name, seconds in self.stages.items()}
+
+class Counter:
+    """Thread-safe counter, optionally split by a fixed set of label names"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        COUNTERS.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(dict(zip(self.labels, key)), value) for key, value in sorted(items)]
+
+    def family(self):
+        return self.name, 'counter', self.help_text, self.samples()
+
+COUNTERS = []
+
+uploads_total = Counter('xray_uploads_total', 'Images accepted for detection', ('source',))
+upload_errors_total = Counter('xray_upload_errors_total', 'Rejected uploads and failed detections', ('reason',))
+detection_cache_total = Counter('xray_detection_cache_lookups_total', 'Detection result cache lookups', ('result',))
+reports_total = Counter('xray_reports_total', 'PDF reports generated', ('kind', 'status'))
+http_requests_total = Counter('xray_http_requests_total', 'HTTP requests served', ('endpoint', 'method', 'status'))
+
+# Time spent in the model's forward pass, whether batched or not
+inference_seconds = Histogram()
+
+def _histogram_for(store, key, buckets=LATENCY_BUCKETS):
+    histogram = store.get(key)
+    if histogram is None:
+        with _stage_lock:
+            histogram = store.setdefault(key, Histogram(buckets))
+    return histogram
+
+# Per-stage latency histograms shared by every pipeline in this process
+stage_histograms = {}
+# Request latency per endpoint, and per (endpoint, stage) for timed spans
+request_histograms = {}
+request_stage_histograms = {}
+_stage_lock = threading.Lock()
+
+def observe_stages(timer):
+    """Fold the stages of a finished StageTimer into the process-wide histograms"""
+    for name, seconds in timer.stages.items():
+        _histogram_for(stage_histograms, name).observe(seconds)
+
+def stage_stats():
+    return {name: histogram.snapshot() for name, histogram in sorted(stage_histograms.items())}
+
+def request_timer():
+    """StageTimer of the current request; a throwaway one outside a request"""
+    if has_request_context():
+        timer = g.get('request_timer')
+        if timer is not None:
+            return timer
+    return StageTimer()
+
+def span(name):
+    """Time a stage of the current request, e.g. `with span('validate'):`"""
+    return request_timer().stage(name)
+
+class RequestMetrics:
+    """Counts and times every request, including the spans recorded inside it.
+
+    The stage breakdown can be returned in a Server-Timing header
+    (SERVER_TIMING) and printed for slow requests (REQUEST_TIMING_LOG).
+    """
+
+    def __init__(self):
+        self.server_timing = False
+        self.log_timing = False
+        self.log_min_seconds = 0.0
+
+    def init_app(self, app):
+        self.server_timing = app.config.get('SERVER_TIMING', False)
+        self.log_timing = app.config.get('REQUEST_TIMING_LOG', False)
+        self.log_min_seconds = app.config.get('REQUEST_TIMING_LOG_MIN_MS', 0) / 1000.0
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        g.request_started = time.perf_counter()
+        g.request_timer = StageTimer()
+
+    def _after_request(self, response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        total = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        http_requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        _histogram_for(request_histograms, endpoint, REQUEST_BUCKETS).observe(total)
+
+        stages = g.request_timer.stages
+        for name, seconds in stages.items():
+            _histogram_for(request_stage_histograms, (endpoint, name), REQUEST_BUCKETS).observe(seconds)
+        if self.server_timing:
+            timings = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in stages.items()]
+            response.headers['Server-Timing'] = ', '.join(timings + [f"total;dur={total * 1000:.2f}"])
+        if self.log_timing and total >= self.log_min_seconds:
+            breakdown = ' '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in stages.items())
+            print(f" {request.method} {request.path} {response.status_code} {total * 1000:.1f}ms {breakdown}")
+        return response
+
+request_metrics = RequestMetrics()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+def histogram_family(name, help_text, histograms, label_names):
+    """Family for a dict of histograms keyed by one label value or a tuple of them"""
+    samples = []
+    for key, histogram in sorted(histograms.items()):
+        values = key if isinstance(key, tuple) else (key,)
+        samples.append((dict(zip(label_names, values)), histogram))
+    return name, 'histogram', help_text, samples
+
+def prometheus_text(families):
+    """Render (name, type, help, samples) families in the Prometheus text format.
+
+    Samples are (labels, value) pairs; a Histogram value is expanded into its
+    _bucket, _sum and _count series.
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if kind != 'histogram':
+                lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            snapshot = value.snapshot()
+            for bound, count in snapshot['buckets'].items():
+                lines.append(f"{name}_bucket{_labels(dict(labels, le=bound))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {snapshot['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {snapshot['count']}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,394 @@
+"""Local model server shared by every gunicorn worker.
+
+With MODEL_SERVER enabled, get_model() returns a ModelServerClient instead
+of loading the weights in each worker. One server process holds the model
+and the whole CPU thread budget; workers copy decoded images into a
+shared memory segment and send only a small JSON header over a Unix
+socket, and the boxes come back over the same socket.
+
+    flask model-server          # foreground, e.g. under systemd or compose
+    python -m model_server      # what workers spawn when MODEL_SERVER_AUTOSTART is on
+"""
+from flask import current_app
+from multiprocessing import resource_tracker, shared_memory
+import click
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+import weakref
+import numpy as np
+from backends import Boxes, Result, as_numpy_boxes, create_backend, get_backend_class
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HEADER = struct.Struct('!I')
+
+class ModelServerError(RuntimeError):
+    pass
+
+def send_message(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def recv_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.recv(size - len(data)) if hasattr(stream, 'recv') else stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recv_message(stream):
+    """Next length-prefixed JSON message, or None once the peer has closed"""
+    header = recv_exactly(stream, HEADER.size)
+    if header is None:
+        return None
+    data = recv_exactly(stream, HEADER.unpack(header)[0])
+    return None if data is None else json.loads(data)
+
+def attach_segment(name):
+    """Open a worker's segment without handing it to this process's resource tracker.
+
+    The tracker would unlink segments it knows about when the server exits,
+    pulling them from under workers that keep using them after a restart.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+# The config a server needs; MODEL_SERVER_CONFIG ends up in the server's
+# environment, so secrets such as SECRET_KEY or DATABASE_URL are left out
+SERVER_KEYS = ('INFERENCE_BACKEND', 'MODEL_PATH', 'ONNX_MODEL_PATH', 'OPENVINO_MODEL_PATH', 'MODEL_IMGSZ',
+               'MODEL_WARMUP_IMGSZ', 'ONNX_INTRA_OP_THREADS', 'DETECTION_THRESHOLD', 'INFERENCE_BATCHING',
+               'INFERENCE_MAX_BATCH_SIZE', 'INFERENCE_MAX_WAIT_MS', 'INFERENCE_TILING', 'INFERENCE_TILE_SIZE',
+               'INFERENCE_TILE_OVERLAP', 'INFERENCE_TILE_BATCH', 'INFERENCE_TILE_MERGE_IOU', 'INFERENCE_COARSE_CONF',
+               'MODEL_SERVER_SOCKET')
+
+def server_settings(config):
+    """The inference settings passed to a spawned server through MODEL_SERVER_CONFIG"""
+    settings = {key: config[key] for key in SERVER_KEYS if key in config}
+    settings['TORCH_THREADS'] = config.get('MODEL_SERVER_THREADS') or os.cpu_count() or 1
+    return settings
+
+def close_segment(segment):
+    if segment is None:
+        return
+    try:
+        segment.close()
+    except BufferError:
+        # A view is still referenced (e.g. by the predictor); the mapping goes with it
+        pass
+
+def release_segment(segment):
+    """Close and remove a segment this process created"""
+    close_segment(segment)
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+# --- Server ---------------------------------------------------------------
+
+class ModelRequestHandler(socketserver.BaseRequestHandler):
+    """One connection per worker thread; requests on it are answered in order"""
+
+    def handle(self):
+        segment = None
+        try:
+            while True:
+                message = recv_message(self.request)
+                if message is None:
+                    break
+                if message.get('op') == 'info':
+                    send_message(self.request, self.server.info())
+                    continue
+                images = []
+                try:
+                    # A worker keeps one segment per thread and only replaces it to grow it
+                    if segment is None or segment.name != message['shm']:
+                        close_segment(segment)
+                        segment = None
+                        segment = attach_segment(message['shm'])
+                    images = [np.ndarray(tuple(shape), dtype=np.uint8, buffer=segment.buf, offset=offset)
+                              for offset, shape in message['images']]
+                    reply = {'results': self.server.predict(images, message['conf'])}
+                except Exception as e:
+                    reply = {'error': f"{type(e).__name__}: {e}"}
+                del images
+                send_message(self.request, reply)
+        except OSError:
+            pass
+        finally:
+            close_segment(segment)
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Owns the backend; a single inference thread runs everything the workers send.
+
+    Requests that arrive while a forward pass runs are merged into the next
+    one (up to INFERENCE_MAX_BATCH_SIZE images), so batching now spans all
+    workers instead of each worker batching only its own threads.
+    """
+    daemon_threads = True
+    # Every worker thread may connect at once, e.g. right after a restart
+    request_queue_size = 128
+
+    def __init__(self, socket_path, backend, config):
+        self.backend = backend
+        self.names = backend.names
+        self.max_batch_size = max(1, config.get('INFERENCE_MAX_BATCH_SIZE', 8)) if config.get('INFERENCE_BATCHING') else 1
+        self.max_wait = config.get('INFERENCE_MAX_WAIT_MS', 20) / 1000.0
+        self.jobs = queue.Queue()
+        self.served = 0
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, ModelRequestHandler)
+        os.chmod(socket_path, 0o660)
+        threading.Thread(target=self._run, name="model-server-inference", daemon=True).start()
+
+    def info(self):
+        return {'pid': os.getpid(), 'backend': self.backend.name, 'served': self.served,
+                'names': {str(key): value for key, value in self.names.items()}}
+
+    def predict(self, images, conf):
+        job = {'images': images, 'conf': conf, 'done': threading.Event(), 'results': None, 'error': None}
+        self.jobs.put(job)
+        job['done'].wait()
+        if job['error']:
+            raise job['error']
+        return job['results']
+
+    def _gather(self):
+        jobs = [self.jobs.get()]
+        count = len(jobs[0]['images'])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch_size:
+            try:
+                job = self.jobs.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            jobs.append(job)
+            count += len(job['images'])
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._gather() if self.max_batch_size > 1 else [self.jobs.get()]
+            # One forward pass per confidence threshold among the gathered jobs
+            for conf in sorted({job['conf'] for job in jobs}):
+                group = [job for job in jobs if job['conf'] == conf]
+                try:
+                    images = [image for job in group for image in job['images']]
+                    results = self.backend.predict(source=images, save=False, conf=conf, verbose=False)
+                    encoded = [encode_result(result) for result in results]
+                    del images, results
+                    start = 0
+                    for job in group:
+                        job['results'] = encoded[start:start + len(job['images'])]
+                        start += len(job['images'])
+                except Exception as e:
+                    for job in group:
+                        job['error'] = e
+                for job in group:
+                    job['images'] = None
+                    job['done'].set()
+                self.served += len(group)
+
+def encode_result(result):
+    boxes = as_numpy_boxes(result.boxes)
+    return {'xyxy': boxes.xyxy.tolist(), 'conf': boxes.conf.tolist(), 'cls': boxes.cls.tolist(),
+            'orig_shape': list(result.orig_shape)}
+
+def serve(config, socket_path):
+    """Load the backend and answer predictions until SIGTERM"""
+    threads = config.get('TORCH_THREADS')
+    if threads and get_backend_class(config).name == 'torch':
+        import torch
+        torch.set_num_threads(threads)
+    backend = create_backend(config)
+    # Warm up before accepting connections; workers wait for the socket
+    size = config.get('MODEL_WARMUP_IMGSZ', 640)
+    backend.predict(source=np.zeros((size, size, 3), dtype=np.uint8), save=False, verbose=False)
+
+    os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+    server = ModelServer(socket_path, backend, config)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print(f" Model server ({backend.name}, {threads} threads) listening on {socket_path}, pid {os.getpid()}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+# --- Client ---------------------------------------------------------------
+
+class ModelServerClient:
+    """Inference backend that forwards predict() to the model server.
+
+    Each calling thread keeps its own connection and shared memory segment,
+    reused until an image does not fit. If the server is gone (crashed,
+    killed, not started yet) it is spawned again and the request retried
+    once; a request that takes longer than MODEL_SERVER_TIMEOUT fails.
+    """
+    name = 'model-server'
+    preload_before_fork = False
+
+    def __init__(self, config):
+        self.socket_path = config['MODEL_SERVER_SOCKET']
+        self.timeout = config.get('MODEL_SERVER_TIMEOUT', 30)
+        self.start_timeout = config.get('MODEL_SERVER_START_TIMEOUT', 120)
+        self.autostart = config.get('MODEL_SERVER_AUTOSTART', True)
+        self.settings = server_settings(config)
+        self.weights_path = get_backend_class(config).weights_file(config)
+        self._names = None
+        self._local = threading.local()
+        self._process = None
+        self._spawn_lock = threading.Lock()
+
+    @property
+    def names(self):
+        if self._names is None:
+            info = self._call({'op': 'info'})
+            self._names = {int(key): value for key, value in info['names'].items()}
+        return self._names
+
+    def predict(self, source, conf=0.25, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        images = [np.asarray(image, dtype=np.uint8) for image in images]
+        reply = self._call({'conf': conf}, images)
+        names = self.names
+        return [Result(Boxes(np.asarray(item['xyxy']).reshape(-1, 4), item['conf'], item['cls']),
+                       names, tuple(item['orig_shape'])) for item in reply['results']]
+
+    # Per-thread state; a forked worker must not reuse its parent's socket
+    def _state(self):
+        state = self._local
+        if getattr(state, 'pid', None) != os.getpid():
+            state.pid, state.sock, state.segment = os.getpid(), None, None
+        return state
+
+    def _segment(self, state, size):
+        if state.segment is None or state.segment.size < size:
+            if state.segment is not None:
+                release_segment(state.segment)
+            # Some headroom so slightly larger films do not force a new segment
+            state.segment = shared_memory.SharedMemory(create=True, size=max(size * 5 // 4, 1))
+            # Removed when the thread goes away, or at exit at the latest
+            weakref.finalize(threading.current_thread(), release_segment, state.segment)
+        return state.segment
+
+    def _disconnect(self, state, drop_segment=False):
+        if state.sock is not None:
+            state.sock.close()
+            state.sock = None
+        if drop_segment and state.segment is not None:
+            # The server may still be reading it, so never write into it again
+            release_segment(state.segment)
+            state.segment = None
+
+    def _request(self, header, images):
+        state = self._state()
+        if images:
+            offsets, total = [], 0
+            for image in images:
+                offsets.append(total)
+                # 64-byte aligned so every view is aligned for SIMD loads
+                total += (image.nbytes + 63) // 64 * 64
+            segment = self._segment(state, total)
+            for offset, image in zip(offsets, images):
+                view = np.ndarray(image.shape, dtype=np.uint8, buffer=segment.buf, offset=offset)
+                view[...] = image
+                del view
+            header = dict(header, shm=segment.name,
+                          images=[[offset, list(image.shape)] for offset, image in zip(offsets, images)])
+        if state.sock is None:
+            state.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            state.sock.settimeout(self.timeout)
+            try:
+                state.sock.connect(self.socket_path)
+            except OSError:
+                self._disconnect(state)
+                raise
+        try:
+            send_message(state.sock, header)
+            reply = recv_message(state.sock)
+        except OSError:
+            self._disconnect(state)
+            raise
+        if reply is None:
+            self._disconnect(state)
+            raise ConnectionResetError("Model server closed the connection")
+        return reply
+
+    def _call(self, header, images=()):
+        try:
+            reply = self._request(header, images)
+        except socket.timeout:
+            self._disconnect(self._state(), drop_segment=True)
+            raise ModelServerError(f"Model server did not answer within {self.timeout}s")
+        except OSError as e:
+            if not self.autostart:
+                raise ModelServerError(f"Model server unavailable at {self.socket_path}: {e}")
+            print(f" Model server unavailable ({e}), starting it")
+            self.ensure_server()
+            reply = self._request(header, images)
+        if 'error' in reply:
+            raise ModelServerError(reply['error'])
+        return reply
+
+    def _reachable(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+
+    def ensure_server(self):
+        """Spawn the server unless one is running; the lock file lets only one worker do it"""
+        import fcntl
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        with self._spawn_lock, open(f"{self.socket_path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._process is not None:
+                # Reap a server this worker started earlier
+                self._process.poll()
+            if not self._reachable():
+                env = dict(os.environ, MODEL_SERVER_CONFIG=json.dumps(self.settings))
+                # Own session, so it outlives the worker and ignores the worker's signals
+                self._process = subprocess.Popen([sys.executable, '-m', 'model_server'], cwd=BASE_DIR,
+                                                 env=env, start_new_session=True)
+            deadline = time.monotonic() + self.start_timeout
+            while not self._reachable():
+                if self._process is not None and self._process.poll() is not None:
+                    raise ModelServerError(f"Model server exited with code {self._process.returncode}")
+                if time.monotonic() > deadline:
+                    raise ModelServerError(f"Model server did not start within {self.start_timeout}s")
+                time.sleep(0.1)
+
+# Flask CLI command running the model server in the foreground
+@click.command("model-server")
+def model_server_command():
+    """Serve the model to the web workers over MODEL_SERVER_SOCKET."""
+    config = current_app.config
+    serve(server_settings(config), config['MODEL_SERVER_SOCKET'])
+
+if __name__ == '__main__':
+    settings = json.loads(os.environ['MODEL_SERVER_CONFIG'])
+    serve(settings, settings['MODEL_SERVER_SOCKET'])
@@ -0,0 +1,169 @@
+import hashlib
+import json
+from functools import lru_cache
+import numpy as np
+from backends import as_numpy_boxes, box_iou
+
+NO_DETECTION = "No foreign object detected"
+
+@lru_cache(maxsize=8)
+def parse_class_thresholds(value):
+    """'foreign_object=0.4, 3=0.5' -> {'foreign_object': 0.4, '3': 0.5}; keys are class names or ids"""
+    thresholds = {}
+    for entry in (value or '').split(','):
+        if not entry.strip():
+            continue
+        name, separator, threshold = entry.partition('=')
+        if not separator or not name.strip():
+            raise ValueError(f"Invalid class threshold {entry.strip()!r}, expected class=threshold")
+        thresholds[name.strip()] = float(threshold)
+    return thresholds
+
+def postprocess_settings(config):
+    """Post-processing options from the app config (or a plain dict in worker processes)"""
+    return {
+        'threshold': config.get('DETECTION_THRESHOLD', 0.25),
+        'class_thresholds': parse_class_thresholds(config.get('DETECTION_CLASS_THRESHOLDS') or ''),
+        'nms_iou': config.get('DETECTION_NMS_IOU', 0.0),
+        'max_boxes': config.get('DETECTION_MAX_BOXES', 300)
+    }
+
+def lowest_threshold(settings):
+    """Smallest threshold any class is held to"""
+    return min([settings['threshold'], *settings['class_thresholds'].values()])
+
+def thresholds_fingerprint(settings):
+    """Short tag that changes with the per-class thresholds, for cache keys"""
+    if not settings['class_thresholds']:
+        return ''
+    encoded = json.dumps(settings['class_thresholds'], sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:8]
+
+def settings_fingerprint(settings, *extra):
+    """Short tag for everything besides the threshold that changes a stored result, for the result cache key"""
+    encoded = json.dumps([settings['class_thresholds'], settings['nms_iou'], settings['max_boxes'], *extra],
+                         sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+class Detections:
+    """Boxes of one image as parallel NumPy arrays, with a class label per box.
+
+    Produced once from the model output and then shared by summarizing,
+    drawing, the detection table insert and JSON responses. A class id of
+    -1 stands for boxes stored before class ids were recorded.
+    """
+
+    def __init__(self, xyxy, conf, cls, labels):
+        self.xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        self.conf = np.asarray(conf, dtype=np.float32).reshape(-1)
+        self.cls = np.asarray(cls, dtype=np.int64).reshape(-1)
+        self.labels = np.asarray(labels, dtype=object).reshape(-1)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 4)), [], [], [])
+
+    @classmethod
+    def from_results(cls, results, names):
+        """Every box of a list of Results (ultralytics or backends.Result)"""
+        box_sets = [as_numpy_boxes(result.boxes) for result in results]
+        box_sets = [boxes for boxes in box_sets if len(boxes)]
+        if not box_sets:
+            return cls.empty()
+        class_ids = np.concatenate([boxes.cls for boxes in box_sets]).astype(np.int64)
+        # One name lookup per distinct class instead of one per box
+        unique_ids, inverse = np.unique(class_ids, return_inverse=True)
+        labels = np.array([names.get(int(class_id), "Unknown") for class_id in unique_ids], dtype=object)
+        return cls(np.concatenate([boxes.xyxy for boxes in box_sets]),
+                   np.concatenate([boxes.conf for boxes in box_sets]),
+                   class_ids, labels[inverse])
+
+    @classmethod
+    def from_dicts(cls, boxes):
+        """Prediction dicts (class_id, class, confidence, coordinates), e.g. from the JSON cache"""
+        if not boxes:
+            return cls.empty()
+        return cls([box['coordinates'] for box in boxes], [box['confidence'] for box in boxes],
+                   [-1 if box.get('class_id') is None else box['class_id'] for box in boxes],
+                   [box['class'] for box in boxes])
+
+    @classmethod
+    def from_rows(cls, rows):
+        """(class_id, class_name, confidence, x1, y1, x2, y2) tuples from the detection table"""
+        if not rows:
+            return cls.empty()
+        class_ids, labels, conf, x1, y1, x2, y2 = zip(*rows)
+        return cls(np.column_stack([x1, y1, x2, y2]), conf,
+                   [-1 if class_id is None else class_id for class_id in class_ids], labels)
+
+    def __len__(self):
+        return len(self.conf)
+
+    def take(self, index):
+        """Subset by index array, boolean mask or slice"""
+        return Detections(self.xyxy[index], self.conf[index], self.cls[index], self.labels[index])
+
+    def scaled(self, factor):
+        return Detections(self.xyxy * factor, self.conf, self.cls, self.labels)
+
+    def sorted(self):
+        """Best first; ties keep the model's order"""
+        return self.take(np.argsort(-self.conf, kind='stable'))
+
+    def as_dicts(self):
+        """Prediction dicts as stored in Upload.predictions and the detection cache"""
+        return [{
+            "class_id": None if class_id < 0 else class_id,
+            "class": label,
+            "confidence": confidence,
+            "coordinates": coordinates
+        } for class_id, label, confidence, coordinates in zip(
+            self.cls.tolist(), self.labels.tolist(), self.conf.tolist(), self.xyxy.tolist())]
+
+def class_thresholds(detections, settings):
+    """Threshold each box is held to: its class's entry in DETECTION_CLASS_THRESHOLDS, else the default"""
+    thresholds = np.full(len(detections), settings['threshold'], dtype=np.float64)
+    for key, value in settings['class_thresholds'].items():
+        mask = detections.labels == key
+        if key.lstrip('-').isdigit():
+            mask |= detections.cls == int(key)
+        thresholds[mask] = value
+    return thresholds
+
+def nms(detections, iou_threshold):
+    """Class-aware greedy NMS over boxes sorted best first; returns the kept indices"""
+    order = np.arange(len(detections))
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        overlap = box_iou(detections.xyxy[best:best + 1], detections.xyxy[rest])[0]
+        order = rest[(overlap <= iou_threshold) | (detections.cls[rest] != detections.cls[best])]
+    return np.array(keep, dtype=np.int64)
+
+def postprocess(results, names, settings):
+    """All boxes worth storing, best first.
+
+    Optional class-aware NMS (DETECTION_NMS_IOU) runs on top of the model's
+    own and DETECTION_MAX_BOXES keeps the most confident boxes. Everything
+    the model reported above the store threshold is kept, so results can be
+    re-thresholded later without running the model again.
+    """
+    detections = Detections.from_results(results, names).sorted()
+    if settings['nms_iou'] and len(detections) > 1:
+        detections = detections.take(nms(detections, settings['nms_iou']))
+    if settings['max_boxes'] and len(detections) > settings['max_boxes']:
+        detections = detections.take(slice(0, settings['max_boxes']))
+    return detections
+
+def select(detections, settings):
+    """Boxes above their class threshold, keeping the order"""
+    return detections.take(detections.conf > class_thresholds(detections, settings))
+
+def summarize(detections, settings):
+    """Top result, its confidence and the predictions above the thresholds, best first"""
+    predictions = select(detections, settings)
+    if not len(predictions):
+        return NO_DETECTION, 0.0, predictions
+    # The highest confidence prediction is the result
+    return predictions.labels[0], float(predictions.conf[0]), predictions
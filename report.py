@@ -1,25 +1,41 @@
-from flask import Blueprint, redirect, url_for, send_file, session, flash, current_app
-from fpdf import FPDF
+from flask import Blueprint, redirect, url_for, send_file, session, flash, current_app, request, render_template, jsonify
+from concurrent.futures import ThreadPoolExecutor
 import os
-from database import db, Upload, log_action  # Import SQLAlchemy db and models
+import json
+import uuid
+from database import db, Upload, ReportJob  # Import SQLAlchemy db and models
+from audit import log_action
+from derivatives import get_derivative
+from detection import get_processed_derivative
+from history import parse_history_filters, filter_uploads
+from metrics import StageTimer, observe_stages, span, reports_total
 from io import BytesIO
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, timedelta
 
 report_bp = Blueprint('report', __name__)
 
-class DetectionReportPDF(FPDF):
-    def header(self):
-        self.set_font('Arial', 'B', 18)
-        self.cell(0, 10, 'Detection Report', 0, 1, 'C')
-        self.set_font('Arial', 'I', 12)
-        self.cell(0, 10, f'Generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}', 0, 1, 'C')
-        self.ln(5)
-    
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Page {self.page_no()}/{{nb}}', 0, 0, 'C')
+# Full-history reports are built here instead of in the request worker
+report_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report")
+
+def new_report_pdf():
+    """An empty report PDF; fpdf pulls in PIL, so it is only imported when a report is built"""
+    from fpdf import FPDF
+
+    class DetectionReportPDF(FPDF):
+        def header(self):
+            self.set_font('Arial', 'B', 18)
+            self.cell(0, 10, 'Detection Report', 0, 1, 'C')
+            self.set_font('Arial', 'I', 12)
+            self.cell(0, 10, f'Generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}', 0, 1, 'C')
+            self.ln(5)
+
+        def footer(self):
+            self.set_y(-15)
+            self.set_font('Arial', 'I', 8)
+            self.cell(0, 10, f'Page {self.page_no()}/{{nb}}', 0, 0, 'C')
+
+    return DetectionReportPDF()
 
 def login_required(f):
     @wraps(f)
@@ -30,203 +46,275 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-@report_bp.route('/generate_report', methods=['GET'])
-@login_required
-def generate_report():
-    try:
-        uploads = Upload.query.order_by(Upload.upload_time.desc()).all()
-        if not uploads:
-            flash("No images found in the database to generate a report.", "warning")
-            return redirect(url_for('detection.history'))
-        
-        # Initialize PDF with custom class
-        pdf = DetectionReportPDF()
-        pdf.alias_nb_pages()
+def build_report_query(filters):
+    """Uploads in the scope of a report, newest first"""
+    return filter_uploads(Upload.query, filters).order_by(Upload.upload_time.desc())
+
+def write_upload_section(pdf, upload, size_name):
+    """Write one upload's details and its original/processed images.
+
+    Images are embedded as derivatives of size_name, so each report can pick
+    the size it needs.
+    """
+    # Extract data
+    file_name = upload.file_name
+    detection_result = upload.detection_result or upload.status.capitalize()
+    confidence_score = upload.confidence_score
+    remarks = upload.remarks if upload.remarks else 'None'
+    upload_time = upload.upload_time.strftime("%Y-%m-%d %H:%M:%S")
+    original_path = upload.file_path
+    
+    # Add a clear section header with background
+    pdf.set_fill_color(230, 230, 230)
+    pdf.set_font('Arial', 'B', 14)
+    pdf.cell(0, 10, f"Image Analysis: {file_name}", 1, 1, 'L', True)
+    
+    # Image details in a structured format
+    pdf.set_font('Arial', '', 10)
+    pdf.cell(35, 7, "Upload Time:", 0, 0)
+    pdf.cell(0, 7, f"{upload_time}", 0, 1)
+    
+    pdf.cell(35, 7, "Detection Result:", 0, 0)
+    # Color code the detection result
+    if "foreign_object" in detection_result.lower():
+        pdf.set_text_color(255, 0, 0)  # Red for foreign objects
+    else:
+        pdf.set_text_color(0, 128, 0)  # Green for no foreign objects
+    pdf.cell(0, 7, f"{detection_result}", 0, 1)
+    pdf.set_text_color(0, 0, 0)  # Reset text color
+    
+    pdf.cell(35, 7, "Confidence Score:", 0, 0)
+    confidence_str = f"{confidence_score:.2f}" if confidence_score else "N/A"
+    pdf.cell(0, 7, f"{confidence_str}", 0, 1)
+    
+    pdf.cell(35, 7, "Remarks:", 0, 0)
+    pdf.cell(0, 7, f"{remarks}", 0, 1)
+    pdf.ln(5)
+    
+    # Starting Y position for images
+    start_y = pdf.get_y()
+    
+    # Check if we have enough space for images
+    if start_y > 180:  # If less than about 90 points left on page
         pdf.add_page()
-        
-        # Create report content
-        for upload in uploads:
-            # Extract data
-            file_name = upload.file_name
-            detection_result = upload.detection_result
-            confidence_score = upload.confidence_score
-            remarks = upload.remarks if upload.remarks else 'None'
-            upload_time = upload.upload_time.strftime("%Y-%m-%d %H:%M:%S")
-            original_path = upload.file_path
-            processed_path = upload.processed_file_path
-            
-            # Add a clear section header with background
-            pdf.set_fill_color(230, 230, 230)
-            pdf.set_font('Arial', 'B', 14)
-            pdf.cell(0, 10, f"Image Analysis: {file_name}", 1, 1, 'L', True)
-            
-            # Image details in a structured format
-            pdf.set_font('Arial', '', 10)
-            pdf.cell(35, 7, "Upload Time:", 0, 0)
-            pdf.cell(0, 7, f"{upload_time}", 0, 1)
-            
-            pdf.cell(35, 7, "Detection Result:", 0, 0)
-            # Color code the detection result
-            if "foreign_object" in detection_result.lower():
-                pdf.set_text_color(255, 0, 0)  # Red for foreign objects
-            else:
-                pdf.set_text_color(0, 128, 0)  # Green for no foreign objects
-            pdf.cell(0, 7, f"{detection_result}", 0, 1)
-            pdf.set_text_color(0, 0, 0)  # Reset text color
-            
-            pdf.cell(35, 7, "Confidence Score:", 0, 0)
-            confidence_str = f"{confidence_score:.2f}" if confidence_score else "N/A"
-            pdf.cell(0, 7, f"{confidence_str}", 0, 1)
-            
-            pdf.cell(35, 7, "Remarks:", 0, 0)
-            pdf.cell(0, 7, f"{remarks}", 0, 1)
+        start_y = pdf.get_y()
+    
+    # Add original image on the left
+    pdf.set_font('Arial', 'B', 10)
+    pdf.cell(90, 7, 'Original Image:', 0, 1)
+    original_image = get_derivative(original_path, size_name)
+    if original_image:
+        pdf.image(original_image, x=10, y=pdf.get_y(), w=90, h=65)
+    else:
+        pdf.cell(90, 65, 'Image not available', 1, 0, 'C')
+    
+    # Add processed image on the right
+    pdf.set_xy(105, start_y)
+    pdf.cell(90, 7, 'Processed Image:', 0, 1)
+    processed_image = get_processed_derivative(upload, size_name)
+    if processed_image:
+        pdf.image(processed_image, x=105, y=pdf.get_y(), w=90, h=65)
+    else:
+        pdf.set_xy(105, pdf.get_y())
+        pdf.cell(90, 65, 'Image not available', 1, 0, 'C')
+    
+    # Move cursor below images
+    pdf.set_y(start_y + 75)
+
+def build_full_report(job, out_path, timer=None):
+    """Render every upload in the job's scope into a PDF file on disk.
+
+    Uploads are streamed from the database in chunks and only cached
+    thumbnails are embedded, so memory stays flat for large histories.
+    """
+    timer = timer or StageTimer()
+    filters = json.loads(job.filters) if job.filters else {}
+    chunk_size = current_app.config.get('REPORT_CHUNK_SIZE', 200)
+    
+    # Initialize PDF with custom class
+    pdf = new_report_pdf()
+    pdf.alias_nb_pages()
+    pdf.add_page()
+    
+    count = 0
+    for upload in build_report_query(filters).yield_per(chunk_size):
+        # Add a separator line between entries
+        if count:
+            pdf.line(10, pdf.get_y(), 200, pdf.get_y())
             pdf.ln(5)
             
-            # Starting Y position for images
-            start_y = pdf.get_y()
-            
-            # Check if we have enough space for images
-            if start_y > 180:  # If less than about 90 points left on page
+            # Check if we have enough space for the next entry
+            if pdf.get_y() > 240:
                 pdf.add_page()
-                start_y = pdf.get_y()
-            
-            # Add original image on the left
-            pdf.set_font('Arial', 'B', 10)
-            pdf.cell(90, 7, 'Original Image:', 0, 1)
-            if original_path and os.path.exists(original_path):
-                pdf.image(original_path, x=10, y=pdf.get_y(), w=90, h=65)
-            else:
-                pdf.cell(90, 65, 'Image not available', 1, 0, 'C')
-            
-            # Add processed image on the right
-            pdf.set_xy(105, start_y)
-            pdf.cell(90, 7, 'Processed Image:', 0, 1)
-            if processed_path and os.path.exists(processed_path):
-                pdf.image(processed_path, x=105, y=pdf.get_y(), w=90, h=65)
-            else:
-                pdf.set_xy(105, pdf.get_y())
-                pdf.cell(90, 65, 'Image not available', 1, 0, 'C')
-            
-            # Move cursor below images and add some spacing
-            pdf.set_y(start_y + 75)
-            pdf.ln(10)
-            
-            # Add a separator line between entries
-            if upload != uploads[-1]:
-                pdf.line(10, pdf.get_y(), 200, pdf.get_y())
-                pdf.ln(5)
-                
-                # Check if we have enough space for the next entry
-                if pdf.get_y() > 240:
-                    pdf.add_page()
         
-        # Output PDF directly to memory
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        report_filename = f"detection_report_{timestamp}.pdf"
+        with timer.stage('report_sections'):
+            write_upload_section(pdf, upload, 'thumb')
+        pdf.ln(10)
+        count += 1
+    
+    with timer.stage('report_output'):
+        pdf.output(out_path, 'F')
+    return count
+
+def run_report_job(app, job_id):
+    """Background task: build the report for a ReportJob and record the outcome"""
+    with app.app_context():
+        # Claim the job atomically; after a restart every worker may queue it
+        claimed = ReportJob.query.filter_by(id=job_id, status='pending').update(
+            {'status': 'running', 'started_at': datetime.now()})
+        db.session.commit()
+        if not claimed:
+            return
+        job = ReportJob.query.get(job_id)
         
-        # Get PDF as bytes directly in memory
-        pdf_bytes = pdf.output(dest='S').encode('latin1')
-        pdf_stream = BytesIO(pdf_bytes)
-        pdf_stream.seek(0)
+        report_folder = app.config['REPORT_FOLDER']
+        out_path = os.path.join(report_folder, f"detection_report_{job.id}_{uuid.uuid4().hex}.pdf")
+        timer = StageTimer()
+        try:
+            with timer.stage('report_total'):
+                job.total = build_full_report(job, out_path, timer)
+            job.file_path = out_path
+            job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error_message = str(e)
+            if os.path.exists(out_path):
+                os.remove(out_path)
+        job.finished_at = datetime.now()
+        db.session.commit()
+        observe_stages(timer)
+        reports_total.inc(kind='full', status=job.status)
         
         # Log the action
-        admin_id = session.get('admin_id')
-        log_action(admin_id, "generate_report", f"Generated report with {len(uploads)} images")
-        
-        return send_file(
-            pdf_stream,
-            as_attachment=True,
-            download_name=report_filename,
-            mimetype='application/pdf'
-        )
+        if job.status == 'done':
+            log_action(job.admin_id, "generate_report", f"Generated report with {job.total} images")
+
+def fail_stale_report_jobs():
+    """Mark reports running for longer than REPORT_JOB_TIMEOUT as failed; the worker building them is gone"""
+    cutoff = datetime.now() - timedelta(seconds=current_app.config.get('REPORT_JOB_TIMEOUT', 1800))
+    count = ReportJob.query.filter(
+        ReportJob.status == 'running',
+        ReportJob.started_at.is_(None) | (ReportJob.started_at < cutoff)
+    ).update({'status': 'failed', 'finished_at': datetime.now(),
+              'error_message': "Interrupted: the server stopped while building the report"},
+             synchronize_session=False)
+    db.session.commit()
+    return count
+
+def requeue_report_jobs(app):
+    """Queue reports a previous process left pending, and fail the ones it left running"""
+    with app.app_context():
+        fail_stale_report_jobs()
+        job_ids = [job_id for (job_id,) in db.session.query(ReportJob.id).filter_by(
+            status='pending').order_by(ReportJob.id)]
+        db.session.remove()
+    for job_id in job_ids:
+        report_executor.submit(run_report_job, app, job_id)
+
+def remove_expired_reports():
+    """Delete report files older than REPORT_RETENTION_HOURS"""
+    cutoff = datetime.now() - timedelta(hours=current_app.config.get('REPORT_RETENTION_HOURS', 24))
+    for job in ReportJob.query.filter(ReportJob.created_at < cutoff, ReportJob.file_path.isnot(None)).all():
+        if os.path.exists(job.file_path):
+            os.remove(job.file_path)
+        job.file_path = None
+        job.status = 'expired'
+    db.session.commit()
+
+@report_bp.route('/generate_report', methods=['GET'])
+@login_required
+def generate_report():
+    """Start building the full report in the background"""
+    try:
+        filters = parse_history_filters(request.args)
+    except ValueError:
+        flash("Invalid filters: dates must use YYYY-MM-DD and confidence must be a number.", "danger")
+        return redirect(url_for('detection.history'))
     
-    except Exception as e:
-        flash(f"Error generating report: {str(e)}", "danger")
+    if not build_report_query(filters).first():
+        flash("No images found in the database to generate a report.", "warning")
         return redirect(url_for('detection.history'))
+    
+    remove_expired_reports()
+    job = ReportJob(admin_id=session.get('admin_id'), filters=json.dumps(filters), status='pending')
+    db.session.add(job)
+    db.session.commit()
+    report_executor.submit(run_report_job, current_app._get_current_object(), job.id)
+    
+    return redirect(url_for('report.report_status', job_id=job.id))
+
+@report_bp.route('/report_jobs/<int:job_id>', methods=['GET'])
+@login_required
+def report_status(job_id):
+    """Report progress page; answers JSON for the polling script"""
+    job = ReportJob.query.get(job_id)
+    if not job:
+        flash("Report not found.", "warning")
+        return redirect(url_for('detection.history'))
+    if job.status == 'running' and fail_stale_report_jobs():
+        db.session.refresh(job)
+    
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            "id": job.id,
+            "status": job.status,
+            "total": job.total,
+            "error": job.error_message
+        })
+    return render_template('report_status.html', job=job,
+                           filters=json.loads(job.filters) if job.filters else {})
+
+@report_bp.route('/report_jobs/<int:job_id>/download', methods=['GET'])
+@login_required
+def download_report(job_id):
+    job = ReportJob.query.get(job_id)
+    if not job or job.status != 'done' or not job.file_path or not os.path.exists(job.file_path):
+        flash("Report is not available.", "warning")
+        return redirect(url_for('detection.history'))
+    
+    timestamp = job.created_at.strftime("%Y%m%d_%H%M%S")
+    return send_file(
+        job.file_path,
+        as_attachment=True,
+        download_name=f"detection_report_{timestamp}.pdf",
+        mimetype='application/pdf'
+    )
 
 @report_bp.route('/single_report/<int:image_id>', methods=['GET'])
 @login_required
 def single_report(image_id):
     """Generate a report for a single image"""
     try:
-        upload = Upload.query.get(image_id)
+        with span('query'):
+            upload = Upload.query.get(image_id)
         if not upload:
             flash("Image not found in the database.", "warning")
             return redirect(url_for('detection.history'))
         
         # Initialize PDF with custom class
-        pdf = DetectionReportPDF()
+        pdf = new_report_pdf()
         pdf.alias_nb_pages()
         pdf.add_page()
         
-        # Extract data
-        file_name = upload.file_name
-        detection_result = upload.detection_result
-        confidence_score = upload.confidence_score
-        remarks = upload.remarks if upload.remarks else 'None'
-        upload_time = upload.upload_time.strftime("%Y-%m-%d %H:%M:%S")
-        original_path = upload.file_path
-        processed_path = upload.processed_file_path
-        
-        # Add a clear section header with background
-        pdf.set_fill_color(230, 230, 230)
-        pdf.set_font('Arial', 'B', 14)
-        pdf.cell(0, 10, f"Image Analysis: {file_name}", 1, 1, 'L', True)
-        
-        # Image details in a structured format
-        pdf.set_font('Arial', '', 10)
-        pdf.cell(35, 7, "Upload Time:", 0, 0)
-        pdf.cell(0, 7, f"{upload_time}", 0, 1)
-        
-        pdf.cell(35, 7, "Detection Result:", 0, 0)
-        # Color code the detection result
-        if "foreign_object" in detection_result.lower():
-            pdf.set_text_color(255, 0, 0)  # Red for foreign objects
-        else:
-            pdf.set_text_color(0, 128, 0)  # Green for no foreign objects
-        pdf.cell(0, 7, f"{detection_result}", 0, 1)
-        pdf.set_text_color(0, 0, 0)  # Reset text color
-        
-        pdf.cell(35, 7, "Confidence Score:", 0, 0)
-        confidence_str = f"{confidence_score:.2f}" if confidence_score else "N/A"
-        pdf.cell(0, 7, f"{confidence_str}", 0, 1)
-        
-        pdf.cell(35, 7, "Remarks:", 0, 0)
-        pdf.cell(0, 7, f"{remarks}", 0, 1)
-        pdf.ln(5)
-        
-        # Starting Y position for images
-        start_y = pdf.get_y()
-        
-        # Add original image on the left
-        pdf.set_font('Arial', 'B', 10)
-        pdf.cell(90, 7, 'Original Image:', 0, 1)
-        if original_path and os.path.exists(original_path):
-            pdf.image(original_path, x=10, y=pdf.get_y(), w=90, h=65)
-        else:
-            pdf.cell(90, 65, 'Image not available', 1, 0, 'C')
-        
-        # Add processed image on the right
-        pdf.set_xy(105, start_y)
-        pdf.cell(90, 7, 'Processed Image:', 0, 1)
-        if processed_path and os.path.exists(processed_path):
-            pdf.image(processed_path, x=105, y=pdf.get_y(), w=90, h=65)
-        else:
-            pdf.set_xy(105, pdf.get_y())
-            pdf.cell(90, 65, 'Image not available', 1, 0, 'C')
+        # Single reports embed the larger web previews
+        with span('sections'):
+            write_upload_section(pdf, upload, 'preview')
         
         # Output PDF directly to memory
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        report_filename = f"detection_report_{file_name}_{timestamp}.pdf"
+        report_filename = f"detection_report_{upload.file_name}_{timestamp}.pdf"
         
         # Get PDF as bytes directly in memory
-        pdf_bytes = pdf.output(dest='S').encode('latin1')
+        with span('output'):
+            pdf_bytes = pdf.output(dest='S').encode('latin1')
         pdf_stream = BytesIO(pdf_bytes)
         pdf_stream.seek(0)
         
         # Log the action
         admin_id = session.get('admin_id')
-        log_action(admin_id, "generate_single_report", f"Generated report for image ID: {image_id}")
+        with span('audit'):
+            log_action(admin_id, "generate_single_report", f"Generated report for image ID: {image_id}")
+        reports_total.inc(kind='single', status='done')
         
         return send_file(
             pdf_stream,
@@ -236,5 +324,6 @@ def single_report(image_id):
         )
     
     except Exception as e:
+        reports_total.inc(kind='single', status='failed')
         flash(f"Error generating report: {str(e)}", "danger")
         return redirect(url_for('detection.image_details', image_id=image_id))
\ No newline at end of file
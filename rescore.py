@@ -0,0 +1,399 @@
+from flask import Blueprint, redirect, url_for, flash, session, current_app, jsonify
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from datetime import datetime
+import multiprocessing
+import click
+import json
+import os
+import threading
+import time
+from database import db, Admin, Upload, Detection, DetectionCache, RescoreJob
+from audit import log_action
+from detection import (login_required, get_model, get_model_version, get_postprocess_settings,
+                       get_store_threshold, decode_image, save_detections)
+from cache import remove_unreferenced_file
+from storage import storage
+from jobs import inference_queue
+from backends import create_backend, get_backend_class
+from tiling import tiling_enabled, tiling_settings, predict_tiled
+from postprocess import postprocess, postprocess_settings, summarize, lowest_threshold
+
+rescore_bp = Blueprint('rescore', __name__)
+
+# Admin-started rescores run one at a time next to live traffic
+rescore_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rescore")
+
+def lower_priority(niceness):
+    """Make the calling process (or, on Linux, thread) yield the CPU to live uploads"""
+    if not niceness:
+        return
+    try:
+        if hasattr(threading, 'get_native_id') and hasattr(os, 'setpriority'):
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+        else:
+            os.nice(niceness)
+    except OSError as e:
+        print(f"Warning: could not lower rescore priority: {e}")
+
+# --- Worker processes ---------------------------------------------------
+
+_worker_state = {}
+
+def _init_worker(config):
+    """Load the backend once per worker process"""
+    lower_priority(config.get('RESCORE_NICE', 10))
+    threads = config.get('RESCORE_THREADS')
+    if threads and get_backend_class(config).name == 'torch':
+        import torch
+        torch.set_num_threads(threads)
+    elif threads:
+        # ONNX Runtime sizes its intra-op pool from ONNX_INTRA_OP_THREADS,
+        # OpenMP-based runtimes from OMP_NUM_THREADS
+        config['ONNX_INTRA_OP_THREADS'] = config.get('ONNX_INTRA_OP_THREADS') or threads
+        os.environ.setdefault('OMP_NUM_THREADS', str(threads))
+    _worker_state['backend'] = create_backend(config)
+    _worker_state['postprocess'] = postprocess_settings(config)
+    _worker_state['conf'] = min(config.get('DETECTION_STORE_MIN_CONFIDENCE', 0.1),
+                                lowest_threshold(_worker_state['postprocess']))
+    _worker_state['tiling'] = tiling_settings(config) if tiling_enabled(config) else None
+
+def _detect(item, backend, conf, tiling, settings):
+    """Decode and run one image; returns (upload_id, boxes, error)"""
+    upload_id, image_data, error = item
+    if error:
+        return upload_id, None, error
+    try:
+        image = decode_image(image_data)
+        if image is None:
+            return upload_id, None, "Failed to read image"
+        if tiling:
+            results = predict_tiled(backend, image, conf, tiling)
+        else:
+            results = backend.predict(source=image, save=False, conf=conf, verbose=False)
+        # NumPy arrays travel back to the parent far cheaper than box dicts
+        return upload_id, postprocess(results, backend.names, settings), None
+    except Exception as e:
+        return upload_id, None, f"Prediction error: {str(e)}"
+
+def _detect_in_worker(item):
+    return _detect(item, _worker_state['backend'], _worker_state['conf'], _worker_state['tiling'],
+                   _worker_state['postprocess'])
+
+def _detect_inline(item):
+    """Same as _detect_in_worker with this process's model.
+
+    Runs on the calling thread rather than through the micro-batcher, so the
+    lowered priority applies; the batcher thread keeps serving live uploads.
+    """
+    model = get_model()
+    if model is None:
+        return item[0], None, "Model not available"
+    config = current_app.config
+    return _detect(item, model, get_store_threshold(), tiling_settings(config) if tiling_enabled(config) else None,
+                   get_postprocess_settings())
+
+# --- Pipeline -----------------------------------------------------------
+
+def bounded_map(submit, function, items, window):
+    """Like map(), keeping at most `window` calls in flight ahead of the consumer"""
+    pending = deque()
+    for item in items:
+        pending.append(submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def read_image(row):
+    upload_id, file_path = row
+    try:
+        with storage.open(file_path) as f:
+            return upload_id, f.read(), None
+    except OSError as e:
+        return upload_id, None, f"Cannot read {file_path}: {e.strerror or e}"
+
+def iter_rescore_rows(job, chunk_size):
+    """Stream (id, file_path) of uploads still to rescore, in id order, chunk by chunk"""
+    last_id = job.last_upload_id
+    while True:
+        rows = db.session.query(Upload.id, Upload.file_path).filter(
+            Upload.id > last_id,
+            Upload.status == 'done',
+            (Upload.model_version.is_(None)) | (Upload.model_version != job.model_version)
+        ).order_by(Upload.id).limit(chunk_size).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+def write_results(job, results, settings):
+    """Store one chunk of results with bulk statements and advance the checkpoint"""
+    done = [(upload_id, boxes) for upload_id, boxes, error in results if error is None]
+    failed = [(upload_id, error) for upload_id, boxes, error in results if error is not None]
+    ids = [upload_id for upload_id, _ in done]
+
+    old_files = [path for (path,) in db.session.query(Upload.processed_file_path).filter(
+        Upload.id.in_(ids), Upload.processed_file_path.isnot(None))] if ids else []
+
+    mappings = []
+    for upload_id, boxes in done:
+        detection_result, confidence_score, predictions = summarize(boxes, settings)
+        # The old processed image shows the previous model's boxes; the
+        # overlay is drawn from the new boxes on request instead
+        mappings.append({
+            "id": upload_id,
+            "detection_result": detection_result,
+            "confidence_score": confidence_score,
+            "predictions": json.dumps(predictions.as_dicts()),
+            "processed_file_path": None,
+            "model_version": job.model_version
+        })
+    if ids:
+        # Cached results of older models point at the same stale processed files
+        if old_files:
+            DetectionCache.query.filter(DetectionCache.processed_file_path.in_(old_files),
+                                        DetectionCache.model_version != job.model_version).delete(synchronize_session=False)
+        Detection.query.filter(Detection.upload_id.in_(ids)).delete(synchronize_session=False)
+        db.session.bulk_update_mappings(Upload, mappings)
+        for upload_id, boxes in done:
+            save_detections(upload_id, boxes, job.model_version)
+    for upload_id, error in failed:
+        print(f" Upload {upload_id} not rescored: {error}")
+
+    job.last_upload_id = max(upload_id for upload_id, _, _ in results)
+    job.processed += len(done)
+    job.failed += len(failed)
+    job.updated_at = datetime.now()
+    db.session.commit()
+
+    for path in old_files:
+        remove_unreferenced_file(path)
+
+def wait_for_live_uploads(poll_seconds, max_pause):
+    """Hold the rescore while uploads wait for inference, so it never starves them.
+
+    Gives up after max_pause seconds so an upload stuck in pending cannot
+    stall the job forever.
+    """
+    waited = 0.0
+    while waited < max_pause and Upload.query.filter_by(status='pending').count():
+        db.session.rollback()
+        time.sleep(poll_seconds)
+        waited += poll_seconds
+    return waited
+
+def run_rescore(job_id, workers=1, max_rate=None, progress=print):
+    """Rescore every upload not yet produced by the job's model version.
+
+    Rows are streamed in RESCORE_CHUNK_SIZE chunks; image files are read on
+    a thread pool ahead of inference; detection runs in `workers` processes
+    (or in this process when workers is 1); each chunk's results are written
+    with bulk statements and checkpointed in the job row, so an interrupted
+    job resumes where it stopped.
+
+    RESCORE_NICE lowers the worker processes as a whole, but with workers=1
+    only the calling thread: the model's own intra-op thread pool (and a
+    model server, if one is used) keeps its normal priority.
+    """
+    config = current_app.config
+    chunk_size = config.get('RESCORE_CHUNK_SIZE', 100)
+    settings = get_postprocess_settings()
+    job = RescoreJob.query.get(job_id)
+    if job.total is None:
+        job.total = Upload.query.filter(
+            Upload.status == 'done',
+            (Upload.model_version.is_(None)) | (Upload.model_version != job.model_version)).count()
+    job.status = 'running'
+    db.session.commit()
+
+    pool = None
+    if workers > 1:
+        # spawn: forking a process that already runs torch threads can deadlock
+        worker_config = {key: value for key, value in config.items()
+                         if isinstance(value, (str, int, float, bool, type(None)))}
+        # The cores are shared out between the worker processes
+        worker_config['RESCORE_THREADS'] = config.get('TORCH_THREADS') or max(1, (os.cpu_count() or 1) // workers)
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(worker_config,))
+        detect, window = pool.submit, workers * 2
+        function = _detect_in_worker
+    else:
+        lower_priority(config.get('RESCORE_NICE', 10))
+        detect, window = None, 1
+        function = _detect_inline
+
+    io_pool = ThreadPoolExecutor(max_workers=config.get('RESCORE_IO_THREADS', 4), thread_name_prefix="rescore-io")
+    started = time.monotonic()
+    paused = 0.0
+    # Uploads a resumed job handled before; the rate cap and throughput only count this run
+    done_before = job.processed + job.failed
+    try:
+        loaded = bounded_map(io_pool.submit, read_image, iter_rescore_rows(job, chunk_size),
+                             config.get('RESCORE_PREFETCH', 16))
+        results = bounded_map(detect, function, loaded, window) if detect else map(function, loaded)
+
+        chunk = []
+        for result in results:
+            chunk.append(result)
+            if max_rate:
+                # Simple throughput cap for the whole job
+                expected = (job.processed + job.failed - done_before + len(chunk)) / max_rate
+                elapsed = time.monotonic() - started - paused
+                if expected > elapsed:
+                    time.sleep(expected - elapsed)
+            if len(chunk) < chunk_size:
+                continue
+            write_results(job, chunk, settings)
+            chunk = []
+            elapsed = time.monotonic() - started
+            progress(f" {job.processed + job.failed}/{job.total} uploads, {job.failed} failed, "
+                     f"{(job.processed + job.failed - done_before) / max(elapsed - paused, 1e-9):.1f} images/s")
+
+            db.session.refresh(job)
+            if job.status == 'cancelled':
+                progress(" Rescore cancelled")
+                return job
+            if config.get('RESCORE_YIELD_TO_LIVE', True):
+                paused += wait_for_live_uploads(config.get('RESCORE_POLL_SECONDS', 1.0),
+                                                config.get('RESCORE_MAX_PAUSE', 300))
+        if chunk:
+            write_results(job, chunk, settings)
+
+        job.status = 'done'
+        job.finished_at = datetime.now()
+        db.session.commit()
+        elapsed = time.monotonic() - started
+        progress(f" Rescored {job.processed} uploads ({job.failed} failed) in {elapsed:.1f}s")
+    except Exception as e:
+        db.session.rollback()
+        job = RescoreJob.query.get(job_id)
+        job.status = 'failed'
+        job.error_message = str(e)
+        db.session.commit()
+        print(f"Rescore job {job_id} failed: {e}")
+    finally:
+        io_pool.shutdown(wait=False, cancel_futures=True)
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+    return job
+
+def claim_job(job_id, status='pending'):
+    """Mark a job running unless another process got to it first; returns whether this one did"""
+    claimed = RescoreJob.query.filter_by(id=job_id, status=status).update(
+        {'status': 'running', 'updated_at': datetime.now()})
+    db.session.commit()
+    return bool(claimed)
+
+def run_rescore_job(app, job_id):
+    """Background task for a rescore started from the web interface"""
+    with app.app_context():
+        # Claim the job atomically; every inference worker polls for pending jobs
+        if not claim_job(job_id):
+            return
+        job = run_rescore(job_id, workers=1)
+        if job and job.status == 'done' and job.admin_id:
+            log_action(job.admin_id, "rescore", f"Rescored {job.processed} uploads with model {job.model_version}")
+
+def serialize_job(job):
+    return {
+        "id": job.id,
+        "status": job.status,
+        "model_version": job.model_version,
+        "total": job.total,
+        "processed": job.processed,
+        "failed": job.failed,
+        "last_upload_id": job.last_upload_id,
+        "error": job.error_message,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None
+    }
+
+def active_job():
+    return RescoreJob.query.filter(RescoreJob.status.in_(('pending', 'running'))).first()
+
+@rescore_bp.route('/rescore', methods=['POST'])
+@login_required
+def start_rescore():
+    """Re-run detection over the stored history with the model currently loaded"""
+    if active_job():
+        flash("A rescore is already running.", "warning")
+        return redirect(url_for('detection.history'))
+    job = RescoreJob(admin_id=session.get('admin_id'), model_version=get_model_version(), status='pending')
+    db.session.add(job)
+    db.session.commit()
+    # With a separate inference process the pending job row is picked up there
+    if not inference_queue.external:
+        rescore_executor.submit(run_rescore_job, current_app._get_current_object(), job.id)
+    flash(f"Rescore started. Progress: {url_for('rescore.rescore_status', job_id=job.id)}", "success")
+    return redirect(url_for('detection.history'))
+
+@rescore_bp.route('/rescore_jobs/<int:job_id>', methods=['GET'])
+@login_required
+def rescore_status(job_id):
+    job = RescoreJob.query.get(job_id)
+    if not job:
+        return jsonify({"error": "Rescore job not found"}), 404
+    return jsonify(serialize_job(job))
+
+@rescore_bp.route('/rescore_jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_rescore(job_id):
+    """Stop after the current chunk; the checkpoint lets the job be resumed later"""
+    job = RescoreJob.query.get(job_id)
+    if not job:
+        return jsonify({"error": "Rescore job not found"}), 404
+    if job.status in ('pending', 'running'):
+        job.status = 'cancelled'
+        db.session.commit()
+    return jsonify(serialize_job(job))
+
+# Flask CLI command to re-run detection over the history after a model change
+@click.command("rescore")
+@click.option("--model", "model_path", default=None, type=click.Path(exists=True),
+              help="Weights to rescore with (default: MODEL_PATH).")
+@click.option("--workers", default=1, type=int, help="Inference worker processes.")
+@click.option("--resume", "resume_id", default=None, type=int, help="Continue a stopped or failed job.")
+@click.option("--max-rate", default=None, type=float, help="Maximum images per second.")
+@click.option("--admin", "username", default="admin", help="Admin user recorded in the audit log.")
+def rescore_command(model_path, workers, resume_id, max_rate, username):
+    """Re-run detection on stored uploads, resumably, in worker processes."""
+    # Load the weights in this process: a running model server keeps the model
+    # it started with, and its boxes would be stored under the new version
+    if current_app.config.get('MODEL_SERVER'):
+        current_app.config['MODEL_SERVER'] = False
+        get_model.cache_clear()
+    if model_path:
+        current_app.config['MODEL_PATH'] = model_path
+        get_model.cache_clear()
+        get_model_version.cache_clear()
+
+    if resume_id:
+        job = RescoreJob.query.get(resume_id)
+        if not job:
+            click.echo(f"Rescore job {resume_id} not found")
+            return
+        if job.status == 'done':
+            click.echo(f"Rescore job {job.id} is already done")
+            return
+        if job.model_version != get_model_version():
+            click.echo(f"Job {job.id} was for model {job.model_version}, the configured model is {get_model_version()}")
+            return
+        if not claim_job(job.id, job.status):
+            click.echo(f"Rescore job {job.id} was started by another process")
+            return
+        click.echo(f"Resuming job {job.id} after upload {job.last_upload_id}")
+    else:
+        admin = Admin.query.filter_by(username=username).first()
+        # Created running, so inference workers polling for pending jobs never pick it up
+        job = RescoreJob(admin_id=admin.id if admin else None, model_version=get_model_version(), status='running')
+        db.session.add(job)
+        db.session.commit()
+        click.echo(f"Rescore job {job.id} for model {job.model_version}")
+
+    job = run_rescore(job.id, workers=max(1, workers), max_rate=max_rate, progress=click.echo)
+    if job.status == 'done' and job.admin_id:
+        log_action(job.admin_id, "rescore", f"Rescored {job.processed} uploads with model {job.model_version}")
+    elif job.status == 'failed':
+        click.echo(f"Failed: {job.error_message}. Resume with: flask rescore --resume {job.id}")
@@ -0,0 +1,422 @@
+from flask import current_app
+import click
+import io
+import os
+import shutil
+import threading
+import time
+import uuid
+from database import db, Upload, DetectionCache
+
+# Uploads are stored under keys such as originals/ab/cd/<sha256>.jpg; the two
+# shard levels keep any one directory (or S3 prefix listing) small. Absolute
+# paths in file_path are legacy files written before the storage layer and
+# are still read from disk until `flask migrate-storage` moves them
+STORAGE_BACKENDS = ('local', 's3')
+COPY_CHUNK_SIZE = 1024 * 1024
+# Fetched S3 objects used this recently are never evicted, so a reader
+# that was just handed a local path can still open it
+BLOB_CACHE_GRACE = 300
+# A *.tmp file is a write in progress (see write_atomic) unless it is older than this
+TEMP_FILE_GRACE = 3600
+
+def shard(name):
+    """Two directory levels from the first four hex characters of a file name"""
+    stem = os.path.splitext(name)[0].replace('processed_', '')
+    return f"{stem[:2]}/{stem[2:4]}"
+
+def original_key(digest, extension):
+    return f"originals/{shard(digest)}/{digest}{extension}"
+
+def processed_key(name=None):
+    """Key for a processed image; a new unique name unless one is given"""
+    name = name or f"processed_{uuid.uuid4().hex}.jpg"
+    return f"processed/{shard(name)}/{name}"
+
+def is_legacy_path(ref):
+    return os.path.isabs(ref)
+
+def write_atomic(path, data):
+    """Write bytes or a readable stream under a temporary name, then rename"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f, COPY_CHUNK_SIZE)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def evict_lru(folder, max_bytes, min_age=0):
+    """Delete least recently used files under folder once it exceeds max_bytes.
+
+    The modification time is the last-used time; files touched within
+    min_age seconds are kept. Temporary files of writes in progress are
+    left alone; only ones abandoned for TEMP_FILE_GRACE are removed. Goes
+    down to 90% of the limit so it does not run again on every write.
+    Returns the number of files removed.
+    """
+    entries = []
+    total = 0
+    temp_cutoff = time.time() - TEMP_FILE_GRACE
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith('.tmp') and stat.st_mtime > temp_cutoff:
+                total += stat.st_size
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= max_bytes:
+        return 0
+
+    removed = 0
+    cutoff = time.time() - min_age
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes * 0.9 or mtime > cutoff:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+class LocalStorage:
+    """Hash-sharded directories under UPLOAD_FOLDER"""
+    name = 'local'
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, ref):
+        if is_legacy_path(ref):
+            return ref
+        return os.path.join(self.root, *ref.split('/'))
+
+    def save(self, key, data):
+        write_atomic(self.path(key), data)
+
+    def open(self, ref):
+        return open(self.path(ref), 'rb')
+
+    def exists(self, ref):
+        return os.path.isfile(self.path(ref))
+
+    def size(self, ref):
+        try:
+            return os.path.getsize(self.path(ref))
+        except OSError:
+            return None
+
+    def delete(self, ref):
+        try:
+            os.remove(self.path(ref))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, ref):
+        path = self.path(ref)
+        return path if os.path.isfile(path) else None
+
+    def iter_keys(self, prefix):
+        folder = self.path(prefix.rstrip('/'))
+        for root, _, names in os.walk(folder):
+            for name in names:
+                if not name.endswith('.tmp'):
+                    yield os.path.relpath(os.path.join(root, name), self.root).replace(os.sep, '/')
+
+class S3Storage:
+    """S3-compatible object storage (AWS S3, MinIO, Ceph RGW).
+
+    Writes above the multipart threshold go up in parallel parts, reads
+    stream the object body. Code that needs a file on disk (OpenCV, Pillow,
+    send_file) gets a copy downloaded into STORAGE_S3_CACHE_FOLDER, which is
+    kept under STORAGE_S3_CACHE_MAX_MB separately from the derivatives.
+    """
+    name = 's3'
+
+    def __init__(self, config):
+        # boto3 is only needed with STORAGE_BACKEND=s3
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.exceptions import ClientError
+        self._boto3 = boto3
+        self._client_error = ClientError
+        self.bucket = config['STORAGE_S3_BUCKET']
+        if not self.bucket:
+            raise RuntimeError("STORAGE_S3_BUCKET must be set when STORAGE_BACKEND=s3")
+        self.prefix = (config.get('STORAGE_S3_PREFIX') or '').strip('/')
+        self.endpoint_url = config.get('STORAGE_S3_ENDPOINT_URL') or None
+        self.region = config.get('STORAGE_S3_REGION') or None
+        self.cache_folder = config['STORAGE_S3_CACHE_FOLDER']
+        self.cache_max_bytes = config.get('STORAGE_S3_CACHE_MAX_MB', 2048) * 1024 * 1024
+        self._eviction_lock = threading.Lock()
+        self._last_eviction = 0.0
+        self.transfer = TransferConfig(
+            multipart_threshold=config.get('STORAGE_S3_MULTIPART_THRESHOLD_MB', 8) * 1024 * 1024,
+            multipart_chunksize=config.get('STORAGE_S3_MULTIPART_CHUNK_MB', 8) * 1024 * 1024,
+            max_concurrency=config.get('STORAGE_S3_MAX_CONCURRENCY', 4))
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self.legacy = LocalStorage(config['UPLOAD_FOLDER'])
+
+    @property
+    def client(self):
+        # Clients are thread-safe but must not cross a fork, so each worker makes its own
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = self._boto3.session.Session().client(
+                        's3', endpoint_url=self.endpoint_url, region_name=self.region)
+                    self._pid = os.getpid()
+        return self._client
+
+    def object_key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _os_error(self, error, ref):
+        if self._missing(error):
+            return FileNotFoundError(f"{ref} not found in bucket {self.bucket}")
+        return OSError(f"S3 error for {ref}: {error}")
+
+    def save(self, key, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = io.BytesIO(data)
+        try:
+            self.client.upload_fileobj(data, self.bucket, self.object_key(key), Config=self.transfer)
+        except self._client_error as e:
+            raise self._os_error(e, key)
+
+    def open(self, ref):
+        """Streaming body of an object; read it in chunks or all at once"""
+        if is_legacy_path(ref):
+            return self.legacy.open(ref)
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(ref))['Body']
+        except self._client_error as e:
+            raise self._os_error(e, ref)
+
+    def _head(self, ref):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(ref))
+        except self._client_error as e:
+            if self._missing(e):
+                return None
+            raise self._os_error(e, ref)
+
+    def exists(self, ref):
+        if is_legacy_path(ref):
+            return self.legacy.exists(ref)
+        return self._head(ref) is not None
+
+    def size(self, ref):
+        if is_legacy_path(ref):
+            return self.legacy.size(ref)
+        head = self._head(ref)
+        return head['ContentLength'] if head else None
+
+    def delete(self, ref):
+        if is_legacy_path(ref):
+            return self.legacy.delete(ref)
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(ref))
+        cached = os.path.join(self.cache_folder, *ref.split('/'))
+        if os.path.exists(cached):
+            os.remove(cached)
+
+    def local_path(self, ref):
+        if is_legacy_path(ref):
+            return self.legacy.local_path(ref)
+        path = os.path.join(self.cache_folder, *ref.split('/'))
+        if os.path.isfile(path):
+            # The modification time doubles as the last-used time for eviction
+            os.utime(path)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            # Ranged GETs in parallel for large objects
+            self.client.download_file(self.bucket, self.object_key(ref), temp_path, Config=self.transfer)
+            os.replace(temp_path, path)
+        except self._client_error as e:
+            if not self._missing(e):
+                print(f"Error fetching {ref} from S3: {e}")
+            return None
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict_cache()
+        return path
+
+    def evict_cache(self):
+        """Keep the local copies under their size limit; scans at most once a minute per process"""
+        now = time.monotonic()
+        if now - self._last_eviction < 60 or not self._eviction_lock.acquire(blocking=False):
+            return 0
+        try:
+            self._last_eviction = now
+            return evict_lru(self.cache_folder, self.cache_max_bytes, BLOB_CACHE_GRACE)
+        finally:
+            self._eviction_lock.release()
+
+    def iter_keys(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        start = len(self.prefix) + 1 if self.prefix else 0
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.object_key(prefix)):
+            for item in page.get('Contents', []):
+                yield item['Key'][start:]
+
+class Storage:
+    """Blob store for originals and processed images, chosen by STORAGE_BACKEND.
+
+    Upload.file_path and processed_file_path hold storage keys; every read,
+    write and delete of those files goes through here.
+    """
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        name = app.config.get('STORAGE_BACKEND', 'local')
+        if name not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown STORAGE_BACKEND {name!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
+        if name == 's3':
+            self.backend = S3Storage(app.config)
+        else:
+            self.backend = LocalStorage(app.config['UPLOAD_FOLDER'])
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def save(self, key, data):
+        """Store bytes or a readable stream under key"""
+        self.backend.save(key, data)
+
+    def open(self, ref):
+        """Readable binary stream of a stored file; raises OSError if it is missing"""
+        return self.backend.open(ref)
+
+    def exists(self, ref):
+        return bool(ref) and self.backend.exists(ref)
+
+    def size(self, ref):
+        return self.backend.size(ref) if ref else None
+
+    def delete(self, ref):
+        if ref:
+            self.backend.delete(ref)
+
+    def local_path(self, ref):
+        """Path of the file on local disk for readers that need one, or None if missing"""
+        if not ref:
+            return None
+        return self.backend.local_path(ref)
+
+    def iter_keys(self, prefix):
+        return self.backend.iter_keys(prefix)
+
+storage = Storage()
+
+def migrated_key(ref, kind, digest=None):
+    """Sharded key for a stored file, or None if it already has one"""
+    name = os.path.basename(ref)
+    if kind == 'original':
+        extension = os.path.splitext(name)[1].lower()
+        key = original_key(digest, extension) if digest else f"originals/{shard(name)}/{name}"
+    else:
+        key = processed_key(name)
+    return None if key == ref else key
+
+def copy_to_storage(source_path, key):
+    with open(source_path, 'rb') as f:
+        storage.save(key, f)
+
+def link_into_place(source_path, target_path):
+    """Give a local file its new name as well; the old one is removed after the commit"""
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+    except FileExistsError:
+        # Same content already stored under this key
+        pass
+    except OSError:
+        # No hard links here (e.g. another filesystem); fall back to a copy
+        with open(source_path, 'rb') as f:
+            write_atomic(target_path, f)
+
+# Flask CLI command to move uploads into the sharded layout / configured backend
+@click.command("migrate-storage")
+@click.option("--dry-run", is_flag=True, help="Only report what would change.")
+@click.option("--keep-local", is_flag=True, help="Leave the local copies in place after copying.")
+def migrate_storage_command(dry_run, keep_local):
+    """Copy stored images into STORAGE_BACKEND and rewrite file_path values to storage keys."""
+    local = LocalStorage(current_app.config['UPLOAD_FOLDER'])
+    # (ref, kind, content hash) of every file the database points at
+    refs = {}
+    for file_path, digest in db.session.query(Upload.file_path, Upload.content_hash):
+        if file_path:
+            refs.setdefault(file_path, ('original', digest))
+    for (path,) in db.session.query(Upload.processed_file_path).filter(Upload.processed_file_path.isnot(None)):
+        refs.setdefault(path, ('processed', None))
+    for (path,) in db.session.query(DetectionCache.processed_file_path).filter(
+            DetectionCache.processed_file_path.isnot(None)):
+        refs.setdefault(path, ('processed', None))
+
+    copied = rewritten = missing = 0
+    copied_from = []
+    for ref, (kind, digest) in sorted(refs.items()):
+        key = migrated_key(ref, kind, digest) or ref
+        source = local.local_path(ref)
+        # Already in place: a sharded key that the configured backend holds
+        if key == ref and (storage.name == 'local' or storage.exists(key)):
+            continue
+        if source is None:
+            if not storage.exists(key):
+                missing += 1
+                print(f" Missing file for {ref}")
+                continue
+        elif not dry_run:
+            # Nothing is moved before the commit: a failed run leaves every
+            # row pointing at a file that still exists
+            if storage.name == 'local':
+                link_into_place(source, local.path(key))
+            else:
+                copy_to_storage(source, key)
+            copied_from.append(source)
+        copied += source is not None
+        if key == ref:
+            continue
+        rewritten += 1
+        if kind == 'original':
+            Upload.query.filter_by(file_path=ref).update({'file_path': key}, synchronize_session=False)
+        else:
+            Upload.query.filter_by(processed_file_path=ref).update(
+                {'processed_file_path': key}, synchronize_session=False)
+            DetectionCache.query.filter_by(processed_file_path=ref).update(
+                {'processed_file_path': key}, synchronize_session=False)
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+        # Local copies go only once the rows point at their new home
+        if not keep_local:
+            for path in copied_from:
+                os.remove(path)
+    click.echo(f"{len(refs)} stored files, {copied} stored in {storage.name} storage, "
+               f"{rewritten} paths rewritten, {missing} missing" + (" (dry run)" if dry_run else ""))
@@ -0,0 +1,79 @@
+"""Shared fixtures: the app on a scratch database and folders, with the stub model"""
+import os
+import shutil
+import tempfile
+import pytest
+from benchmarks.stub import install_stub_backend
+
+# app.py reads its configuration at import time, so the environment is set
+# before any test module imports it
+WORKDIR = tempfile.mkdtemp(prefix='xray_tests_')
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(WORKDIR, 'test.db')}",
+    'INFERENCE_BACKEND': 'stub',
+    'MODEL_PATH': install_stub_backend(),
+    'REPORT_FOLDER': os.path.join(WORKDIR, 'reports'),
+    'DERIVATIVE_FOLDER': os.path.join(WORKDIR, 'derivatives'),
+    'UPLOAD_FOLDER': os.path.join(WORKDIR, 'uploads'),
+    'SECRET_KEY': 'test'
+})
+
+# Rows every test may rely on; everything else is cleared after each test
+KEPT_TABLES = ('admin', 'schema_version')
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    from detection import model_ready
+    app.config['TESTING'] = True
+    assert model_ready.wait(30), "stub model did not become ready"
+    yield app
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+@pytest.fixture
+def db(app):
+    """The database and stored files inside an app context, emptied again after the test"""
+    from database import db
+    from jobs import inference_queue
+    from audit import audit_log
+    with app.app_context():
+        yield db
+        inference_queue.drain()
+        audit_log.flush()
+        db.session.remove()
+        with db.engine.begin() as conn:
+            for table in reversed(db.metadata.sorted_tables):
+                if table.name not in KEPT_TABLES:
+                    conn.execute(table.delete())
+        for folder in (app.config['UPLOAD_FOLDER'], app.config['DERIVATIVE_FOLDER']):
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+
+@pytest.fixture
+def admin_id(db):
+    from database import Admin
+    return Admin.query.filter_by(username='admin').first().id
+
+@pytest.fixture
+def client(app, admin_id):
+    """Test client logged in as the default admin"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+        session['admin_id'] = admin_id
+    return client
+
+@pytest.fixture
+def socket_path():
+    """A Unix socket path; these are limited to ~100 characters, too short for tmp_path"""
+    folder = tempfile.mkdtemp(prefix='ms_')
+    yield os.path.join(folder, 'model.sock')
+    shutil.rmtree(folder, ignore_errors=True)
+
+@pytest.fixture
+def config(app):
+    """app.config, with every change made by the test undone afterwards"""
+    saved = dict(app.config)
+    yield app.config
+    app.config.clear()
+    app.config.update(saved)
@@ -0,0 +1,142 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import admission as admission_module
+import bulk
+from admission import admission, take_token, admission_rejections_total, BatchSlots
+from tests.utils import xray_jpeg, add_upload
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Admission control on with generous limits; tests tighten the one they exercise"""
+    for name, value in (('enabled', True), ('rate', 0.0), ('burst', 1), ('max_queue', 0), ('max_concurrent', 4),
+                        ('active', 0), ('_pending', (0.0, 0))):
+        monkeypatch.setattr(admission, name, value)
+    return admission
+
+def rejections(reason):
+    return sum(value for labels, value in admission_rejections_total.samples()
+               if labels == {'endpoint': 'detection.upload_file', 'reason': reason})
+
+def upload(client, **kwargs):
+    return client.post('/upload', data={'file': (io.BytesIO(xray_jpeg(1)), 'scan.jpg')},
+                       content_type='multipart/form-data', **kwargs)
+
+def test_token_bucket_allows_a_burst_then_refills(db):
+    assert [take_token('admin:1', 1.0, 3, now=100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert take_token('admin:1', 1.0, 3, now=100.0) == pytest.approx(1.0)
+    assert take_token('admin:1', 1.0, 3, now=100.5) == pytest.approx(0.5)
+    assert take_token('admin:1', 1.0, 3, now=101.0) == 0.0
+    # Refilling stops at the burst size
+    assert [take_token('admin:1', 1.0, 3, now=200.0) for _ in range(4)][-1] == pytest.approx(1.0)
+    # Every admin has a bucket of their own
+    assert take_token('admin:2', 1.0, 3, now=100.0) == 0.0
+
+def test_rate_limit_fails_open(db, limits, monkeypatch):
+    limits.rate = 1.0
+    assert limits.rate_limited(None) == 0.0
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(admission_module, 'take_token', broken)
+    assert limits.rate_limited(1) == 0.0
+
+def test_rate_limited_uploads_get_429(client, limits):
+    limits.rate, limits.burst = 1 / 60.0, 1
+    before = rejections('rate_limit')
+    assert upload(client).status_code == 302
+    response = upload(client)
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= limits.max_retry_after
+    assert b"Too Many Requests" in response.data
+    assert rejections('rate_limit') == before + 1
+
+def test_full_backlog_gets_503(client, limits):
+    limits.max_queue = 1
+    add_upload(xray_jpeg(2), status='pending')
+    response = upload(client, headers={'Accept': 'application/json'})
+    assert response.status_code == 503
+    assert response.get_json()['reason'] == 'queue_full'
+    assert 'Retry-After' in response.headers
+
+def test_concurrency_limit_keeps_read_endpoints_free(client, limits):
+    limits.max_concurrent, limits.active = 2, 2
+    response = upload(client, headers={'Accept': 'application/json'})
+    assert response.status_code == 503
+    assert response.get_json() == {"error": "The server is handling as many uploads as it can.",
+                                   "reason": "concurrency", "retry_after": 1}
+    assert response.headers['Retry-After'] == '1'
+    # History and the result pages never pass through admission control
+    assert client.get('/history').status_code == 200
+
+def test_slots_are_released(client, limits):
+    limits.max_concurrent = 1
+    for _ in range(2):
+        assert upload(client).status_code == 302
+    assert limits.active == 0
+
+def test_api_rejections_are_json(app, db, limits):
+    token = app.test_cli_runner().invoke(args=['create-token', 'ci']).output.strip()
+    limits.max_concurrent = 0
+    response = app.test_client().post('/api/v1/detections', data=xray_jpeg(1), content_type='image/jpeg',
+                                      headers={'Authorization': f"Bearer {token}"})
+    assert response.status_code == 503
+    assert response.get_json()['reason'] == 'concurrency'
+
+def test_batch_slots_charge_images_beyond_the_first(limits):
+    limits.max_concurrent, limits.active = 2, 1
+    slots = BatchSlots(4, limits)
+    # The request's own slot covers the first image, the second takes the last free one
+    slots.acquire()
+    slots.acquire()
+    assert (slots.running, limits.active) == (2, 2)
+
+    third = threading.Thread(target=slots.acquire)
+    third.start()
+    third.join(0.2)
+    assert third.is_alive()
+    slots.release()
+    third.join(5)
+    assert (slots.running, limits.active) == (2, 2)
+    slots.release()
+    slots.release()
+    assert (slots.running, limits.active) == (0, 1)
+
+def test_batch_uploads_count_against_the_concurrency_limit(app, client, admin_id, limits, monkeypatch):
+    limits.max_concurrent = 2
+    gate = threading.Event()
+
+    def blocked_detect(app, data):
+        gate.wait(5)
+        return {'detection_result': 'none', 'confidence_score': 0.0, 'processed_file_path': None,
+                'predictions': [], 'boxes': []}, None, 0.0
+    monkeypatch.setattr(bulk, '_detect', blocked_detect)
+    batch_client = app.test_client()
+    with batch_client.session_transaction() as session:
+        session['admin_logged_in'] = True
+        session['admin_id'] = admin_id
+    files = [(io.BytesIO(xray_jpeg(20 + index)), f"{index}.jpg") for index in range(3)]
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        batch = pool.submit(batch_client.post, '/upload_batch', data={'files': files},
+                            content_type='multipart/form-data', headers={'Accept': 'application/json'})
+        deadline = time.monotonic() + 5
+        while limits.active < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Two images of the batch in flight fill both slots
+        rejected = upload(client, headers={'Accept': 'application/json'})
+        gate.set()
+        response = batch.result(10)
+    assert rejected.status_code == 503 and rejected.get_json()['reason'] == 'concurrency'
+    assert response.get_json()['ok'] == 3
+    assert limits.active == 0
+
+def test_disabled_admission_control(client, limits):
+    limits.enabled, limits.max_concurrent = False, 0
+    assert upload(client).status_code == 302
+
+def test_stats(limits):
+    limits.rate, limits.max_queue = 0.5, 10
+    assert limits.stats() == {'enabled': True, 'active': 0, 'max_concurrent_per_worker': 4, 'max_queue': 10,
+                              'rate_limit_per_minute': 30.0}
@@ -0,0 +1,81 @@
+import io
+import time
+from urllib.parse import urlparse
+import pytest
+from jobs import inference_queue
+from tests.utils import xray_jpeg
+
+@pytest.fixture
+def token(app, db):
+    result = app.test_cli_runner().invoke(args=['create-token', 'ci'])
+    assert result.exit_code == 0, result.output
+    return result.output.strip()
+
+@pytest.fixture
+def api(app, token):
+    """Test client sending the bearer token"""
+    client = app.test_client()
+
+    def call(method, path, **kwargs):
+        headers = dict(kwargs.pop('headers', {}), Authorization=f"Bearer {token}")
+        return client.open(path, method=method, headers=headers, **kwargs)
+    return call
+
+def test_requests_need_a_valid_token(app, token):
+    client = app.test_client()
+    assert client.get('/api/v1/detections').status_code == 401
+    assert client.get('/api/v1/detections', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get('/api/v1/detections', headers={'Authorization': f"Bearer {token}"}).status_code == 200
+
+    assert app.test_cli_runner().invoke(args=['revoke-token', 'ci']).output.strip() == "Revoked 1 token(s)"
+    assert client.get('/api/v1/detections', headers={'Authorization': f"Bearer {token}"}).status_code == 401
+
+def test_raw_image_with_wait_returns_the_result(api):
+    response = api('POST', '/api/v1/detections?wait=10&filename=scan.jpg', data=xray_jpeg(1),
+                   content_type='image/jpeg')
+    assert response.status_code == 201
+    detection = response.get_json()
+    assert detection['status'] == 'done' and detection['file_name'] == 'scan.jpg'
+    assert detection['detection_result'] == 'foreign_object'
+    assert detection['predictions'][0]['confidence'] == pytest.approx(0.87)
+    assert response.headers['Location'].endswith(f"/api/v1/detections/{detection['id']}")
+
+    assert api('GET', f"/api/v1/detections/{detection['id']}").get_json()['id'] == detection['id']
+    image = api('GET', f"/api/v1/detections/{detection['id']}/image/original")
+    assert image.status_code == 200 and image.data == xray_jpeg(1)
+
+def test_overlay_url_without_a_stored_processed_file(api, config, monkeypatch):
+    config['STORE_PROCESSED_IMAGES'] = False
+    detection = api('POST', '/api/v1/detections?wait=10', data=xray_jpeg(2), content_type='image/jpeg').get_json()
+    assert detection['has_processed']
+    overlay = api('GET', urlparse(detection['images']['processed']).path)
+    assert overlay.status_code == 200 and overlay.mimetype == 'image/jpeg'
+
+    # Nothing to draw until detection has run
+    monkeypatch.setattr(inference_queue, 'external', True)
+    queued = api('POST', '/api/v1/detections', data=xray_jpeg(3), content_type='image/jpeg').get_json()
+    assert queued['images']['processed'] is None and not queued['has_processed']
+
+def test_multipart_files_are_reported_one_by_one(api):
+    response = api('POST', '/api/v1/detections?wait=10', content_type='multipart/form-data',
+                   data={'files': [(io.BytesIO(xray_jpeg(2)), 'a.jpg'), (io.BytesIO(b'garbage'), 'b.jpg')]})
+    items = response.get_json()['items']
+    assert items[0]['status'] == 'done'
+    assert items[1] == {'file_name': 'b.jpg', 'error': "Invalid image file."}
+
+def test_bad_requests(api):
+    assert api('POST', '/api/v1/detections', data=b'{}', content_type='application/json').status_code == 400
+    assert api('POST', '/api/v1/detections', data=b'garbage', content_type='image/jpeg').status_code == 400
+    assert api('GET', '/api/v1/detections/999999').status_code == 404
+    assert api('GET', '/api/v1/detections?after=bogus').status_code == 400
+
+def test_external_inference_is_polled_until_the_wait_runs_out(api, monkeypatch):
+    monkeypatch.setattr(inference_queue, 'external', True)
+    started = time.monotonic()
+    response = api('POST', '/api/v1/detections?wait=0.3', data=xray_jpeg(3), content_type='image/jpeg')
+    assert response.status_code == 202
+    assert response.get_json()['status'] == 'pending'
+    assert time.monotonic() - started >= 0.3
+
+def test_wait_only_knows_jobs_queued_here():
+    assert inference_queue.wait(999999, 0.1) is None
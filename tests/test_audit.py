@@ -0,0 +1,62 @@
+import csv
+import io
+import time
+from audit import AuditLogWriter, log_action
+from database import Log
+
+def make_writer(app, batch_size=100, max_attempts=5):
+    writer = AuditLogWriter()
+    writer.app = app
+    writer.batch_size = batch_size
+    writer.max_attempts = max_attempts
+    # Flushed by the test, not by the background thread
+    writer.flush_interval = 3600
+    return writer
+
+def test_entries_are_buffered_until_flushed(app, db, admin_id):
+    writer = make_writer(app)
+    for index in range(3):
+        writer.record(admin_id, 'upload_detection', f"file {index}")
+    assert writer.pending() == 3 and Log.query.count() == 0
+
+    assert writer.flush() == 3
+    assert writer.pending() == 0
+    assert [log.details for log in Log.query.order_by(Log.id)] == ['file 0', 'file 1', 'file 2']
+
+def test_full_buffer_wakes_the_writer(app, db, admin_id):
+    writer = make_writer(app, batch_size=2)
+    writer.record(admin_id, 'login')
+    assert not writer._wakeup.is_set()
+    writer.record(admin_id, 'logout')
+    deadline = time.monotonic() + 5
+    while writer.flushed < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert Log.query.count() == 2
+
+def test_bad_entry_does_not_hold_back_the_batch(app, db, admin_id):
+    writer = make_writer(app, max_attempts=3)
+    writer.record(admin_id, 'login')
+    writer.record(admin_id, None)
+    writer.record(admin_id, 'logout')
+
+    assert writer.flush() == 2
+    assert writer.pending() == 1
+    assert writer.flush() == 0 and writer.flush() == 0
+    assert writer.pending() == 0 and writer.dropped == 1
+    assert {log.action for log in Log.query} == {'login', 'logout'}
+
+def test_unbuffered_writes_immediately(app, db, admin_id):
+    writer = make_writer(app)
+    writer.enabled = False
+    writer.record(admin_id, 'login')
+    assert Log.query.count() == 1
+
+def test_csv_export_includes_buffered_entries(client, admin_id):
+    log_action(admin_id, 'generate_report', 'Generated report with 3 images')
+    log_action(admin_id, 'login')
+    response = client.get('/audit_log.csv?action=generate_report')
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    assert rows[0] == ['id', 'timestamp', 'admin', 'action', 'details']
+    assert [row[2:] for row in rows[1:]] == [['admin', 'generate_report', 'Generated report with 3 images']]
+    assert client.get('/audit_log.csv?start_date=yesterday').status_code == 400
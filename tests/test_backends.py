@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import backends
+from benchmarks.stub import StubBackend
+from backends import Boxes, OnnxBackend, as_numpy_boxes, box_iou, default_export_path, get_backend_class, match_detections
+from tests.utils import xray_jpeg
+
+def onnx_backend(imgsz):
+    """OnnxBackend without a session, for its pre- and post-processing"""
+    backend = object.__new__(OnnxBackend)
+    backend.imgsz = imgsz
+    return backend
+
+def test_box_iou():
+    a = np.array([[0, 0, 10, 10]], dtype=np.float32)
+    b = np.array([[0, 0, 10, 10], [5, 0, 15, 10], [20, 20, 30, 30]], dtype=np.float32)
+    assert np.allclose(box_iou(a, b), [[1.0, 1 / 3, 0.0]], atol=1e-6)
+
+def test_match_detections_pairs_boxes_of_the_same_class():
+    reference = Boxes([[0, 0, 10, 10], [20, 20, 30, 30]], [0.9, 0.8], [0, 1])
+    candidate = Boxes([[1, 1, 10, 10], [20, 20, 30, 30]], [0.7, 0.8], [0, 0])
+    matched, differences = match_detections(reference, candidate)
+    assert matched == 1
+    assert differences == pytest.approx([0.2])
+
+def test_as_numpy_boxes_converts_tensor_like_boxes():
+    class Tensor:
+        def __init__(self, values):
+            self.values = values
+
+        def cpu(self):
+            return self
+
+        def numpy(self):
+            return np.asarray(self.values)
+
+    class TorchBoxes:
+        xyxy = Tensor([[1, 2, 3, 4]])
+        conf = Tensor([0.5])
+        cls = Tensor([2])
+
+    boxes = as_numpy_boxes(TorchBoxes())
+    assert isinstance(boxes, Boxes) and len(boxes) == 1
+    assert boxes.xyxy.tolist() == [[1, 2, 3, 4]] and boxes.cls.tolist() == [2]
+    assert as_numpy_boxes(boxes) is boxes
+
+def test_backend_registry():
+    assert get_backend_class({}).name == 'torch'
+    assert get_backend_class({'INFERENCE_BACKEND': 'onnx'}) is OnnxBackend
+    with pytest.raises(ValueError):
+        get_backend_class({'INFERENCE_BACKEND': 'tensorrt'})
+
+def test_default_export_paths():
+    assert default_export_path('models/best.pt', 'onnx') == 'models/best.onnx'
+    assert default_export_path('models/best.pt', 'onnx', int8=True) == 'models/best_int8.onnx'
+    assert default_export_path('models/best.pt', 'openvino') == 'models/best_openvino_model'
+
+def test_onnx_letterbox_pads_to_a_square():
+    tensor, ratio, pad = onnx_backend(64)._letterbox(np.zeros((32, 64, 3), dtype=np.uint8))
+    assert tensor.shape == (3, 64, 64) and tensor.dtype == np.float32
+    assert ratio == 1.0 and pad == (0, 16)
+    # Padding rows carry the letterbox colour, the image rows stay black
+    assert tensor[0, 0, 0] == pytest.approx(114 / 255) and tensor[0, 32, 32] == 0
+
+def test_onnx_postprocess_thresholds_runs_class_aware_nms_and_undoes_the_letterbox():
+    # Columns are anchors: centre x, centre y, width, height, then one score per class
+    prediction = np.array([
+        [32, 32, 32, 32],
+        [32, 32, 32, 32],
+        [10, 10, 10, 10],
+        [10, 10, 10, 10],
+        [0.9, 0.8, 0.0, 0.1],
+        [0.0, 0.0, 0.7, 0.0],
+    ], dtype=np.float32)
+    boxes = onnx_backend(64)._postprocess(prediction, 1.0, (0, 16), (32, 64), conf=0.25, iou=0.7, max_det=300)
+    assert boxes.conf.tolist() == pytest.approx([0.9, 0.7])
+    assert boxes.cls.tolist() == [0, 1]
+    assert boxes.xyxy[0].tolist() == pytest.approx([27, 11, 37, 21])
+
+def test_onnx_postprocess_without_boxes():
+    prediction = np.zeros((5, 3), dtype=np.float32)
+    assert len(onnx_backend(64)._postprocess(prediction, 1.0, (0, 0), (64, 64), 0.25, 0.7, 300)) == 0
+
+def test_check_backend_needs_sample_images(app, db):
+    result = app.test_cli_runner().invoke(args=['check-backend', '--backend', 'stub'])
+    assert result.exit_code != 0 and "No sample images found" in result.output
+
+def test_check_backend_samples_flat_legacy_uploads(app, db, config, monkeypatch):
+    for index in range(2):
+        with open(f"{config['UPLOAD_FOLDER']}/legacy_{index}.jpg", 'wb') as f:
+            f.write(xray_jpeg(index))
+    # The stub stands in for the PyTorch reference as well
+    monkeypatch.setattr(backends, 'create_backend', lambda config, name=None: StubBackend(config))
+    result = app.test_cli_runner().invoke(args=['check-backend', '--backend', 'stub'])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("Images: 2  torch boxes: 4  stub boxes: 4  matched: 4")
@@ -0,0 +1,59 @@
+import threading
+import pytest
+from batching import MicroBatcher
+
+def make_batcher(app, handler, max_batch_size=4, max_wait_ms=200):
+    batcher = MicroBatcher()
+    batcher.init_app(app, handler)
+    batcher.max_batch_size = max_batch_size
+    batcher.max_wait = max_wait_ms / 1000.0
+    return batcher
+
+def test_concurrent_images_share_one_batch(app):
+    batches = []
+
+    def handler(images):
+        batches.append(list(images))
+        return [image * 10 for image in images]
+
+    batcher = make_batcher(app, handler)
+    futures = [batcher.submit(image) for image in range(1, 5)]
+    assert [future.result(timeout=5) for future in futures] == [10, 20, 30, 40]
+    assert batches == [[1, 2, 3, 4]]
+    assert batcher.stats()['batch_size']['count'] == 1
+
+def test_batches_are_capped_at_max_batch_size(app):
+    sizes = []
+    release = threading.Event()
+
+    def handler(images):
+        release.wait(5)
+        sizes.append(len(images))
+        return images
+
+    batcher = make_batcher(app, handler, max_batch_size=3)
+    futures = [batcher.submit(image) for image in range(7)]
+    release.set()
+    assert [future.result(timeout=5) for future in futures] == list(range(7))
+    assert max(sizes) <= 3 and sum(sizes) == 7
+
+def test_lone_image_waits_at_most_max_wait(app):
+    batcher = make_batcher(app, lambda images: images, max_wait_ms=10)
+    assert batcher.predict('only', timeout=5) == 'only'
+    assert batcher.stats()['latency_seconds']['avg'] < 1.0
+
+def test_handler_error_fails_the_whole_batch(app):
+    def handler(images):
+        raise ValueError("bad batch")
+
+    batcher = make_batcher(app, handler, max_wait_ms=50)
+    futures = [batcher.submit(image) for image in range(2)]
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+def test_wrong_number_of_results_is_an_error(app):
+    batcher = make_batcher(app, lambda images: images[:1], max_wait_ms=50)
+    futures = [batcher.submit(image) for image in range(2)]
+    with pytest.raises(RuntimeError):
+        futures[1].result(timeout=5)
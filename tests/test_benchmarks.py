@@ -0,0 +1,45 @@
+import json
+import pytest
+from benchmarks import compare
+from benchmarks.run import Scenario, percentile
+from benchmarks.stub import synthetic_xray, load_xray, MB
+
+def results(**scenarios):
+    return {'meta': {'commit': 'abc'}, 'scenarios': scenarios}
+
+def test_percentile_interpolates():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([0, 10], 95) == pytest.approx(9.5)
+
+def test_scenario_summary():
+    scenario = Scenario('upload', track_rss=False).run(lambda i: (0.01 * (i + 1), i != 3), 4, concurrency=2)
+    summary = scenario.summary()
+    assert (summary['count'], summary['errors']) == (4, 1)
+    assert summary['p50_ms'] == pytest.approx(25.0)
+    assert summary['throughput_rps'] > 0
+
+def test_compare_gates_p95_throughput_and_errors():
+    base = results(upload={'p50_ms': 10, 'p95_ms': 20, 'throughput_rps': 50},
+                   history={'p95_ms': 5, 'throughput_rps': 100})
+    head = results(upload={'p50_ms': 30, 'p95_ms': 21, 'throughput_rps': 49},
+                   history={'p95_ms': 5, 'throughput_rps': 70, 'errors': 2})
+    regressed = {(name, metric) for name, metric, _, _, _, worse in compare.compare(base, head, 0.15) if worse}
+    # p50 tripled but is informational only
+    assert regressed == {('history', 'throughput_rps'), ('history', 'errors')}
+
+def test_compare_exit_status(tmp_path, capsys):
+    base, head = tmp_path / 'base.json', tmp_path / 'head.json'
+    base.write_text(json.dumps(results(upload={'p95_ms': 20})))
+    head.write_text(json.dumps(results(upload={'p95_ms': 22})))
+    assert compare.main([str(base), str(head)]) == 0
+    assert compare.main([str(base), str(head), '--threshold', '0.05']) == 1
+    assert 'REGRESSION' in capsys.readouterr().out
+
+def test_synthetic_xray_size_and_cache(tmp_path):
+    data = synthetic_xray(MB // 4)
+    assert data[:2] == b'\xff\xd8'
+    assert abs(len(data) - MB // 4) < MB // 4 * 0.15
+    cached = load_xray(0.1, str(tmp_path))
+    assert load_xray(0.1, str(tmp_path)) == cached
+    assert len(list(tmp_path.iterdir())) == 1
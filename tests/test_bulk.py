@@ -0,0 +1,68 @@
+import io
+import threading
+import zipfile
+import bulk
+from bulk import ingest_entries
+from database import Upload
+from jobs import inference_queue
+from tests.utils import xray_jpeg
+
+def entries(*files):
+    return [(name, len(data), io.BytesIO(data)) for name, data in files]
+
+def test_batch_upload_expands_zip_and_reports_each_file(client, db):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zipped:
+        zipped.writestr('a.jpg', xray_jpeg(1))
+        zipped.writestr('notes.txt', b'not an image')
+    archive.seek(0)
+    response = client.post('/upload_batch', headers={'Accept': 'application/json'},
+                           data={'files': [(archive, 'films.zip'), (io.BytesIO(xray_jpeg(2)), 'b.jpg'),
+                                           (io.BytesIO(b'garbage'), 'c.jpg')]},
+                           content_type='multipart/form-data')
+    result = response.get_json()
+    assert (result['total'], result['ok'], result['queued'], result['failed']) == (4, 2, 0, 2)
+    statuses = {item['file']: item['status'] for item in result['items']}
+    assert statuses == {'a.jpg': 'ok', 'notes.txt': 'failed', 'b.jpg': 'ok', 'c.jpg': 'failed'}
+    assert Upload.query.filter_by(status='done').count() == 2
+
+def test_duplicates_in_a_batch_share_one_detection(db, admin_id, monkeypatch):
+    calls = []
+    detect = bulk._detect
+    monkeypatch.setattr(bulk, '_detect', lambda app, data: calls.append(1) or detect(app, data))
+    data = xray_jpeg(3)
+    result = ingest_entries(entries(('a.jpg', data), ('copy.jpg', data)), admin_id)
+    assert result['ok'] == 2 and len(calls) == 1
+    first, second = (db.session.get(Upload, item['upload_id']) for item in result['items'])
+    assert first.file_path == second.file_path
+
+def test_external_inference_queues_the_batch(db, admin_id, monkeypatch):
+    monkeypatch.setattr(inference_queue, 'external', True)
+    result = ingest_entries(entries(('a.jpg', xray_jpeg(4)), ('b.jpg', xray_jpeg(5))), admin_id)
+    assert (result['ok'], result['queued'], result['failed']) == (0, 2, 0)
+    assert Upload.query.filter_by(status='pending').count() == 2
+
+def test_in_flight_detections_are_bounded(db, admin_id, monkeypatch):
+    gate = threading.Event()
+    finished = []
+    ahead = []
+
+    def blocked_detect(app, data):
+        gate.wait(5)
+        finished.append(1)
+        return {'detection_result': 'none', 'confidence_score': 0.0, 'processed_file_path': None,
+                'predictions': [], 'boxes': []}, None, 0.0
+
+    def slow_entries():
+        for index in range(6):
+            # Entries submitted but not finished when the next one is read
+            ahead.append(index - len(finished))
+            data = xray_jpeg(10 + index)
+            yield f"{index}.jpg", len(data), io.BytesIO(data)
+
+    monkeypatch.setattr(bulk, '_detect', blocked_detect)
+    threading.Timer(0.3, gate.set).start()
+    result = ingest_entries(slow_entries(), admin_id, workers=1)
+    assert result['ok'] == 6
+    # One worker: at most two images wait for or run detection
+    assert max(ahead) == 2
@@ -0,0 +1,75 @@
+import detection
+from cache import content_hash, content_path, get_cached_detection, store_detection, evict_detection_cache
+from database import Upload, Detection, DetectionCache
+from jobs import inference_queue
+from storage import storage
+from tests.utils import xray_jpeg, post_upload
+
+SUMMARY = {'detection_result': 'foreign_object', 'confidence_score': 0.9, 'processed_file_path': None,
+           'predictions': [{'class_id': 0, 'class': 'foreign_object', 'confidence': 0.9,
+                            'coordinates': [1.0, 2.0, 3.0, 4.0]}]}
+
+def count_predictions(monkeypatch):
+    calls = []
+    predict = detection.predict_image
+    monkeypatch.setattr(detection, 'predict_image', lambda image: calls.append(1) or predict(image))
+    return calls
+
+def test_storage_name_is_the_content_hash():
+    data = xray_jpeg(1)
+    digest = content_hash(data)
+    assert len(digest) == 64
+    assert content_hash(xray_jpeg(1)) == digest != content_hash(xray_jpeg(2))
+    assert content_path(digest, '.jpg').endswith(f"{digest}.jpg")
+
+def test_duplicate_upload_reuses_the_cached_result(client, db, monkeypatch):
+    calls = count_predictions(monkeypatch)
+    data = xray_jpeg(3)
+    first = post_upload(client, data, 'first.jpg')
+    inference_queue.drain()
+    second = post_upload(client, data, 'second.jpg')
+    inference_queue.drain()
+    assert len(calls) == 1
+
+    first, second = db.session.get(Upload, first), db.session.get(Upload, second)
+    assert second.status == 'done'
+    assert second.file_path == first.file_path
+    assert (second.detection_result, second.confidence_score) == (first.detection_result, first.confidence_score)
+    boxes = Detection.query.filter_by(upload_id=second.id).count()
+    assert boxes and boxes == Detection.query.filter_by(upload_id=first.id).count()
+
+def test_cache_is_keyed_on_model_threshold_and_settings(db):
+    store_detection('abc', 'v1', 0.25, 'settings', SUMMARY)
+    assert get_cached_detection('abc', 'v1', 0.25, 'settings').detection_result == 'foreign_object'
+    assert get_cached_detection('abc', 'v2', 0.25, 'settings') is None
+    assert get_cached_detection('abc', 'v1', 0.5, 'settings') is None
+    assert get_cached_detection('abc', 'v1', 0.25, 'other') is None
+
+def test_storing_the_same_key_twice_keeps_one_entry(db):
+    store_detection('abc', 'v1', 0.25, '', SUMMARY)
+    store_detection('abc', 'v1', 0.25, '', SUMMARY)
+    assert DetectionCache.query.count() == 1
+
+def test_changed_postprocess_settings_miss_the_cache(client, db, config, monkeypatch):
+    calls = count_predictions(monkeypatch)
+    data = xray_jpeg(4)
+    post_upload(client, data)
+    inference_queue.drain()
+    config['DETECTION_MAX_BOXES'] = 1
+    post_upload(client, data)
+    inference_queue.drain()
+    assert len(calls) == 2
+
+def test_entry_without_its_processed_image_is_dropped(db):
+    storage.save('processed/gone.jpg', b'jpeg')
+    store_detection('abc', 'v1', 0.25, '', dict(SUMMARY, processed_file_path='processed/gone.jpg'))
+    storage.delete('processed/gone.jpg')
+    assert get_cached_detection('abc', 'v1', 0.25, '') is None
+    assert DetectionCache.query.count() == 0
+
+def test_eviction_drops_the_least_recently_used(db):
+    for digest in ('a', 'b', 'c'):
+        store_detection(digest, 'v1', 0.25, '', SUMMARY)
+    get_cached_detection('a', 'v1', 0.25, '')
+    assert evict_detection_cache(2) == 1
+    assert {entry.content_hash for entry in DetectionCache.query} == {'a', 'c'}
@@ -0,0 +1,53 @@
+import sqlite3
+from flask import Flask
+from sqlalchemy import inspect, text
+from database import db as database, Upload, Detection, SchemaVersion, MIGRATIONS, database_uri, engine_options, init_db, upgrade_db
+
+# Schema of the first release, before any of the migrations
+LEGACY_SCHEMA = """
+CREATE TABLE admin (id INTEGER PRIMARY KEY, username VARCHAR(50) NOT NULL UNIQUE, password VARCHAR(255) NOT NULL,
+                    created_at DATETIME, last_login DATETIME);
+CREATE TABLE upload (id INTEGER PRIMARY KEY, file_name VARCHAR(255) NOT NULL, file_path VARCHAR(255) NOT NULL,
+                     detection_result VARCHAR(255), confidence_score FLOAT, remarks TEXT, upload_time DATETIME,
+                     processed_file_path VARCHAR(255));
+CREATE TABLE log (id INTEGER PRIMARY KEY, admin_id INTEGER NOT NULL, action VARCHAR(50) NOT NULL,
+                  timestamp DATETIME, details TEXT);
+INSERT INTO upload (file_name, file_path, detection_result, confidence_score, upload_time)
+VALUES ('old.jpg', 'old.jpg', 'foreign_object', 0.8, '2024-01-02 03:04:05');
+"""
+
+def test_every_migration_is_recorded(db):
+    assert {row.version for row in SchemaVersion.query} == {version for version, _, _ in MIGRATIONS}
+    upgrade_db()
+    assert SchemaVersion.query.count() == len(MIGRATIONS)
+
+def test_sqlite_runs_in_wal_mode(db):
+    with database.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == 'wal'
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() > 0
+
+def test_database_url(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgres://user@host/xray')
+    assert database_uri() == 'postgresql://user@host/xray'
+    assert engine_options(database_uri())['pool_pre_ping']
+    assert 'pool_size' not in engine_options('sqlite:///database.db')
+
+def test_legacy_database_is_upgraded_in_place(tmp_path):
+    path = tmp_path / 'legacy.db'
+    with sqlite3.connect(path) as conn:
+        conn.executescript(LEGACY_SCHEMA)
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    init_db(app)
+    with app.app_context():
+        columns = {column['name'] for column in inspect(database.engine).get_columns('upload')}
+        assert {'status', 'content_hash', 'model_version'} <= columns
+        indexes = {index['name'] for index in inspect(database.engine).get_indexes('upload')}
+        assert 'ix_upload_upload_time_id' in indexes
+        upload = Upload.query.one()
+        assert (upload.file_name, upload.status) == ('old.jpg', 'done')
+        assert Detection.query.count() == 0
+        assert SchemaVersion.query.count() == len(MIGRATIONS)
+        database.session.remove()
+        database.engine.dispose()
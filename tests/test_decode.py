@@ -0,0 +1,47 @@
+import io
+import cv2
+import numpy as np
+import detection
+from database import Upload
+from detection import validate_image, decode_image, load_image, process_upload
+from storage import storage
+from tests.utils import xray_jpeg, add_upload
+
+def png_bytes():
+    ok, encoded = cv2.imencode('.png', np.zeros((8, 8, 3), dtype=np.uint8))
+    return encoded.tobytes()
+
+def test_validate_image_sniffs_the_format_and_rewinds():
+    for data, extension in ((xray_jpeg(), '.jpg'), (png_bytes(), '.png'), (b'not an image at all', None)):
+        stream = io.BytesIO(data)
+        assert validate_image(stream) == extension
+        assert stream.tell() == 0
+
+def test_decode_image_matches_reading_the_file(tmp_path):
+    data = xray_jpeg(1)
+    path = tmp_path / 'scan.jpg'
+    path.write_bytes(data)
+    assert np.array_equal(decode_image(data), cv2.imread(str(path)))
+
+def test_load_image_passes_decoded_arrays_through():
+    image = decode_image(xray_jpeg(2))
+    assert load_image(image) is image
+    assert load_image(None) is None
+
+def test_handed_over_bytes_are_not_read_again(db, config, monkeypatch):
+    # Thumbnails made at ingest read the stored file on purpose
+    config['DERIVATIVES_AT_INGEST'] = False
+    data = xray_jpeg(3)
+    upload = add_upload(data, status='pending')
+
+    def no_disk_read(*args, **kwargs):
+        raise AssertionError("the original was read from storage")
+
+    monkeypatch.setattr(storage, 'local_path', no_disk_read)
+    monkeypatch.setattr(cv2, 'imread', no_disk_read)
+    decoded = []
+    monkeypatch.setattr(detection, 'decode_image', lambda data: decoded.append(1) or decode_image(data))
+    process_upload(upload.id, data)
+    upload = db.session.get(Upload, upload.id)
+    assert upload.status == 'done'
+    assert len(decoded) == 1
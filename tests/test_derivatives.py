@@ -0,0 +1,52 @@
+import os
+import time
+from PIL import Image
+from derivatives import get_derivative, remove_derivatives, DERIVATIVE_SIZES
+from storage import evict_lru, TEMP_FILE_GRACE
+from tests.utils import xray_jpeg, add_upload
+
+def write_file(path, size, age):
+    path.write_bytes(b'x' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+def test_thumbnail_is_made_once_within_its_bounds(db):
+    upload = add_upload(xray_jpeg(1, width=1600, height=1200))
+    path = get_derivative(upload.file_path, 'thumb')
+    with Image.open(path) as image:
+        assert max(image.size) <= max(DERIVATIVE_SIZES['thumb'])
+        assert image.size == (320, 240)
+    # A second request reuses the file instead of writing a new one
+    inode = os.stat(path).st_ino
+    assert get_derivative(upload.file_path, 'thumb') == path
+    assert os.stat(path).st_ino == inode
+
+    remove_derivatives(upload.file_path)
+    assert not os.path.exists(path)
+
+def test_missing_source_has_no_derivative(db):
+    assert get_derivative(None, 'thumb') is None
+    assert get_derivative('originals/no/ne/missing.jpg', 'thumb') is None
+
+def test_eviction_removes_the_least_recently_used_first(tmp_path):
+    oldest = write_file(tmp_path / 'a.jpg', 400, 300)
+    older = write_file(tmp_path / 'b.jpg', 400, 200)
+    recent = write_file(tmp_path / 'c.jpg', 400, 100)
+    # 1200 bytes against a 1000 byte limit: down to at most 900 bytes
+    assert evict_lru(str(tmp_path), 1000) == 1
+    assert not oldest.exists() and older.exists() and recent.exists()
+    assert evict_lru(str(tmp_path), 1000) == 0
+
+def test_eviction_keeps_recently_used_files(tmp_path):
+    write_file(tmp_path / 'a.jpg', 600, 30)
+    write_file(tmp_path / 'b.jpg', 600, 10)
+    assert evict_lru(str(tmp_path), 1000, min_age=60) == 0
+
+def test_eviction_leaves_writes_in_progress_alone(tmp_path):
+    in_progress = write_file(tmp_path / 'a.jpg.123.tmp', 600, 10)
+    abandoned = write_file(tmp_path / 'b.jpg.456.tmp', 600, TEMP_FILE_GRACE + 60)
+    cached = write_file(tmp_path / 'c.jpg', 600, 300)
+    assert evict_lru(str(tmp_path), 1000) == 2
+    assert in_progress.exists()
+    assert not abandoned.exists() and not cached.exists()
@@ -0,0 +1,50 @@
+import pytest
+from database import db as database, Upload, Detection
+from detection import save_detections, stored_boxes, process_upload
+from jobs import inference_queue
+from postprocess import Detections
+from tests.utils import xray_jpeg, add_upload, post_upload
+
+def test_every_box_above_the_store_threshold_is_kept(client, db):
+    upload_id = post_upload(client, xray_jpeg(1))
+    inference_queue.drain()
+    rows = Detection.query.filter_by(upload_id=upload_id).order_by(Detection.confidence.desc()).all()
+    assert [row.confidence for row in rows] == pytest.approx([0.87, 0.41, 0.12])
+    assert {(row.class_id, row.class_name) for row in rows} == {(0, 'foreign_object')}
+    assert all(row.x1 < row.x2 and row.y1 < row.y2 for row in rows)
+    # The summary only counts boxes above DETECTION_THRESHOLD
+    upload = database.session.get(Upload, upload_id)
+    assert upload.confidence_score == pytest.approx(0.87)
+
+def test_boxes_can_be_rethresholded_without_the_model(client, db):
+    upload_id = post_upload(client, xray_jpeg(2))
+    inference_queue.drain()
+
+    def confidences(query=''):
+        boxes = client.get(f'/upload/{upload_id}/boxes{query}').get_json()['boxes']
+        return [box['confidence'] for box in boxes]
+
+    assert confidences() == pytest.approx([0.87, 0.41])
+    assert confidences('?threshold=0.5') == pytest.approx([0.87])
+    assert confidences('?threshold=0.1') == pytest.approx([0.87, 0.41, 0.12])
+    assert client.get('/upload/999999/boxes').status_code == 404
+
+def test_class_thresholds_apply_to_stored_boxes(db, config):
+    upload = add_upload(xray_jpeg(3), status='pending')
+    process_upload(upload.id)
+    config['DETECTION_CLASS_THRESHOLDS'] = 'foreign_object=0.5'
+    assert stored_boxes(upload).conf.tolist() == pytest.approx([0.87])
+    # An explicit threshold overrides the per-class ones
+    assert len(stored_boxes(upload, threshold=0.3)) == 2
+
+def test_save_detections_accepts_prediction_dicts(db):
+    upload = add_upload(xray_jpeg(4))
+    save_detections(upload.id, [
+        {'class_id': None, 'class': 'legacy', 'confidence': 0.6, 'coordinates': [1, 2, 3, 4]},
+        {'class_id': 2, 'class': 'wire', 'confidence': 0.7, 'coordinates': [5, 6, 7, 8]},
+    ], 'v1')
+    save_detections(upload.id, Detections.empty(), 'v1')
+    database.session.commit()
+    rows = Detection.query.filter_by(upload_id=upload.id).order_by(Detection.confidence).all()
+    assert [(row.class_id, row.class_name, row.x1, row.model_version) for row in rows] == [
+        (None, 'legacy', 1, 'v1'), (2, 'wire', 5, 'v1')]
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+import pytest
+from werkzeug.datastructures import MultiDict
+from database import db as database, Upload
+from history import parse_history_filters, history_page, encode_cursor, decode_cursor
+
+START = datetime(2024, 5, 1, 12, 0, 0)
+
+@pytest.fixture
+def uploads(db, config):
+    """Twelve uploads, newest last; some share an upload time to exercise the id tiebreak"""
+    config['HISTORY_COUNT_TTL'] = 0
+    rows = []
+    for index in range(12):
+        rows.append(Upload(
+            file_name=f"scan_{index}.jpg", file_path=f"scan_{index}.jpg",
+            upload_time=START + timedelta(days=index // 2),
+            detection_result='foreign_object' if index % 3 else 'No foreign object detected',
+            confidence_score=index / 12, remarks='checked' if index == 5 else None))
+    database.session.add_all(rows)
+    database.session.commit()
+    return rows
+
+def ids(page):
+    return [upload.id for upload in page['items']]
+
+def test_pages_cover_every_upload_once_newest_first(uploads):
+    expected = [upload.id for upload in sorted(uploads, key=lambda u: (u.upload_time, u.id), reverse=True)]
+    seen, cursor = [], None
+    while True:
+        page = history_page({}, after=cursor, limit=5)
+        assert page['total'] == 12
+        seen += ids(page)
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == expected
+
+def test_before_goes_back_to_the_previous_page(uploads):
+    first = history_page({}, limit=5)
+    assert first['prev_cursor'] is None
+    second = history_page({}, after=first['next_cursor'], limit=5)
+    back = history_page({}, before=second['prev_cursor'], limit=5)
+    assert ids(back) == ids(first)
+
+def test_filters(uploads):
+    def filtered(**args):
+        return history_page(parse_history_filters(MultiDict(args)), limit=50)
+
+    assert filtered(result='negative')['total'] == 4
+    assert filtered(result='positive')['total'] == 8
+    assert filtered(start_date='2024-05-02', end_date='2024-05-03')['total'] == 4
+    assert filtered(min_confidence='0.5')['total'] == 6
+    assert ids(filtered(has_remarks='on')) == [uploads[5].id]
+    assert ids(filtered(q='scan_11')) == [uploads[11].id]
+
+def test_malformed_input_is_rejected():
+    with pytest.raises(ValueError):
+        parse_history_filters(MultiDict({'start_date': '05/01/2024'}))
+    with pytest.raises(ValueError):
+        decode_cursor('not-a-cursor')
+
+def test_cursor_round_trip(uploads):
+    assert decode_cursor(encode_cursor(uploads[3])) == (uploads[3].upload_time, uploads[3].id)
+
+def test_history_data_endpoint(client, uploads):
+    page = client.get('/history/data?limit=4&result=positive').get_json()
+    assert len(page['items']) == 4 and page['total'] == 8
+    assert page['items'][0]['file_name'] == 'scan_11.jpg'
+    rest = client.get(f"/history/data?limit=50&result=positive&after={page['next_cursor']}").get_json()
+    assert len(rest['items']) == 4
+    assert client.get('/history/data?after=bogus').status_code == 400
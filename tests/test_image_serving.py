@@ -0,0 +1,52 @@
+from detection import image_version, IMMUTABLE_MAX_AGE
+from tests.utils import xray_jpeg, add_upload
+
+def test_original_has_a_strong_etag_and_revalidates(client, db):
+    data = xray_jpeg(1)
+    upload = add_upload(data)
+    response = client.get(f'/view_image/{upload.id}/original')
+    assert response.status_code == 200 and response.data == data
+    assert response.headers['ETag'] == f'"{upload.content_hash}"'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'private' in response.headers['Cache-Control']
+
+    again = client.get(f'/view_image/{upload.id}/original', headers={'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304 and not again.data
+    since = client.get(f'/view_image/{upload.id}/original',
+                       headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert since.status_code == 304
+
+def test_range_requests(client, db):
+    data = xray_jpeg(2)
+    upload = add_upload(data)
+    response = client.get(f'/view_image/{upload.id}/original', headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206
+    assert response.data == data[:100]
+    assert response.headers['Content-Range'] == f'bytes 0-99/{len(data)}'
+
+def test_versioned_urls_are_immutable(client, db):
+    upload = add_upload(xray_jpeg(3))
+    versioned = client.get(f'/view_image/{upload.id}/original?v={image_version(upload)}')
+    assert versioned.cache_control.immutable and versioned.cache_control.max_age == IMMUTABLE_MAX_AGE
+    plain = client.get(f'/view_image/{upload.id}/original')
+    assert not plain.cache_control.immutable
+
+def test_x_accel_redirect_leaves_the_bytes_to_the_proxy(client, db, config):
+    upload = add_upload(xray_jpeg(4))
+    config.update(IMAGE_SENDFILE='x-accel', IMAGE_ACCEL_ROOT=config['UPLOAD_FOLDER'], IMAGE_ACCEL_PREFIX='/protected/')
+    response = client.get(f'/view_image/{upload.id}/original')
+    assert response.headers['X-Accel-Redirect'] == f'/protected/{upload.file_path}'
+    assert not response.data
+    assert response.headers['ETag'] == f'"{upload.content_hash}"'
+
+def test_thumbnails_are_served_with_their_own_etag(client, db):
+    upload = add_upload(xray_jpeg(5, width=1200, height=900))
+    response = client.get(f'/view_image/{upload.id}/original?size=thumb')
+    assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+    assert response.headers['ETag'].startswith('"thumb-')
+    assert len(response.data) < len(xray_jpeg(5, width=1200, height=900))
+
+def test_missing_images(client, db):
+    assert client.get('/view_image/999999/original').status_code == 404
+    upload = add_upload(xray_jpeg(6), status='pending')
+    assert client.get(f'/view_image/{upload.id}/processed').status_code == 404
@@ -0,0 +1,71 @@
+import threading
+from datetime import datetime, timedelta
+from database import Upload
+from detection import pending_upload_ids, reset_stale_uploads, process_upload
+from jobs import InferenceQueue, inference_queue
+from tests.utils import xray_jpeg, post_upload, add_upload
+
+def make_queue(app, handler, workers=2):
+    queue = InferenceQueue()
+    queue.init_app(app, handler)
+    queue.num_workers = workers
+    return queue
+
+def test_queue_runs_every_job_and_counts_failures(app):
+    seen = []
+    lock = threading.Lock()
+
+    def handler(upload_id):
+        if upload_id == 3:
+            raise RuntimeError("boom")
+        with lock:
+            seen.append(upload_id)
+
+    queue = make_queue(app, handler)
+    for upload_id in range(1, 6):
+        queue.submit(upload_id)
+    queue.drain()
+    assert sorted(seen) == [1, 2, 4, 5]
+    stats = queue.stats()
+    assert (stats['completed'], stats['failed'], stats['queue_depth']) == (4, 1, 0)
+
+def test_external_queue_runs_nothing(app):
+    queue = make_queue(app, lambda upload_id: None)
+    queue.external = True
+    queue.submit(1)
+    assert queue.stats()['queue_depth'] == 0
+    assert not queue._threads
+
+def test_upload_is_detected_in_the_background(client, db):
+    upload_id = post_upload(client, xray_jpeg(1))
+    inference_queue.drain()
+    upload = db.session.get(Upload, upload_id)
+    assert upload.status == 'done'
+    assert upload.detection_result == 'foreign_object'
+    assert upload.started_at <= upload.finished_at
+
+def test_claimed_upload_is_not_processed_twice(db):
+    upload = add_upload(xray_jpeg(2), status='running', started_at=datetime.now())
+    process_upload(upload.id)
+    db.session.refresh(upload)
+    assert upload.status == 'running'
+    assert upload.detection_result is None
+
+def test_stale_running_uploads_go_back_to_pending(db):
+    stale = add_upload(xray_jpeg(3), status='running', started_at=datetime.now() - timedelta(hours=1))
+    fresh = add_upload(xray_jpeg(4), status='running', started_at=datetime.now())
+    waiting = add_upload(xray_jpeg(5), status='pending')
+
+    assert reset_stale_uploads(600) == [stale.id]
+    db.session.expire_all()
+    assert stale.status == 'pending' and stale.started_at is None
+    assert fresh.status == 'running'
+    assert pending_upload_ids() == [stale.id, waiting.id]
+    assert pending_upload_ids(limit=1) == [stale.id]
+
+def test_requeued_upload_is_read_from_storage(db):
+    upload = add_upload(xray_jpeg(6), status='pending')
+    process_upload(upload.id)
+    db.session.refresh(upload)
+    assert upload.status == 'done'
+    assert upload.detection_result == 'foreign_object'
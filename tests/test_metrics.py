@@ -0,0 +1,62 @@
+from metrics import Counter, Histogram, StageTimer, COUNTERS, prometheus_text, histogram_family, request_metrics
+from tests.utils import xray_jpeg, post_upload
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5.0):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot['buckets'] == {'0.1': 2, '1.0': 3, '+Inf': 4}
+    assert (snapshot['count'], snapshot['sum'], snapshot['avg']) == (4, 5.65, 1.4125)
+    assert Histogram().snapshot()['avg'] == 0.0
+
+def test_counter_labels():
+    counter = Counter('test_total', 'Test counter', ('reason',))
+    COUNTERS.remove(counter)
+    counter.inc(reason='b')
+    counter.inc(2, reason='a')
+    counter.inc(reason='b')
+    assert counter.samples() == [({'reason': 'a'}, 2), ({'reason': 'b'}, 2)]
+
+def test_stage_timer_adds_up_repeated_stages():
+    timer = StageTimer()
+    for _ in range(2):
+        with timer.stage('decode'):
+            pass
+    assert list(timer.as_dict()) == ['decode']
+
+def test_prometheus_text_format():
+    histogram = Histogram((1.0,))
+    histogram.observe(0.5)
+    text = prometheus_text([
+        ('xray_things_total', 'counter', 'Things', [({'kind': 'a"b'}, 3)]),
+        histogram_family('xray_stage_seconds', 'Stages', {'decode': histogram}, ('stage',)),
+    ])
+    assert text.splitlines() == [
+        '# HELP xray_things_total Things',
+        '# TYPE xray_things_total counter',
+        'xray_things_total{kind="a\\"b"} 3',
+        '# HELP xray_stage_seconds Stages',
+        '# TYPE xray_stage_seconds histogram',
+        'xray_stage_seconds_bucket{stage="decode",le="1.0"} 1',
+        'xray_stage_seconds_bucket{stage="decode",le="+Inf"} 1',
+        'xray_stage_seconds_sum{stage="decode"} 0.5',
+        'xray_stage_seconds_count{stage="decode"} 1',
+    ]
+
+def test_metrics_endpoint(client, db, config):
+    post_upload(client, xray_jpeg(1))
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'xray_uploads_total{source="web"}' in text
+    assert 'xray_http_request_seconds_count{endpoint="detection.upload_file"}' in text
+    assert '# TYPE xray_model_ready gauge' in text
+
+    config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+def test_server_timing_header(client, db, monkeypatch):
+    monkeypatch.setattr(request_metrics, 'server_timing', True)
+    response = client.post('/upload', data={}, content_type='multipart/form-data')
+    timings = response.headers['Server-Timing']
+    assert 'parse;dur=' in timings and 'total;dur=' in timings
@@ -0,0 +1,28 @@
+import os
+import detection
+from cache import file_hash
+from detection import get_model, get_model_version, get_model_status, warm_up_model
+from jobs import inference_queue
+
+def test_ready_once_the_model_is_warm(app):
+    response = app.test_client().get('/ready')
+    assert response.status_code == 200
+    status = response.get_json()
+    assert status['ready'] and status['error'] is None
+    assert status['warm_up_seconds'] is not None
+
+def test_model_version_follows_the_weights_file(db):
+    version = get_model_version()
+    assert version == f"stub-{file_hash(os.environ['MODEL_PATH'])[:16]}"
+    assert get_model() is get_model()
+
+def test_external_inference_is_always_ready(monkeypatch):
+    monkeypatch.setattr(inference_queue, 'external', True)
+    assert get_model_status()['inference'] == 'external'
+    assert get_model_status()['ready']
+
+def test_warm_up_reports_a_missing_model(db, monkeypatch):
+    monkeypatch.setitem(detection._model_state, 'error', None)
+    monkeypatch.setattr(detection, 'get_model', lambda: None)
+    assert not warm_up_model()
+    assert get_model_status()['error'] == "Model not available"
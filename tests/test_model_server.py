@@ -0,0 +1,149 @@
+import os
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+from benchmarks.stub import StubBackend, render_xray
+from model_server import (ModelServer, ModelServerClient, ModelServerError, send_message, recv_message,
+                          server_settings)
+
+class SlowBackend(StubBackend):
+    """The stub, failing on request or taking longer than the client waits"""
+    delay = 0.0
+    fail = False
+
+    def predict(self, source, conf=0.25, **kwargs):
+        if self.fail:
+            raise ValueError("broken weights")
+        time.sleep(self.delay)
+        return super().predict(source, conf=conf)
+
+class DroppingServer(ModelServer):
+    """Remembers its connections so stopping it drops them, as a crashed process would"""
+
+    def get_request(self):
+        request, address = super().get_request()
+        self.connections.append(request)
+        return request, address
+
+def start_server(socket_path, backend=None, **config):
+    server = DroppingServer(socket_path, backend or SlowBackend({'MODEL_PATH': 'stub.pt'}), config)
+    server.connections = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+    for connection in server.connections:
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Already closed by its handler
+            pass
+
+def make_client(socket_path, **config):
+    return ModelServerClient(dict({'MODEL_SERVER_SOCKET': socket_path, 'MODEL_SERVER_AUTOSTART': False,
+                                   'INFERENCE_BACKEND': 'stub', 'MODEL_PATH': 'stub.pt'}, **config))
+
+def test_messages_are_length_prefixed_json():
+    left, right = socket.socketpair()
+    with left, right:
+        send_message(left, {'op': 'info'})
+        send_message(left, {'images': [[0, [2, 2, 3]]]})
+        assert recv_message(right) == {'op': 'info'}
+        assert recv_message(right) == {'images': [[0, [2, 2, 3]]]}
+        left.close()
+        assert recv_message(right) is None
+
+def test_server_settings_pass_only_inference_keys():
+    settings = server_settings({'MODEL_PATH': 'best.pt', 'MODEL_SERVER_THREADS': 3, 'INFERENCE_BATCHING': True,
+                                'SECRET_KEY': 'secret', 'DATABASE_URL': 'postgresql://user:password@db/xray',
+                                'STORAGE_S3_BUCKET': 'scans'})
+    assert settings == {'MODEL_PATH': 'best.pt', 'INFERENCE_BATCHING': True, 'TORCH_THREADS': 3}
+    assert server_settings({})['TORCH_THREADS'] == (os.cpu_count() or 1)
+
+def test_client_matches_the_backend(socket_path):
+    server = start_server(socket_path)
+    client = make_client(socket_path)
+    images = [render_xray(200, 160, seed=1), render_xray(97, 61, seed=2)]
+    try:
+        results = client.predict(images, conf=0.25)
+        expected = server.backend.predict(images, conf=0.25)
+        assert client.names == {0: 'foreign_object'}
+        for result, reference in zip(results, expected):
+            assert result.orig_shape == reference.orig_shape
+            assert np.allclose(result.boxes.xyxy, reference.boxes.xyxy)
+            assert result.boxes.conf.tolist() == pytest.approx(reference.boxes.conf.tolist())
+        # The same segment is reused while the images fit
+        segment = client._state().segment
+        client.predict(images[1], conf=0.1)
+        assert client._state().segment is segment
+        assert server.info()['served'] == 2
+    finally:
+        stop_server(server)
+
+def test_requests_from_several_threads_share_a_forward_pass(socket_path):
+    server = start_server(socket_path, INFERENCE_BATCHING=True, INFERENCE_MAX_BATCH_SIZE=8, INFERENCE_MAX_WAIT_MS=200)
+    calls = []
+    predict = server.backend.predict
+    server.backend.predict = lambda source, **kwargs: calls.append(len(source)) or predict(source, **kwargs)
+    client = make_client(socket_path)
+    threads = [threading.Thread(target=client.predict, args=(render_xray(64, 64, seed),)) for seed in range(3)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sum(calls) == 3 and len(calls) < 3
+    finally:
+        stop_server(server)
+
+def test_backend_errors_reach_the_worker(socket_path):
+    server = start_server(socket_path)
+    server.backend.fail = True
+    try:
+        with pytest.raises(ModelServerError, match="ValueError: broken weights"):
+            make_client(socket_path).predict(render_xray(64, 64))
+    finally:
+        stop_server(server)
+
+def test_slow_requests_time_out(socket_path):
+    server = start_server(socket_path)
+    server.backend.delay = 0.5
+    client = make_client(socket_path, MODEL_SERVER_TIMEOUT=0.1)
+    try:
+        with pytest.raises(ModelServerError, match="did not answer"):
+            client.predict(render_xray(64, 64))
+        # The segment the server may still read is never written again
+        assert client._state().segment is None
+    finally:
+        stop_server(server)
+
+def test_missing_server_without_autostart(socket_path):
+    with pytest.raises(ModelServerError, match="unavailable"):
+        make_client(socket_path).predict(render_xray(64, 64))
+
+def test_client_restarts_a_crashed_server(socket_path, monkeypatch):
+    servers = [start_server(socket_path)]
+    client = make_client(socket_path, MODEL_SERVER_AUTOSTART=True)
+    client.predict(render_xray(64, 64))
+    stop_server(servers[0])
+    # Stands in for spawning python -m model_server
+    monkeypatch.setattr(client, 'ensure_server', lambda: servers.append(start_server(socket_path)))
+    try:
+        [result] = client.predict(render_xray(64, 64))
+        assert len(servers) == 2 and len(result.boxes) == 2
+    finally:
+        stop_server(servers[-1])
+
+def test_predict_image_through_the_model_server(socket_path, db, monkeypatch):
+    import detection
+    server = start_server(socket_path)
+    monkeypatch.setattr(detection, 'get_model', lambda: make_client(socket_path))
+    try:
+        results, error = detection.predict_image(render_xray(120, 100))
+        assert error is None and len(results[0].boxes) == 3
+    finally:
+        stop_server(server)
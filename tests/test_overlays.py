@@ -0,0 +1,73 @@
+import os
+import cv2
+import numpy as np
+from cache import content_hash
+from database import db as database, Upload
+from detection import overlay_key
+from jobs import inference_queue
+from storage import storage, original_key
+from tests.utils import xray_jpeg, post_upload
+
+def decode(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def detected_upload(client, config, seed):
+    config['STORE_PROCESSED_IMAGES'] = False
+    upload_id = post_upload(client, xray_jpeg(seed))
+    inference_queue.drain()
+    return database.session.get(Upload, upload_id)
+
+def test_processed_image_is_drawn_on_demand(client, db, config):
+    upload = detected_upload(client, config, 1)
+    assert upload.processed_file_path is None
+
+    response = client.get(f'/view_image/{upload.id}/processed')
+    assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+    original = decode(client.get(f'/view_image/{upload.id}/original').data)
+    overlay = decode(response.data)
+    assert overlay.shape == original.shape
+    assert np.abs(overlay.astype(int) - original.astype(int)).max() > 100
+
+    # Revalidation is answered from the overlay key alone
+    again = client.get(f'/view_image/{upload.id}/processed', headers={'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304
+
+def test_threshold_changes_the_overlay(client, db, config):
+    upload = detected_upload(client, config, 2)
+    assert overlay_key(upload) != overlay_key(upload, 0.5)
+    default = client.get(f'/view_image/{upload.id}/processed').data
+    strict = client.get(f'/view_image/{upload.id}/processed?threshold=0.5').data
+    assert default != strict
+    thumb = client.get(f'/view_image/{upload.id}/processed?size=thumb&threshold=0.5')
+    assert thumb.status_code == 200 and max(decode(thumb.data).shape[:2]) <= 320
+
+def test_purge_processed_keeps_what_cannot_be_redrawn(app, client, db, config):
+    config['STORE_PROCESSED_IMAGES'] = True
+    upload_id = post_upload(client, xray_jpeg(3))
+    inference_queue.drain()
+    upload = database.session.get(Upload, upload_id)
+    processed = upload.processed_file_path
+    assert storage.exists(processed)
+
+    result = app.test_cli_runner().invoke(args=['purge-processed'])
+    assert result.output.startswith("1 processed images")
+    database.session.refresh(upload)
+    assert upload.processed_file_path is None and not storage.exists(processed)
+    assert client.get(f'/view_image/{upload.id}/processed').status_code == 200
+
+def test_dedupe_uploads_moves_legacy_files_into_storage(app, db, config):
+    folder = config['UPLOAD_FOLDER']
+    data = xray_jpeg(4)
+    legacy = [os.path.join(folder, name) for name in ('first.jpg', 'copy.jpg')]
+    for path in legacy:
+        with open(path, 'wb') as f:
+            f.write(data)
+    database.session.add_all([Upload(file_name=os.path.basename(path), file_path=path) for path in legacy])
+    database.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['dedupe-uploads'])
+    assert result.output.strip() == "1 distinct files, 1 stored under their content hash, 2 legacy files removed, 2 rows updated"
+    key = original_key(content_hash(data), '.jpg')
+    assert storage.exists(key)
+    assert not any(os.path.exists(path) for path in legacy)
+    assert {(upload.file_path, upload.content_hash) for upload in Upload.query} == {(key, content_hash(data))}
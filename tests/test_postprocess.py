@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from backends import Boxes, Result
+from postprocess import (NO_DETECTION, Detections, parse_class_thresholds, postprocess_settings, postprocess,
+                         class_thresholds, nms, select, summarize, lowest_threshold, thresholds_fingerprint,
+                         settings_fingerprint)
+
+NAMES = {0: 'foreign_object', 1: 'pacemaker'}
+
+def settings(**overrides):
+    return dict(postprocess_settings({}), **overrides)
+
+def result(xyxy, conf, cls):
+    return Result(Boxes(xyxy, conf, cls), NAMES, (100, 100))
+
+def test_parse_class_thresholds():
+    assert parse_class_thresholds('') == {}
+    assert parse_class_thresholds('foreign_object=0.4, 3=0.5,') == {'foreign_object': 0.4, '3': 0.5}
+    for value in ('foreign_object', '=0.4', 'foreign_object=high'):
+        with pytest.raises(ValueError):
+            parse_class_thresholds(value)
+
+def test_postprocess_settings_from_config():
+    assert postprocess_settings({}) == {'threshold': 0.25, 'class_thresholds': {}, 'nms_iou': 0.0, 'max_boxes': 300}
+    config = {'DETECTION_THRESHOLD': 0.3, 'DETECTION_CLASS_THRESHOLDS': 'pacemaker=0.1', 'DETECTION_MAX_BOXES': 5}
+    assert postprocess_settings(config) == {'threshold': 0.3, 'class_thresholds': {'pacemaker': 0.1},
+                                            'nms_iou': 0.0, 'max_boxes': 5}
+    assert lowest_threshold(postprocess_settings(config)) == 0.1
+
+def test_detections_from_results_are_sorted_best_first():
+    detections = postprocess([result([[0, 0, 10, 10], [20, 20, 30, 30]], [0.3, 0.9], [0, 1]),
+                              result(np.zeros((0, 4)), [], []),
+                              result([[50, 50, 60, 60]], [0.6], [7])], NAMES, settings())
+    assert detections.conf.tolist() == pytest.approx([0.9, 0.6, 0.3])
+    assert detections.labels.tolist() == ['pacemaker', 'Unknown', 'foreign_object']
+    assert detections.xyxy[0].tolist() == [20, 20, 30, 30]
+    assert len(postprocess([], NAMES, settings())) == 0
+
+def test_class_thresholds_by_name_and_id():
+    detections = Detections([[0, 0, 1, 1]] * 3, [0.3, 0.3, 0.3], [0, 1, 2], ['foreign_object', 'pacemaker', 'clip'])
+    thresholds = class_thresholds(detections, settings(class_thresholds={'pacemaker': 0.5, '2': 0.1}))
+    assert thresholds.tolist() == [0.25, 0.5, 0.1]
+    assert select(detections, settings(class_thresholds={'pacemaker': 0.5})).labels.tolist() == \
+        ['foreign_object', 'clip']
+
+def test_nms_is_class_aware():
+    detections = Detections([[0, 0, 10, 10], [1, 1, 10, 10], [0, 0, 10, 10], [50, 50, 60, 60]],
+                            [0.9, 0.8, 0.7, 0.6], [0, 0, 1, 0], ['a', 'a', 'b', 'a'])
+    # The second box overlaps the first of the same class; the third is another class
+    assert nms(detections, 0.5).tolist() == [0, 2, 3]
+    kept = postprocess([result(detections.xyxy, detections.conf, detections.cls)], NAMES, settings(nms_iou=0.5))
+    assert kept.conf.tolist() == pytest.approx([0.9, 0.7, 0.6])
+    assert len(postprocess([result(detections.xyxy, detections.conf, detections.cls)], NAMES, settings())) == 4
+
+def test_max_boxes_keeps_the_most_confident():
+    boxes = result([[i, i, i + 5, i + 5] for i in range(5)], [0.1, 0.5, 0.3, 0.9, 0.2], [0] * 5)
+    assert postprocess([boxes], NAMES, settings(max_boxes=2)).conf.tolist() == pytest.approx([0.9, 0.5])
+
+def test_summarize():
+    detections = Detections([[0, 0, 1, 1], [0, 0, 2, 2]], [0.8, 0.2], [1, 0], ['pacemaker', 'foreign_object'])
+    label, confidence, predictions = summarize(detections, settings())
+    assert (label, confidence, len(predictions)) == ('pacemaker', pytest.approx(0.8), 1)
+    assert summarize(detections, settings(threshold=0.9))[:2] == (NO_DETECTION, 0.0)
+    assert summarize(Detections.empty(), settings())[0] == NO_DETECTION
+
+def test_fingerprints_change_with_what_changes_a_result():
+    base = settings()
+    assert thresholds_fingerprint(base) == ''
+    assert len(thresholds_fingerprint(settings(class_thresholds={'pacemaker': 0.5}))) == 8
+    fingerprint = settings_fingerprint(base)
+    assert settings_fingerprint(settings(threshold=0.9)) == fingerprint
+    assert len({fingerprint,
+                settings_fingerprint(settings(class_thresholds={'pacemaker': 0.5})),
+                settings_fingerprint(settings(nms_iou=0.5)),
+                settings_fingerprint(settings(max_boxes=10)),
+                settings_fingerprint(base, 'tiles')}) == 5
+
+def test_dicts_and_rows_round_trip():
+    detections = Detections([[1, 2, 3, 4], [5, 6, 7, 8]], [0.75, 0.5], [1, -1], ['pacemaker', 'legacy'])
+    dicts = detections.as_dicts()
+    assert dicts[0] == {'class_id': 1, 'class': 'pacemaker', 'confidence': 0.75, 'coordinates': [1, 2, 3, 4]}
+    assert dicts[1]['class_id'] is None
+    again = Detections.from_dicts(dicts)
+    assert again.as_dicts() == dicts
+    rows = Detections.from_rows([(1, 'pacemaker', 0.75, 1, 2, 3, 4), (None, 'legacy', 0.5, 5, 6, 7, 8)])
+    assert rows.as_dicts() == dicts
+    assert len(Detections.from_dicts([])) == len(Detections.from_rows([])) == 0
+    assert detections.scaled(0.5).xyxy[0].tolist() == [0.5, 1, 1.5, 2]
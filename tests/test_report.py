@@ -0,0 +1,52 @@
+import json
+from datetime import datetime, timedelta
+from database import db as database, ReportJob
+from report import report_executor, run_report_job, fail_stale_report_jobs, requeue_report_jobs
+from tests.utils import xray_jpeg, add_upload
+
+def wait_for_reports():
+    # One report thread: a no-op queued behind the jobs finishes after them
+    report_executor.submit(lambda: None).result(timeout=30)
+
+def add_job(admin_id, status='pending', filters=None, **columns):
+    job = ReportJob(admin_id=admin_id, status=status, filters=json.dumps(filters or {}), **columns)
+    database.session.add(job)
+    database.session.commit()
+    return job
+
+def test_report_is_built_in_the_background(client, db):
+    add_upload(xray_jpeg(1), detection_result='foreign_object', confidence_score=0.9)
+    add_upload(xray_jpeg(2), detection_result='No foreign object detected', confidence_score=0.0)
+    response = client.get('/generate_report?result=positive')
+    assert response.status_code == 302
+    job_id = int(response.headers['Location'].rsplit('/', 1)[1])
+    wait_for_reports()
+
+    status = client.get(f'/report_jobs/{job_id}', headers={'Accept': 'application/json'}).get_json()
+    assert (status['status'], status['total']) == ('done', 1)
+    download = client.get(f'/report_jobs/{job_id}/download')
+    assert download.status_code == 200
+    assert download.data.startswith(b'%PDF')
+
+def test_a_claimed_job_is_not_built_twice(app, db, admin_id):
+    job = add_job(admin_id, status='running', started_at=datetime.now())
+    run_report_job(app, job.id)
+    database.session.refresh(job)
+    assert job.status == 'running' and job.file_path is None
+
+def test_stale_running_jobs_fail(db, admin_id):
+    stale = add_job(admin_id, status='running', started_at=datetime.now() - timedelta(hours=2))
+    unknown = add_job(admin_id, status='running')
+    fresh = add_job(admin_id, status='running', started_at=datetime.now())
+    assert fail_stale_report_jobs() == 2
+    database.session.expire_all()
+    assert (stale.status, unknown.status, fresh.status) == ('failed', 'failed', 'running')
+    assert stale.error_message
+
+def test_pending_jobs_are_requeued_after_a_restart(app, db, admin_id):
+    add_upload(xray_jpeg(3), detection_result='foreign_object', confidence_score=0.9)
+    job = add_job(admin_id)
+    requeue_report_jobs(app)
+    wait_for_reports()
+    database.session.refresh(job)
+    assert (job.status, job.total) == ('done', 1)
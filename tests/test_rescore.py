@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from database import db as database, Detection, RescoreJob
+import detection
+from detection import get_model, get_model_version
+import rescore
+from rescore import run_rescore, run_rescore_job, claim_job, bounded_map, _init_worker, _worker_state
+from worker import pending_rescore_job
+from tests.test_model_server import SlowBackend, start_server, stop_server
+from tests.utils import xray_jpeg, add_upload
+
+@pytest.fixture
+def rescore_config(config):
+    config.update(RESCORE_CHUNK_SIZE=2, RESCORE_YIELD_TO_LIVE=False, RESCORE_NICE=0)
+    return config
+
+def old_uploads(count, seed=0):
+    return [add_upload(xray_jpeg(seed + index), detection_result='old', confidence_score=0.1,
+                       model_version='old-model') for index in range(count)]
+
+def new_job(**columns):
+    columns.setdefault('status', 'pending')
+    job = RescoreJob(model_version=get_model_version(), **columns)
+    database.session.add(job)
+    database.session.commit()
+    return job
+
+def quiet(message):
+    pass
+
+def test_uploads_of_other_models_are_rescored(db, rescore_config):
+    uploads = old_uploads(3)
+    current = add_upload(xray_jpeg(10), detection_result='kept', model_version=get_model_version())
+    job = run_rescore(new_job().id, progress=quiet)
+    assert (job.status, job.total, job.processed, job.failed) == ('done', 3, 3, 0)
+    assert job.last_upload_id == uploads[-1].id
+
+    database.session.expire_all()
+    for upload in uploads:
+        assert (upload.detection_result, upload.model_version) == ('foreign_object', get_model_version())
+        assert Detection.query.filter_by(upload_id=upload.id, model_version=get_model_version()).count() == 3
+    assert current.detection_result == 'kept'
+
+def test_unreadable_uploads_are_counted_as_failed(db, rescore_config):
+    uploads = old_uploads(2)
+    uploads[0].file_path = 'originals/no/ne/missing.jpg'
+    database.session.commit()
+    job = run_rescore(new_job().id, progress=quiet)
+    assert (job.status, job.processed, job.failed) == ('done', 1, 1)
+
+def test_resumed_job_starts_after_its_checkpoint(db, rescore_config):
+    uploads = old_uploads(3)
+    job = run_rescore(new_job(last_upload_id=uploads[0].id, processed=1).id, progress=quiet)
+    assert (job.processed, job.last_upload_id) == (3, uploads[-1].id)
+    database.session.expire_all()
+    assert uploads[0].detection_result == 'old'
+
+def test_rate_cap_slows_the_job(db, rescore_config):
+    old_uploads(3)
+    started = time.monotonic()
+    run_rescore(new_job().id, max_rate=20, progress=quiet)
+    assert time.monotonic() - started >= 0.15
+
+def test_rate_cap_only_counts_the_current_run(db, rescore_config):
+    old_uploads(2)
+    # Had the 1000 uploads of earlier runs counted, this would sleep for 20 seconds
+    started = time.monotonic()
+    job = run_rescore(new_job(processed=1000).id, max_rate=50, progress=quiet)
+    assert job.processed == 1002
+    assert time.monotonic() - started < 5
+
+def test_inline_rescore_bypasses_the_batcher(db, rescore_config, monkeypatch):
+    def busy(image):
+        raise AssertionError("rescore went through the live uploads' batcher")
+    monkeypatch.setattr(detection.inference_batcher, 'enabled', True)
+    monkeypatch.setattr(detection.inference_batcher, 'predict', busy)
+    old_uploads(2)
+    job = run_rescore(new_job().id, progress=quiet)
+    assert (job.status, job.processed, job.failed) == ('done', 2, 0)
+
+def test_worker_threads_without_torch(app, monkeypatch):
+    monkeypatch.delenv('OMP_NUM_THREADS', raising=False)
+    # import torch fails from here on
+    monkeypatch.setitem(sys.modules, 'torch', None)
+    config = {'INFERENCE_BACKEND': 'stub', 'MODEL_PATH': app.config['MODEL_PATH'], 'RESCORE_THREADS': 2,
+              'RESCORE_NICE': 0}
+    _init_worker(config)
+    assert _worker_state['backend'].name == 'stub'
+    assert (config['ONNX_INTRA_OP_THREADS'], os.environ['OMP_NUM_THREADS']) == (2, '2')
+
+class OldModel(SlowBackend):
+    """What the running model server still has loaded: a model that finds nothing"""
+    def predict(self, source, conf=0.25, **kwargs):
+        return super().predict(source, conf=1.0)
+
+def test_cli_rescore_does_not_use_the_model_server(app, db, config, rescore_config, socket_path, tmp_path):
+    uploads = old_uploads(2)
+    served_version = get_model_version()
+    weights = tmp_path / 'new.pt'
+    weights.write_bytes(b'new stub weights')
+    server = start_server(socket_path, OldModel({'MODEL_PATH': config['MODEL_PATH']}))
+    config.update(MODEL_SERVER=True, MODEL_SERVER_SOCKET=socket_path, MODEL_SERVER_AUTOSTART=False)
+    get_model.cache_clear()
+    try:
+        result = app.test_cli_runner().invoke(args=['rescore', '--model', str(weights)])
+        assert result.exit_code == 0, result.output
+        new_version = get_model_version()
+    finally:
+        stop_server(server)
+        get_model.cache_clear()
+        get_model_version.cache_clear()
+    assert new_version != served_version
+    database.session.expire_all()
+    for upload in uploads:
+        assert (upload.detection_result, upload.model_version) == ('foreign_object', new_version)
+    assert server.info()['served'] == 0
+
+def test_only_one_process_claims_a_job(app, db, rescore_config):
+    job = new_job()
+    assert claim_job(job.id) and not claim_job(job.id)
+    # A job another process is running is left alone
+    uploads = old_uploads(1)
+    run_rescore_job(app, job.id)
+    database.session.expire_all()
+    assert uploads[0].detection_result == 'old'
+
+def test_cli_jobs_are_hidden_from_inference_workers(app, db, rescore_config, monkeypatch):
+    seen = []
+
+    def fake_run(job_id, **kwargs):
+        seen.append((database.session.get(RescoreJob, job_id).status, pending_rescore_job()))
+        return database.session.get(RescoreJob, job_id)
+    monkeypatch.setattr(rescore, 'run_rescore', fake_run)
+    runner = app.test_cli_runner()
+    runner.invoke(args=['rescore'])
+    assert seen == [('running', None)]
+
+    # Resuming claims the job from the state it was left in
+    job = new_job(status='failed')
+    runner.invoke(args=['rescore', '--resume', str(job.id)])
+    assert len(seen) == 2 and seen[-1] == ('running', None)
+
+def test_cancel(client, db):
+    job = new_job(status='running')
+    assert client.post(f'/rescore_jobs/{job.id}/cancel').get_json()['status'] == 'cancelled'
+    assert client.get('/rescore_jobs/999999').status_code == 404
+
+def test_bounded_map_keeps_a_window_in_flight():
+    in_flight = []
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        def submit(function, item):
+            in_flight.append(item)
+            return pool.submit(function, item)
+
+        for result in bounded_map(submit, lambda item: item * 2, range(10), window=3):
+            # Never more than the window ahead of what has been consumed
+            assert len(in_flight) - result // 2 <= 3
+    assert len(in_flight) == 10
@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+from benchmarks.run import REPO_DIR
+from benchmarks.startup import HEAVY_MODULES
+
+# Runs in a fresh interpreter as a web worker of a split deployment: serves a
+# login page, takes one upload and reports the heavy modules loaded after each
+WEB_WORKER = r"""
+import io, json, os, sys
+from benchmarks.stub import install_stub_backend
+os.environ['MODEL_PATH'] = install_stub_backend()
+from app import app
+from database import Upload
+heavy = lambda: sorted(name for name in sys.argv[2:] if name in sys.modules)
+client = app.test_client()
+login = client.get('/login').status_code
+after_login = heavy()
+with client.session_transaction() as session:
+    session['admin_logged_in'] = True
+    session['admin_id'] = 1
+with open(sys.argv[1], 'rb') as f:
+    image = f.read()
+upload = client.post('/upload', data={'file': (io.BytesIO(image), 'scan.jpg')},
+                     content_type='multipart/form-data').status_code
+with app.app_context():
+    pending = Upload.query.filter_by(status='pending').count()
+print(json.dumps({'login': login, 'upload': upload, 'pending': pending,
+                  'after_login': after_login, 'after_upload': heavy()}))
+"""
+
+def run_web_worker(tmp_path, image):
+    path = tmp_path / 'scan.jpg'
+    path.write_bytes(image)
+    env = dict(os.environ,
+               PYTHONPATH=REPO_DIR,
+               INFERENCE_PROCESS='external',
+               INFERENCE_BACKEND='stub',
+               DATABASE_URL=f"sqlite:///{tmp_path / 'web.db'}",
+               REPORT_FOLDER=str(tmp_path / 'reports'),
+               DERIVATIVE_FOLDER=str(tmp_path / 'derivatives'),
+               UPLOAD_FOLDER=str(tmp_path / 'uploads'),
+               SECRET_KEY='test')
+    output = subprocess.run([sys.executable, '-c', WEB_WORKER, str(path), *HEAVY_MODULES], cwd=str(tmp_path),
+                            env=env, capture_output=True, text=True, timeout=120)
+    assert output.returncode == 0, output.stderr
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def test_external_web_tier_stays_light(tmp_path):
+    from tests.utils import xray_jpeg
+    result = run_web_worker(tmp_path, xray_jpeg(1))
+    assert result['login'] == 200
+    assert result['after_login'] == []
+    # The upload is stored and queued for the inference process, which also
+    # makes the thumbnails
+    assert (result['upload'], result['pending']) == (302, 1)
+    assert result['after_upload'] == []
@@ -0,0 +1,84 @@
+import io
+import os
+import pytest
+from cache import content_hash
+from database import db as database, Upload
+from storage import LocalStorage, Storage, shard, original_key, processed_key, migrated_key, storage
+from tests.utils import xray_jpeg
+
+DIGEST = 'abcdef' + '0' * 58
+
+def test_keys_are_sharded_by_the_first_hex_characters():
+    assert shard(DIGEST) == 'ab/cd'
+    assert original_key(DIGEST, '.jpg') == f"originals/ab/cd/{DIGEST}.jpg"
+    assert processed_key('processed_1234abcd.jpg') == 'processed/12/34/processed_1234abcd.jpg'
+    assert processed_key().startswith('processed/') and processed_key() != processed_key()
+
+def test_migrated_key():
+    assert migrated_key('/srv/uploads/scan.jpg', 'original', DIGEST) == original_key(DIGEST, '.jpg')
+    assert migrated_key('/srv/uploads/f00d.JPG', 'original') == 'originals/f0/0d/f00d.JPG'
+    assert migrated_key('/srv/uploads/processed_beef.jpg', 'processed') == 'processed/be/ef/processed_beef.jpg'
+    assert migrated_key(original_key(DIGEST, '.jpg'), 'original', DIGEST) is None
+
+def test_local_storage_round_trip(tmp_path):
+    local = LocalStorage(str(tmp_path))
+    key = original_key(DIGEST, '.jpg')
+    local.save(key, b'bytes')
+    local.save('processed/aa/bb/processed_aabb.jpg', io.BytesIO(b'stream'))
+    assert local.exists(key) and local.size(key) == 5
+    assert local.local_path(key) == os.path.join(str(tmp_path), 'originals', 'ab', 'cd', f"{DIGEST}.jpg")
+    with local.open(key) as f:
+        assert f.read() == b'bytes'
+    assert sorted(local.iter_keys('originals/')) == [key]
+    local.delete(key)
+    local.delete(key)
+    assert not local.exists(key) and local.local_path(key) is None and local.size(key) is None
+
+def test_legacy_absolute_paths_are_read_from_disk(tmp_path):
+    legacy = tmp_path / 'old.jpg'
+    legacy.write_bytes(b'old')
+    local = LocalStorage(str(tmp_path / 'uploads'))
+    assert local.exists(str(legacy)) and local.local_path(str(legacy)) == str(legacy)
+
+def test_unknown_backend_is_rejected(app, config):
+    config['STORAGE_BACKEND'] = 'ftp'
+    with pytest.raises(ValueError):
+        Storage().init_app(app)
+
+def add_legacy_upload(folder, name, data, processed=None):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    upload = Upload(file_name=name, file_path=path, content_hash=content_hash(data), processed_file_path=processed)
+    database.session.add(upload)
+    database.session.commit()
+    return upload
+
+def test_migrate_storage_moves_flat_files_into_shards(app, db, config):
+    folder = config['UPLOAD_FOLDER']
+    data = xray_jpeg(1)
+    processed = os.path.join(folder, 'processed_c0ffee.jpg')
+    with open(processed, 'wb') as f:
+        f.write(b'processed')
+    upload = add_legacy_upload(folder, 'scan.jpg', data, processed)
+    add_legacy_upload(folder, 'gone.jpg', b'x')
+    os.remove(os.path.join(folder, 'gone.jpg'))
+    runner = app.test_cli_runner()
+
+    dry = runner.invoke(args=['migrate-storage', '--dry-run'])
+    assert dry.output.strip().endswith("(dry run)")
+    assert os.path.exists(os.path.join(folder, 'scan.jpg'))
+
+    result = runner.invoke(args=['migrate-storage'])
+    assert result.output.strip().splitlines()[-1] == \
+        "3 stored files, 2 stored in local storage, 2 paths rewritten, 1 missing"
+    database.session.refresh(upload)
+    assert upload.file_path == original_key(content_hash(data), '.jpg')
+    assert upload.processed_file_path == 'processed/c0/ff/processed_c0ffee.jpg'
+    with storage.open(upload.file_path) as f:
+        assert f.read() == data
+    assert not os.path.exists(os.path.join(folder, 'scan.jpg')) and not os.path.exists(processed)
+
+    # A second run finds everything in place
+    again = runner.invoke(args=['migrate-storage'])
+    assert ", 0 stored in local storage, 0 paths rewritten" in again.output
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from backends import Boxes, Result
+from detection import get_settings_key
+from tiling import tile_starts, tile_windows, box_ios, merge_boxes, predict_tiled, tiling_settings, tiling_fingerprint
+
+class RecordingBackend:
+    """Reports one box at a fixed spot of every crop and remembers the crop shapes"""
+    names = {0: 'foreign_object'}
+
+    def __init__(self, conf=0.8):
+        self.conf = conf
+        self.calls = []
+
+    def predict(self, source, conf=0.25, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        self.calls.append([image.shape[:2] for image in images])
+        found = [[10, 10, 20, 20]] if self.conf >= conf else np.zeros((0, 4))
+        return [Result(Boxes(found, [self.conf] * len(found), [0] * len(found)), self.names, image.shape[:2])
+                for image in images]
+
+def settings(**overrides):
+    return dict(tiling_settings({'INFERENCE_TILING': 'tiles', 'INFERENCE_TILE_SIZE': 100}), **overrides)
+
+def test_tile_starts_cover_the_length_flush_with_the_edge():
+    assert tile_starts(80, 100, 80) == [0]
+    assert tile_starts(100, 100, 80) == [0]
+    assert tile_starts(250, 100, 80) == [0, 80, 150]
+    assert tile_starts(260, 100, 80) == [0, 80, 160]
+
+def test_tile_windows_overlap_and_stay_inside_the_image():
+    windows = tile_windows(150, 250, 100, 0.2)
+    assert len(windows) == 3 * 2
+    assert all(x2 - x1 == 100 and y2 - y1 == 100 for x1, y1, x2, y2 in windows)
+    assert max(x2 for _, _, x2, _ in windows) == 250 and max(y2 for _, _, _, y2 in windows) == 150
+    # Neighbouring tiles share at least the overlap
+    assert windows[1][0] - windows[0][0] == 80
+
+def test_box_ios_merges_boxes_cut_at_a_tile_edge():
+    whole = np.array([[0, 0, 100, 10]], dtype=np.float32)
+    cut = np.array([[50, 0, 100, 10]], dtype=np.float32)
+    assert box_ios(whole, cut)[0, 0] == pytest.approx(1.0)
+
+def test_merge_boxes_is_class_aware():
+    merged = merge_boxes([Boxes([[0, 0, 10, 10]], [0.9], [0]),
+                          Boxes([[1, 1, 10, 10], [0, 0, 10, 10]], [0.6, 0.7], [0, 1]),
+                          Boxes(np.zeros((0, 4)), [], [])], 0.5)
+    assert merged.conf.tolist() == pytest.approx([0.9, 0.7])
+    assert merged.cls.tolist() == [0, 1]
+
+def test_small_images_run_once():
+    backend = RecordingBackend()
+    predict_tiled(backend, np.zeros((90, 90, 3), dtype=np.uint8), 0.25, settings())
+    assert backend.calls == [[(90, 90)]]
+
+def test_tiles_are_batched_and_boxes_moved_to_image_coordinates():
+    backend = RecordingBackend()
+    [result] = predict_tiled(backend, np.zeros((150, 250, 3), dtype=np.uint8), 0.25, settings(batch_size=4))
+    # The full image, then six tiles in batches of four
+    assert [len(call) for call in backend.calls] == [1, 4, 2]
+    starts = {(x1, y1) for x1, y1, _, _ in result.boxes.xyxy.tolist()}
+    assert (10.0, 10.0) in starts and (160.0, 60.0) in starts
+
+def test_coarse_mode_only_runs_tiles_near_candidates():
+    backend = RecordingBackend(conf=0.1)
+    [result] = predict_tiled(backend, np.zeros((150, 250, 3), dtype=np.uint8), 0.25,
+                             settings(mode='coarse', coarse_conf=0.05))
+    # The coarse candidate at (10, 10) lies in the top-left tile only
+    assert [len(call) for call in backend.calls] == [1, 1]
+    # The candidate was below the real threshold, so nothing is reported
+    assert len(result.boxes) == 0
+
+def test_fingerprint_ignores_the_tile_batch_size(db, config):
+    assert tiling_fingerprint({}) == 'off'
+    off = get_settings_key()
+    config.update(INFERENCE_TILING='tiles', INFERENCE_TILE_SIZE=512)
+    tiled = get_settings_key()
+    config['INFERENCE_TILE_BATCH'] = 2
+    assert get_settings_key() == tiled != off
+    config['INFERENCE_TILE_OVERLAP'] = 0.3
+    assert get_settings_key() != tiled
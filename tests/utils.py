@@ -0,0 +1,33 @@
+"""Helpers shared by the tests"""
+import io
+import re
+from datetime import datetime
+from benchmarks.stub import render_xray, encode_jpeg
+
+def xray_jpeg(seed=0, width=320, height=256):
+    """JPEG bytes of a small synthetic X-ray; a different seed gives different bytes"""
+    return encode_jpeg(render_xray(width, height, seed))
+
+def post_upload(client, data, name='scan.jpg'):
+    """Upload through the form endpoint; returns the new upload id"""
+    response = client.post('/upload', data={'file': (io.BytesIO(data), name)},
+                           content_type='multipart/form-data')
+    assert response.status_code == 302
+    match = re.search(r'/image/(\d+)', response.headers['Location'])
+    assert match, response.headers['Location']
+    return int(match.group(1))
+
+def add_upload(data, status='done', **columns):
+    """Store the bytes and add an Upload row pointing at them, without running detection"""
+    from database import db, Upload
+    from cache import content_hash, content_path
+    from storage import storage
+    digest = content_hash(data)
+    key = content_path(digest, '.jpg')
+    storage.save(key, data)
+    columns.setdefault('upload_time', datetime.now())
+    upload = Upload(file_name=columns.pop('file_name', 'scan.jpg'), file_path=key, content_hash=digest,
+                    status=status, **columns)
+    db.session.add(upload)
+    db.session.commit()
+    return upload
@@ -0,0 +1,117 @@
+import numpy as np
+from backends import Boxes, Result, as_numpy_boxes
+
+# INFERENCE_TILING modes: whole image only, every tile, or tiles around coarse candidates
+TILING_MODES = ('off', 'tiles', 'coarse')
+
+def tiling_settings(config):
+    """Tiling options from the app config (or a plain dict in worker processes)"""
+    return {
+        'mode': config.get('INFERENCE_TILING', 'off'),
+        'tile_size': config.get('INFERENCE_TILE_SIZE', 1024),
+        'overlap': config.get('INFERENCE_TILE_OVERLAP', 0.2),
+        'batch_size': config.get('INFERENCE_TILE_BATCH', 8),
+        'merge_iou': config.get('INFERENCE_TILE_MERGE_IOU', 0.5),
+        'coarse_conf': config.get('INFERENCE_COARSE_CONF', 0.05)
+    }
+
+def tiling_enabled(config):
+    return config.get('INFERENCE_TILING', 'off') in TILING_MODES[1:]
+
+def tiling_fingerprint(config):
+    """The tiling options that change which boxes are found, for the result cache key"""
+    if not tiling_enabled(config):
+        return 'off'
+    settings = tiling_settings(config)
+    # The batch size only changes how tiles are grouped per predict call
+    del settings['batch_size']
+    return settings
+
+def tile_starts(length, tile_size, step):
+    """Start offsets covering length; the last tile is flush with the edge"""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, step))
+    return starts + [length - tile_size]
+
+def tile_windows(height, width, tile_size, overlap):
+    """Overlapping (x1, y1, x2, y2) windows covering an image"""
+    step = max(1, int(tile_size * (1 - overlap)))
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in tile_starts(height, tile_size, step)
+            for x in tile_starts(width, tile_size, step)]
+
+def box_ios(a, b):
+    """Pairwise intersection over the smaller box between (N, 4) and (M, 4) xyxy arrays.
+
+    A box cut off at a tile edge lies almost entirely inside the complete
+    box from the neighbouring tile, which IoU alone would not merge.
+    """
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return intersection / (np.minimum(area_a[:, None], area_b[None, :]) + 1e-9)
+
+def merge_boxes(box_sets, threshold):
+    """Class-aware greedy NMS over boxes from the full image and every tile"""
+    box_sets = [boxes for boxes in box_sets if len(boxes)]
+    if not box_sets:
+        return Boxes(np.zeros((0, 4)), [], [])
+    xyxy = np.concatenate([boxes.xyxy for boxes in box_sets])
+    conf = np.concatenate([boxes.conf for boxes in box_sets])
+    cls = np.concatenate([boxes.cls for boxes in box_sets])
+
+    order = np.argsort(-conf)
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        overlap = box_ios(xyxy[best:best + 1], xyxy[rest])[0]
+        order = rest[(overlap <= threshold) | (cls[rest] != cls[best])]
+    return Boxes(xyxy[keep], conf[keep], cls[keep])
+
+def predict_tiles(backend, image, windows, conf, batch_size):
+    """Run crops of the windows in batches; boxes come back in image coordinates"""
+    box_sets = []
+    for start in range(0, len(windows), batch_size):
+        chunk = windows[start:start + batch_size]
+        crops = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in chunk]
+        results = backend.predict(source=crops, save=False, conf=conf, verbose=False)
+        for (x1, y1, _, _), result in zip(chunk, results):
+            boxes = as_numpy_boxes(result.boxes)
+            box_sets.append(Boxes(boxes.xyxy + np.array([x1, y1, x1, y1], dtype=np.float32),
+                                  boxes.conf, boxes.cls))
+    return box_sets
+
+def overlaps_any(window, candidates):
+    x1, y1, x2, y2 = window
+    return bool(np.any((candidates[:, 0] < x2) & (candidates[:, 2] > x1) &
+                       (candidates[:, 1] < y2) & (candidates[:, 3] > y1)))
+
+def predict_tiled(backend, image, conf, settings):
+    """Detect on a full-resolution image tile by tile; returns [Result] like backend.predict.
+
+    The whole image is always run once as well, for objects larger than a
+    tile. In coarse mode that pass also runs at INFERENCE_COARSE_CONF and
+    only the tiles overlapping its candidates are run at full resolution.
+    """
+    height, width = image.shape[:2]
+    tile_size = settings['tile_size']
+    coarse = settings['mode'] == 'coarse'
+    first_conf = min(conf, settings['coarse_conf']) if coarse else conf
+    full = as_numpy_boxes(backend.predict(source=image, save=False, conf=first_conf, verbose=False)[0].boxes)
+    if height <= tile_size and width <= tile_size:
+        windows = []
+    else:
+        windows = tile_windows(height, width, tile_size, settings['overlap'])
+
+    if coarse:
+        candidates = full.xyxy
+        windows = [window for window in windows if len(candidates) and overlaps_any(window, candidates)]
+        keep = full.conf >= conf
+        full = Boxes(full.xyxy[keep], full.conf[keep], full.cls[keep])
+
+    box_sets = [full] + predict_tiles(backend, image, windows, conf, settings['batch_size'])
+    return [Result(merge_boxes(box_sets, settings['merge_iou']), backend.names, (height, width))]
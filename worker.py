@@ -0,0 +1,64 @@
+from flask import current_app
+import click
+import signal
+import threading
+import time
+from database import db, RescoreJob
+from detection import start_warm_up, get_model_status, pending_upload_ids, reset_stale_uploads
+from jobs import inference_queue
+from rescore import rescore_executor, run_rescore_job
+
+def pending_rescore_job():
+    return RescoreJob.query.filter_by(status='pending').order_by(RescoreJob.id).first()
+
+# Flask CLI command for the inference tier of an INFERENCE_PROCESS=external deployment
+@click.command("inference-worker")
+@click.option("--poll-interval", default=0.5, help="Seconds between looks for new uploads when idle.")
+@click.option("--rescore/--no-rescore", default=True, help="Also run rescore jobs started from the history page.")
+def inference_worker_command(poll_interval, rescore):
+    """Run detection for uploads that web workers stored as pending."""
+    app = current_app._get_current_object()
+    # This process is the inference tier, whatever INFERENCE_PROCESS says
+    inference_queue.external = False
+    start_warm_up(app).join()
+    status = get_model_status()
+    if not status['ready']:
+        raise click.ClickException(status['error'] or "Model not available")
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    # Enough queued jobs to keep the inference threads (and the batcher) busy
+    capacity = inference_queue.num_workers * max(2, app.config.get('INFERENCE_MAX_BATCH_SIZE', 8))
+    started_jobs = set()
+    lease = app.config.get('INFERENCE_LEASE_SECONDS', 600)
+    next_lease_check = 0.0
+    click.echo(f"Inference worker ready ({inference_queue.num_workers} threads), polling for uploads")
+    try:
+        while not stopping.is_set():
+            # Refill only once the queue has run dry, so waiting rows are not
+            # queued again; a job whose row is already claimed does nothing
+            ids = []
+            if time.monotonic() >= next_lease_check:
+                # Rows claimed by an inference process that died mid-run
+                reset = reset_stale_uploads(lease)
+                if reset:
+                    click.echo(f"Reset {len(reset)} uploads running longer than {lease}s")
+                next_lease_check = time.monotonic() + min(60, lease)
+            if inference_queue.stats()['queue_depth'] == 0:
+                ids = pending_upload_ids(capacity)
+                for upload_id in ids:
+                    # The job claims its row atomically, so several workers can poll the same table
+                    inference_queue.submit(upload_id)
+
+                job = pending_rescore_job() if rescore else None
+                if job and job.id not in started_jobs:
+                    started_jobs.add(job.id)
+                    rescore_executor.submit(run_rescore_job, app, job.id)
+
+                # End the read transaction so the next poll sees rows committed since
+                db.session.remove()
+            stopping.wait(0.05 if ids else poll_interval)
+    except KeyboardInterrupt:
+        pass
+    click.echo(f"Stopping, finishing {inference_queue.stats()['queue_depth']} queued uploads")
+    inference_queue.drain()